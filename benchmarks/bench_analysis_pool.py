@@ -0,0 +1,90 @@
+"""Measure page analysis throughput: in the event loop vs. a pool of workers.
+
+Usage: python -m benchmarks.bench_analysis_pool [--pages N] [--workers 1 2 4]
+
+Every page of a synthetic corpus is extracted and scored, as the scanner
+does once a page is downloaded, with each parser available (html.parser,
+lxml, selectolax) and with ANALYSIS_WORKERS processes. Throughput cannot
+grow beyond the number of CPUs of the host, which is printed too.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from web.backend.domains.analysis import AnalysisPool, analyse_page
+from web.backend.domains.keyword_matcher import default_matcher
+from web.backend.domains.text_extractor import PARSERS
+
+FILLER_WORDS = ["domain", "продается", "hosting", "купить", "this", "сайт",
+                "registrar", "контакты", "privacy", "policy", "cookie",
+                "доставка", "service", "заказ", "tracking", "номер"]
+FLAG_SENTENCE = "Почта России: отслеживание почтовых отправлений и посылок"
+
+
+def make_corpus(pages: int) -> list:
+    random_gen = random.Random(42)
+    corpus = []
+    for index in range(pages):
+        paragraphs = []
+        for _ in range(random_gen.randint(10, 400)):
+            words = random_gen.choices(FILLER_WORDS, k=random_gen.randint(5, 30))
+            paragraphs.append(f"<div class='p'><p>{' '.join(words)}</p></div>")
+        if index % 10 == 0:
+            paragraphs.insert(random_gen.randrange(len(paragraphs)),
+                              f"<h1>{FLAG_SENTENCE}</h1>")
+        corpus.append("<html><head><script>var a = 1;</script></head><body>"
+                      + "".join(paragraphs) + "</body></html>")
+    return corpus
+
+
+async def analyse_in_pool(pool: AnalysisPool, corpus: list, parser: str):
+    return await asyncio.gather(
+        *(pool.run(analyse_page, html, parser) for html in corpus)
+    )
+
+
+def measure(corpus: list, parser: str, workers: int) -> dict:
+    start = time.perf_counter()
+    if workers:
+        pool = AnalysisPool(workers)
+        # Workers are spawned before the clock starts
+        asyncio.run(analyse_in_pool(pool, corpus[:workers], parser))
+        start = time.perf_counter()
+        results = asyncio.run(analyse_in_pool(pool, corpus, parser))
+        elapsed = time.perf_counter() - start
+        pool.close()
+    else:
+        results = [analyse_page(html, parser) for html in corpus]
+        elapsed = time.perf_counter() - start
+    return {"parser": parser, "workers": workers,
+            "seconds": round(elapsed, 3),
+            "pages_per_sec": round(len(corpus) / elapsed, 1),
+            "dangerous": sum(score >= default_matcher.threshold
+                             for score, _ in results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.pages)
+    runs = []
+    for parser_name in PARSERS:
+        for workers in [0] + args.workers:
+            runs.append(measure(corpus, parser_name, workers))
+
+    print(json.dumps({
+        "cpus": os.cpu_count(),
+        "pages": len(corpus),
+        "megabytes": round(sum(map(len, corpus)) / 2 ** 20, 2),
+        "runs": runs,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Time checking the default candidate list with and without DNS
+pre-resolution.
+
+Usage: python -m benchmarks.bench_dns_prefilter [--registered 0.05]
+       [--dns-latency 0.02] [--nxdomain-latency 0.05] [--concurrency 200]
+
+Runs against a local stub: a fraction of the candidates' hosts resolve to a
+local aiohttp server, the rest do not exist. "before" sends a GET for every
+url and lets aiohttp resolve the name, "after" resolves names first and only
+requests registered ones; "after_warm" repeats it with a warm DNS cache, as
+on the next night.
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+from web.backend.domains.dns_resolver import (ConnectorResolver,
+                                              DnsResolver, NameNotFoundError)
+from web.backend.domains.urls_generator import generate_candidates
+
+
+class StubDns:
+    def __init__(self, hosts, registered, latency, nxdomain_latency):
+        random_gen = random.Random(42)
+        self.registered = {host for host in sorted(hosts)
+                           if random_gen.random() < registered}
+        self.latency = latency
+        self.nxdomain_latency = nxdomain_latency
+        self.queries = 0
+
+    async def lookup(self, host):
+        self.queries += 1
+        if host not in self.registered:
+            await asyncio.sleep(self.nxdomain_latency)
+            raise NameNotFoundError(host)
+        await asyncio.sleep(self.latency)
+        return ["127.0.0.1"], 300
+
+
+class StubAiohttpResolver(AbstractResolver):
+    """Resolve through the stub like aiohttp's default resolver would"""
+
+    def __init__(self, dns, port):
+        self.dns = dns
+        self.port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        try:
+            addresses, _ = await self.dns.lookup(host)
+        except NameNotFoundError:
+            raise OSError(f"Could not resolve {host}")
+        return [{"hostname": host, "host": address, "port": self.port,
+                 "family": socket.AF_INET, "proto": 0,
+                 "flags": socket.AI_NUMERICHOST} for address in addresses]
+
+    async def close(self):
+        pass
+
+
+class LocalPortResolver(ConnectorResolver):
+    def __init__(self, dns_resolver, port):
+        super().__init__(dns_resolver)
+        self.port = port
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return await super().resolve(host, self.port, family)
+
+
+async def fetch_all(urls, resolver, concurrency, dns_resolver=None):
+    """GET every url, resolving its host with 'dns_resolver' first if given
+    and skipping names that do not exist, as the scanner's workers do"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+    requests = 0
+
+    async def fetch(session, url):
+        nonlocal requests
+        async with semaphore:
+            if dns_resolver and not await dns_resolver.resolve(
+                    urlsplit(url).hostname
+            ):
+                return
+            requests += 1
+            try:
+                async with session.get(url.replace("https://", "http://")) \
+                        as response:
+                    await response.read()
+            except (aiohttp.ClientError, OSError):
+                pass
+
+    connector = aiohttp.TCPConnector(limit=concurrency, resolver=resolver)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(fetch(session, url) for url in urls))
+    return requests
+
+
+async def main(args):
+    async def page(request):
+        return web.Response(text="<html><body>Parked domain</body></html>",
+                            content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/", page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=4096)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    urls = list(generate_candidates())
+    stub = StubDns({urlsplit(url).hostname for url in urls},
+                   args.registered, args.dns_latency, args.nxdomain_latency)
+    results = {"candidates": len(urls),
+               "registered_hosts": len(stub.registered)}
+
+    try:
+        start = time.perf_counter()
+        requests = await fetch_all(
+            urls, StubAiohttpResolver(stub, port), args.concurrency
+        )
+        results["before"] = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "dns_queries": stub.queries, "http_requests": requests
+        }
+
+        dns_resolver = DnsResolver(lookup=stub.lookup,
+                                   concurrency=args.concurrency)
+        for run in ("after", "after_warm"):
+            stub.queries = 0
+            start = time.perf_counter()
+            requests = await fetch_all(
+                urls, LocalPortResolver(dns_resolver, port),
+                args.concurrency, dns_resolver
+            )
+            results[run] = {
+                "seconds": round(time.perf_counter() - start, 3),
+                "dns_queries": stub.queries, "http_requests": requests
+            }
+    finally:
+        await runner.cleanup()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--registered", type=float, default=0.05)
+    parser.add_argument("--dns-latency", type=float, default=0.02)
+    parser.add_argument("--nxdomain-latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,86 @@
+"""Compare the compiled keyword matcher with the former nested-loop check.
+
+Usage: python -m benchmarks.bench_keyword_matcher [PAGES_DIR] [--repeat N]
+
+PAGES_DIR is a directory of saved pages (*.html, *.htm, *.txt). Without it
+a synthetic corpus of parked and phishing-like pages is generated.
+"""
+import argparse
+import json
+import pathlib
+import random
+import time
+
+from web.backend.domains.keyword_matcher import default_matcher
+from web.backend.domains.text_extractor import TextExtractor
+
+LEGACY_FLAG_WORDS = ["почт", "росси", "отправлени", "посылк", "письм", "писем"]
+
+FILLER_WORDS = ["domain", "продается", "hosting", "купить", "this", "сайт",
+                "registrar", "контакты", "privacy", "policy", "cookie",
+                "доставка", "service", "заказ", "tracking", "номер"]
+FLAG_SENTENCE = "Почта России: отслеживание почтовых отправлений и посылок"
+
+
+def legacy_check(text: str) -> bool:
+    page_text = text.split()
+    potential_infringements = set(
+        word.lower() for word in page_text for flag_word in LEGACY_FLAG_WORDS
+        if flag_word in word.lower()
+    )
+    return len(potential_infringements) > 2
+
+
+def load_corpus(pages_dir: str = None) -> list:
+    if pages_dir:
+        pages = []
+        for path in sorted(pathlib.Path(pages_dir).iterdir()):
+            if path.suffix in (".html", ".htm", ".txt"):
+                extractor = TextExtractor()
+                html = path.read_text(errors="replace")
+                pages.append(extractor.feed(html) + extractor.close())
+        return pages
+
+    random_gen = random.Random(42)
+    pages = []
+    for index in range(500):
+        words = random_gen.choices(FILLER_WORDS, k=random_gen.randint(50, 5000))
+        if index % 10 == 0:
+            words.insert(random_gen.randrange(len(words)), FLAG_SENTENCE)
+        pages.append(" ".join(words))
+    return pages
+
+
+def measure(check, pages: list, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        verdicts = [check(page) for page in pages]
+        best = min(best, time.perf_counter() - start)
+    return {"seconds": round(best, 4),
+            "pages_per_sec": round(len(pages) / best, 1),
+            "dangerous": sum(verdicts)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pages_dir", nargs="?")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    pages = load_corpus(args.pages_dir)
+    results = {
+        "pages": len(pages),
+        "megabytes": round(sum(map(len, pages)) / 2 ** 20, 2),
+        "legacy": measure(legacy_check, pages, args.repeat),
+        "compiled": measure(
+            lambda text: default_matcher.score(text)[0]
+            >= default_matcher.threshold,
+            pages, args.repeat
+        ),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Compare the probe modes of the scanner's HTTP client on the local fake
+internet: "get" downloads pages right away, "head" asks for their headers
+first and "range" for their first SCAN_PROBE_BYTES only.
+
+Usage: python -m benchmarks.bench_probe_modes [--hosts 2000]
+       [--modes get head range] [--concurrency 200] [--probe-bytes 65536]
+       [--large 0.2] [--latency 0.02] ...
+
+Every mode checks the same hosts twice, as the scanner's Domain does
+(resolving them first), without a database: a first scan of unknown pages
+and a rescan knowing the results of the first one, when unchanged pages are
+recognised early. Slow and slow-loris sites are left out by default, they
+only measure timeouts. The report is JSON: seconds, requests and bytes of
+pages served by the farm per pass, and whether every mode has come to the
+same verdicts as "get".
+"""
+import argparse
+import asyncio
+import datetime
+import json
+
+import aiohttp
+
+from benchmarks.fake_internet import (STATS_HOST, FarmConfig,
+                                      LocalPortResolver, StubDns, start_farm)
+from web.backend.domains.dns_resolver import DnsResolver
+from web.backend.domains.domains_checker import Domain, FingerprintIndex
+from web.backend.domains.http_client import PROBE_MODES, HttpClientProfile
+from web.backend.domains.targets import TargetIndex
+
+# Farm settings of this benchmark where they differ from FarmConfig's
+FARM_DEFAULTS = {"registered": 1.0, "large": 0.2, "slow": 0.0,
+                 "slowloris": 0.0}
+
+
+async def farm_stats(port: int) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/",
+                               headers={"Host": STATS_HOST}) as response:
+            return await response.json()
+
+
+def state_of(domain: Domain) -> dict:
+    """Row of 'all_domains' the check of the domain would have written"""
+    now = datetime.datetime.utcnow()
+    return dict(
+        url=domain.url, last_updated=now, whitelisted=False,
+        is_alive=domain.is_alive, is_dangerous=domain.is_dangerous,
+        next_check=now, dead_checks=0, registered_at=None,
+        danger_score=domain.scorer.score,
+        matched_terms=", ".join(domain.scorer.terms), etag=domain.etag,
+        last_modified=domain.last_modified,
+        content_hash=domain.content_hash, simhash=domain.simhash,
+        similar_to=domain.similar_to
+    )
+
+
+async def check_all(urls: list, states: dict, profile: HttpClientProfile,
+                    config: FarmConfig, ports: dict,
+                    concurrency: int) -> list:
+    dns = DnsResolver(lookup=StubDns(config))
+    connector = profile.connector(concurrency,
+                                  LocalPortResolver(dns, ports, config))
+    index = FingerprintIndex()
+    targets = TargetIndex()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with profile.session(connector) as session:
+        async def check(url):
+            domain = Domain(url, session=session, engine=None,
+                            state=states.get(url), dns=dns, index=index,
+                            targets=targets, profile=profile)
+            async with semaphore:
+                await domain._make_checks()
+            return domain
+
+        return await asyncio.gather(*(check(url) for url in urls))
+
+
+async def run_mode(mode: str, urls: list, args, config: FarmConfig,
+                   ports: dict) -> dict:
+    profile = HttpClientProfile(probe_mode=mode,
+                                probe_bytes=args.probe_bytes)
+    states = {}
+    results = {}
+    for run in ("scan", "rescan"):
+        before = await farm_stats(ports["http"])
+        start = asyncio.get_event_loop().time()
+        domains = await check_all(urls, states, profile, config, ports,
+                                  args.concurrency)
+        elapsed = asyncio.get_event_loop().time() - start
+        after = await farm_stats(ports["http"])
+        results[run] = {
+            "seconds": round(elapsed, 3),
+            "requests": after["requests"] - before["requests"],
+            "page_bytes": after["bytes"] - before["bytes"],
+            "alive": sum(domain.is_alive for domain in domains),
+            "dangerous": sum(domain.is_dangerous for domain in domains),
+        }
+        results[run]["verdicts"] = {
+            domain.url: (domain.is_alive, domain.is_dangerous)
+            for domain in domains
+        }
+        states = {domain.url: state_of(domain) for domain in domains}
+    return results
+
+
+async def main(args):
+    overrides = {field: getattr(args, field) for field in FarmConfig._fields}
+    config = FarmConfig(**overrides)
+    farm, ports = start_farm(config)
+    urls = [f"http://probe-{index}.ru" for index in range(args.hosts)]
+    report = {"hosts": args.hosts, "farm": config._asdict(), "modes": {}}
+    try:
+        for mode in args.modes:
+            report["modes"][mode] = await run_mode(mode, urls, args, config,
+                                                   ports)
+    finally:
+        farm.terminate()
+
+    verdicts = {
+        (mode, run): report["modes"][mode][run].pop("verdicts")
+        for mode in report["modes"] for run in ("scan", "rescan")
+    }
+    if "get" in report["modes"]:
+        for (mode, run), verdict in verdicts.items():
+            report["modes"][mode][run]["same_verdicts_as_get"] = (
+                verdict == verdicts["get", run]
+            )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--hosts", type=int, default=2000)
+    parser.add_argument("--modes", nargs="+", choices=PROBE_MODES,
+                        default=list(PROBE_MODES))
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--probe-bytes", type=int, default=65536)
+    for field, default in FarmConfig._field_defaults.items():
+        default = FARM_DEFAULTS.get(field, default)
+        parser.add_argument(f"--{field.replace('_', '-')}",
+                            type=type(default), default=default)
+    asyncio.run(main(parser.parse_args()))
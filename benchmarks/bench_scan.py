@@ -0,0 +1,175 @@
+"""Run 'find_dangerous_domains' end to end against a local fake internet.
+
+Usage: DB_HOST=localhost DB_NAME=squatter_bench DB_USER=... DB_PASS=... \\
+       python -m benchmarks.bench_scan [--sizes 1000 10000 100000] [--reset]
+       [--output results.json] [--registered 0.3] [--latency 0.02] ...
+
+The scanner checks N synthetic candidates whose hosts are served by
+benchmarks/fake_internet.py. That module provides the stub DNS, the site
+farm with slow, slow-loris, redirecting, failing and broken-TLS sites, and
+the stub WHOIS server. The scanner's settings (SCAN_CONCURRENCY,
+ANALYSIS_WORKERS, ...) are read from the environment as in production.
+
+Results go to the database named by the DB_* variables, which must be a
+throwaway one: with --reset its tables are dropped and created again. The
+benchmark refuses to run on a database that has candidates otherwise.
+
+Each size runs in a fresh process so that its peak RSS is its own. The
+report is JSON, including the settings of the run, so that runs can be
+compared:
+- throughput in domains/sec
+- p50/p99 of the check and response latencies (estimated from histograms)
+- peak RSS
+- database statements per domain
+- outcomes and errors by class
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import aiohttp
+from sqlalchemy import func, select
+
+from benchmarks.fake_internet import (FarmConfig, LocalPortResolver, StubDns,
+                                      start_farm, whois_lookup)
+from web.backend.db.db_utils import add_candidates
+from web.backend.db.model import (DB_STATEMENT_SECONDS, all_domains,
+                                  async_engine, create_schema, metadata)
+from web.backend.domains import domains_checker
+from web.backend.domains.dns_resolver import DnsResolver
+from web.backend.domains.scheduler import SCAN_CONCURRENCY
+from web.backend.domains.whois_parser import WhoisResolver
+
+OUTCOMES = ["unregistered", "dead", "alive", "dangerous", "whitelisted",
+            "skipped"]
+SETTINGS = ["SCAN_CONCURRENCY", "SCAN_PER_HOST_LIMIT",
+            "SCAN_PER_NETWORK_LIMIT", "SCAN_MAX_DEFERRED", "ANALYSIS_WORKERS",
+            "RESULT_BATCH_SIZE", "SCAN_TOTAL_TIMEOUT",
+            "SCAN_FIRST_BYTE_TIMEOUT", "SCAN_PROBE_MODE", "SCAN_PROBE_BYTES",
+            "SCAN_COMPRESSION", "SCAN_KEEPALIVE_TIMEOUT"]
+
+
+async def prepare_database(urls: list, reset: bool):
+    async with async_engine.begin() as conn:
+        if reset:
+            await conn.run_sync(metadata.drop_all)
+        await conn.run_sync(create_schema)
+        candidates = (await conn.execute(
+            select(func.count()).select_from(all_domains)
+        )).scalar()
+    if candidates:
+        raise SystemExit(f"The database already has {candidates} candidates, "
+                         f"run with --reset to drop them")
+    await add_candidates(urls)
+
+
+def _quantiles(histogram, **labels) -> dict:
+    return {f"p{int(q * 100)}": round(histogram.quantile(q, **labels) or 0, 4)
+            for q in (0.5, 0.99)}
+
+
+async def scan(size: int, config: FarmConfig, ports: dict,
+               reset: bool) -> dict:
+    urls = [f"http://bench-{size}-{index}.ru" for index in range(size)]
+    await prepare_database(urls, reset)
+
+    dns_lookup = StubDns(config)
+    dns = DnsResolver(lookup=dns_lookup)
+    connector = aiohttp.TCPConnector(
+        limit=SCAN_CONCURRENCY, use_dns_cache=False,
+        resolver=LocalPortResolver(dns, ports, config)
+    )
+    whois = WhoisResolver(lookup=whois_lookup(ports["whois"]),
+                          min_interval=0)
+    statements = DB_STATEMENT_SECONDS.total()
+
+    start = time.perf_counter()
+    await domains_checker.find_dangerous_domains(
+        seed=False, export=False, dns=dns, connector=connector, whois=whois,
+        rate=0, resume=False
+    )
+    elapsed = time.perf_counter() - start
+    whois.close()
+    await async_engine.dispose()
+
+    checked = domains_checker.DOMAINS_CHECKED
+    domains = checked.total()
+    return {
+        "candidates": size,
+        "domains_checked": domains,
+        "seconds": round(elapsed, 3),
+        "domains_per_sec": round(domains / elapsed, 1) if elapsed else 0,
+        "check_latency": _quantiles(domains_checker.CHECK_SECONDS),
+        "response_latency": _quantiles(domains_checker.FETCH_SECONDS,
+                                       phase="response"),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "db_statements_per_domain": round(
+            (DB_STATEMENT_SECONDS.total() - statements) / domains, 3
+        ) if domains else 0,
+        "dns_queries": dns_lookup.queries,
+        "whois_lookups": whois.lookups_made,
+        "outcomes": {outcome: checked.value(outcome=outcome)
+                     for outcome in OUTCOMES},
+        "errors": {":".join(key): count for key, count
+                   in domains_checker.SCAN_ERRORS.values().items()},
+    }
+
+
+def _run_size(size: int, config: FarmConfig, ports: dict, reset: bool,
+              results):
+    results.put(asyncio.run(scan(size, config, ports, reset)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--reset", action="store_true",
+                        help="drop and create the database's tables first")
+    parser.add_argument("--output", help="file the JSON report is saved to")
+    for field, default in FarmConfig._field_defaults.items():
+        parser.add_argument(f"--{field.replace('_', '-')}",
+                            type=type(default), default=default)
+    args = parser.parse_args()
+
+    config = FarmConfig(**{field: getattr(args, field)
+                           for field in FarmConfig._fields})
+    farm, ports = start_farm(config)
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    try:
+        for index, size in enumerate(args.sizes):
+            results = context.Queue()
+            # Candidates of the previous size are dropped before the next
+            reset = args.reset or index > 0
+            process = context.Process(
+                target=_run_size, args=(size, config, ports, reset, results)
+            )
+            process.start()
+            runs.append(results.get())
+            process.join()
+    finally:
+        farm.terminate()
+
+    report = json.dumps({
+        "cpus": os.cpu_count(),
+        "settings": {name: os.getenv(name) for name in SETTINGS},
+        "farm": config._asdict(),
+        "runs": runs,
+    }, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
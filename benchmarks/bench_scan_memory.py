@@ -0,0 +1,169 @@
+"""Measure the memory a scan's state holds as the number of candidates grows.
+
+Usage: python -m benchmarks.bench_scan_memory
+       [--candidates 100000 1000000] [--pages 0.1] [--targets 0.02]
+       [--registered 0.3]
+
+Candidates stream through the scheduler, so the state that grows with them
+is what a scan keeps until it ends: the verdicts on the distinct pages
+(FingerprintIndex) and redirect targets (TargetIndex) it has analysed and
+the DNS answers for the candidates' hosts. Each is filled as a scan of N
+candidates would fill it and measured with tracemalloc. Verdicts are also
+measured as the dicts (and, for targets, the futures) they used to be kept
+as. The report is JSON: bytes in total and per candidate.
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import hashlib
+import json
+import random
+import tracemalloc
+
+from web.backend.domains.dns_resolver import DnsResolver, NameNotFoundError
+from web.backend.domains.fingerprint import FingerprintIndex, Verdict
+from web.backend.domains.targets import TargetIndex
+
+TERMS = ["почта", "россии", "отслеживание", "отправлений", "трек-номер",
+         "посылка", "оплата"]
+RESOLVE_CHUNK_SIZE = 10000
+
+
+def measure(build) -> int:
+    """Bytes still allocated by 'build()' once it has returned"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del state
+    return allocated
+
+
+def make_verdicts(count: int, seed: int = 42) -> list:
+    """Fields of the verdicts on 'count' distinct pages"""
+    random_gen = random.Random(seed)
+    verdicts = []
+    for index in range(count):
+        terms = random_gen.sample(TERMS, random_gen.randint(0, 3))
+        verdicts.append((
+            f"http://pochta-{index}.ru", bool(terms),
+            float(len(terms)), ", ".join(terms),
+            hashlib.sha256(str(index).encode()).hexdigest(),
+            random_gen.getrandbits(64) - (1 << 63)
+        ))
+    return verdicts
+
+
+def fingerprints_as_records(verdicts: list):
+    index = FingerprintIndex()
+    for fields in verdicts:
+        index.add(Verdict(*fields))
+    return index
+
+
+def fingerprints_as_dicts(verdicts: list):
+    bands = FingerprintIndex()._bands
+    by_hash = {}
+    by_band = collections.defaultdict(list)
+    for url, dangerous, score, terms, content_hash, value in verdicts:
+        verdict = dict(url=url, is_dangerous=dangerous, danger_score=score,
+                       matched_terms=terms)
+        by_hash[content_hash] = verdict
+        for band in bands(value):
+            by_band[band].append((value, verdict))
+    return by_hash, by_band
+
+
+def targets_as_records(verdicts: list):
+    async def publish_all():
+        targets = TargetIndex()
+        for fields in verdicts:
+            url = f"https://landing-{fields[0][len('http://'):]}/"
+            targets.claim(url)
+            targets.publish(url, Verdict(*fields))
+        return targets
+
+    return asyncio.run(publish_all())
+
+
+def targets_as_dicts(verdicts: list):
+    async def publish_all():
+        loop = asyncio.get_event_loop()
+        targets = {}
+        for url, dangerous, score, terms, content_hash, value in verdicts:
+            future = targets[f"https://landing-{url[len('http://'):]}/"] = (
+                loop.create_future()
+            )
+            future.set_result(dict(url=url, is_dangerous=dangerous,
+                                   danger_score=score, matched_terms=terms,
+                                   content_hash=content_hash, simhash=value))
+        return targets
+
+    return asyncio.run(publish_all())
+
+
+def resolved_hosts(count: int, registered: float):
+    random_gen = random.Random(42)
+
+    async def lookup(host):
+        if random_gen.random() >= registered:
+            raise NameNotFoundError(host)
+        return [f"192.0.2.{random_gen.randint(1, 254)}"], 300
+
+    async def resolve_all():
+        resolver = DnsResolver(lookup=lookup)
+        for start in range(0, count, RESOLVE_CHUNK_SIZE):
+            await asyncio.gather(*(
+                resolver.resolve(f"pochta-{index}.ru")
+                for index in range(start, min(start + RESOLVE_CHUNK_SIZE,
+                                              count))
+            ))
+        return resolver
+
+    return asyncio.run(resolve_all())
+
+
+def run(candidates: int, args) -> dict:
+    pages = make_verdicts(int(candidates * args.pages))
+    targets = make_verdicts(int(candidates * args.targets), seed=7)
+    report = {
+        "fingerprints": {
+            "records": measure(lambda: fingerprints_as_records(pages)),
+            "dicts": measure(lambda: fingerprints_as_dicts(pages)),
+        },
+        "targets": {
+            "records": measure(lambda: targets_as_records(targets)),
+            "dicts": measure(lambda: targets_as_dicts(targets)),
+        },
+        "dns": measure(lambda: resolved_hosts(candidates, args.registered)),
+    }
+    total = (report["fingerprints"]["records"]
+             + report["targets"]["records"] + report["dns"])
+    report["total"] = total
+    report["bytes_per_candidate"] = round(total / candidates, 1)
+    return report
+
+
+def main(args):
+    report = {"pages": args.pages, "targets": args.targets,
+              "registered": args.registered, "candidates": {}}
+    for candidates in args.candidates:
+        report["candidates"][candidates] = run(candidates, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--candidates", type=int, nargs="+",
+                        default=[100000, 1000000])
+    # Shares of the candidates with a distinct page and a distinct redirect
+    # target, and of the ones whose host is registered
+    parser.add_argument("--pages", type=float, default=0.1)
+    parser.add_argument("--targets", type=float, default=0.02)
+    parser.add_argument("--registered", type=float, default=0.3)
+    main(parser.parse_args())
@@ -0,0 +1,274 @@
+"""A local stand-in for the internet the scanner checks, used by the
+end-to-end benchmark (benchmarks/bench_scan.py).
+
+Every candidate host gets a deterministic profile derived from its name:
+it is not registered, or it serves a parked page, a phishing page (the same
+kit on many domains), a large page, a slow page, a slow-loris response that
+trickles bytes, a redirect, a server error, or a broken TLS endpoint.
+
+- The site farm is one aiohttp server dispatching on the Host header. It
+  runs in its own process so that its CPU time is not charged to the
+  scanner. It answers HEAD and Range requests, and the host STATS_HOST
+  tells how many requests it has served and how many bytes of pages.
+- A stub WHOIS server answers "key: value" records over the WHOIS protocol
+  (TCP, one query per connection).
+- A TLS port accepts connections and sends garbage, which fails the
+  handshake the way expired or self-signed certificates do.
+- StubDns and LocalPortResolver route the scanner's lookups and
+  connections to those ports.
+"""
+import asyncio
+import datetime
+import hashlib
+import multiprocessing
+import random
+import re
+import socket
+from typing import NamedTuple
+
+from aiohttp import web
+
+from web.backend.domains.dns_resolver import (ConnectorResolver,
+                                              NameNotFoundError)
+
+PROFILES = ["parked", "phishing", "large", "slow", "slowloris", "redirect",
+            "error", "tls"]
+
+PARKED_PAGE = ("<html><head><title>{host}</title></head><body><h1>{host}"
+               "</h1><p>This domain is for sale. Домен продается.</p>"
+               "</body></html>")
+PHISHING_PAGE = ("<html><head><title>Почта России</title></head><body>"
+                 "<h1>Почта России</h1><p>Отслеживание почтовых отправлений"
+                 " и посылок</p><form><input name='track'></form>"
+                 + "<p>Введите трек-номер отправления</p>" * 40
+                 + "</body></html>")
+FILLER = "<p>" + "lorem ipsum dolor sit amet " * 20 + "</p>\n"
+STATS_HOST = "stats.farm"
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class FarmConfig(NamedTuple):
+    # Share of the hosts that are registered and shares of the profiles of
+    # the registered ones (the rest serve parked pages)
+    registered: float = 0.3
+    phishing: float = 0.05
+    large: float = 0.05
+    slow: float = 0.05
+    slowloris: float = 0.01
+    redirect: float = 0.05
+    error: float = 0.03
+    tls: float = 0.03
+    # Mean latency of a response, latency of slow sites and size of large
+    # pages in bytes
+    latency: float = 0.02
+    slow_latency: float = 2.0
+    large_size: int = 2 * 1024 * 1024
+    # Seconds between the bytes of slow-loris responses
+    slowloris_interval: float = 1.0
+    dns_latency: float = 0.005
+    whois_latency: float = 0.05
+
+
+def _fraction(host: str, salt: str) -> float:
+    digest = hashlib.blake2b(f"{salt}:{host}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2 ** 64
+
+
+def is_registered(host: str, config: FarmConfig) -> bool:
+    return _fraction(host, "dns") < config.registered
+
+
+def profile_of(host: str, config: FarmConfig) -> str:
+    value = _fraction(host, "profile")
+    for profile in PROFILES:
+        if profile == "parked":
+            continue
+        share = getattr(config, profile)
+        if value < share:
+            return profile
+        value -= share
+    return "parked"
+
+
+def _page(request: web.Request, text: str, stats: dict,
+          **kwargs) -> web.Response:
+    """Response with the page or the range of it that has been asked for"""
+    body = text.encode("utf-8")
+    status = 200
+    headers = dict(kwargs.pop("headers", None) or {})
+    headers["Accept-Ranges"] = "bytes"
+    match = RANGE_PATTERN.match(request.headers.get("Range", ""))
+    if match and int(match.group(1)) < len(body):
+        first = int(match.group(1))
+        last = min(int(match.group(2) or len(body) - 1), len(body) - 1)
+        headers["Content-Range"] = f"bytes {first}-{last}/{len(body)}"
+        body, status = body[first:last + 1], 206
+    stats["requests"] += 1
+    if request.method != "HEAD":
+        stats["bytes"] += len(body)
+    return web.Response(body=body, status=status, headers=headers,
+                        content_type="text/html", charset="utf-8", **kwargs)
+
+
+def make_app(config: FarmConfig) -> web.Application:
+    stats = {"requests": 0, "bytes": 0}
+
+    async def site(request: web.Request) -> web.StreamResponse:
+        host = request.host.split(":")[0]
+        if host == STATS_HOST:
+            return web.json_response(stats)
+        profile = profile_of(host, config)
+        await asyncio.sleep(random.expovariate(1 / config.latency)
+                            if config.latency else 0)
+
+        if profile == "slow":
+            await asyncio.sleep(config.slow_latency)
+        elif profile == "error":
+            raise web.HTTPInternalServerError()
+        elif profile == "redirect" and request.path == "/":
+            raise web.HTTPFound("/landing")
+        elif profile == "slowloris":
+            response = web.StreamResponse(
+                headers={"Content-Type": "text/html"}
+            )
+            await response.prepare(request)
+            for char in PARKED_PAGE.format(host=host):
+                await response.write(char.encode("utf-8"))
+                await asyncio.sleep(config.slowloris_interval)
+            return response
+        elif profile == "large":
+            body = FILLER * (config.large_size // len(FILLER) + 1)
+            return _page(request, body, stats,
+                         headers={"Last-Modified": "Fri, 01 Jan 2021 "
+                                                   "00:00:00 GMT"})
+        elif profile == "phishing":
+            return _page(request, PHISHING_PAGE, stats,
+                         headers={"ETag": '"kit-v1"'})
+        return _page(request, PARKED_PAGE.format(host=host), stats)
+
+    app = web.Application()
+    # HEAD requests are answered by the same handler
+    app.router.add_get("/{path:.*}", site)
+    return app
+
+
+async def _answer_whois(config: FarmConfig, reader, writer):
+    query = (await reader.readline()).decode(errors="replace").strip()
+    await asyncio.sleep(config.whois_latency)
+    owner = ("Private Person" if _fraction(query, "owner") < 0.8
+             else "JSC Russian Post")
+    writer.write(
+        f"domain: {query}\nregistrar: FAKE-REGISTRAR-RU\norg: {owner}\n"
+        f"abuse-email: abuse@fake-registrar.ru\n"
+        f"created: 2021-01-01T00:00:00Z\n".encode("utf-8")
+    )
+    await writer.drain()
+    writer.close()
+
+
+async def _send_garbage(reader, writer):
+    writer.write(b"this is not a TLS handshake\r\n")
+    await writer.drain()
+    writer.close()
+
+
+async def _serve(config: FarmConfig, ports):
+    runner = web.AppRunner(make_app(config), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=4096)
+    await site.start()
+    whois_server = await asyncio.start_server(
+        lambda reader, writer: _answer_whois(config, reader, writer),
+        "127.0.0.1", 0
+    )
+    tls_server = await asyncio.start_server(_send_garbage, "127.0.0.1", 0)
+    ports.put({
+        "http": site._server.sockets[0].getsockname()[1],
+        "whois": whois_server.sockets[0].getsockname()[1],
+        "tls": tls_server.sockets[0].getsockname()[1],
+    })
+    await asyncio.Event().wait()
+
+
+def _run_farm(config: FarmConfig, ports):
+    asyncio.run(_serve(config, ports))
+
+
+def start_farm(config: FarmConfig):
+    """Start the farm in a separate process
+
+    :return: the process and a dict of the ports of its http, whois and tls
+    servers
+    """
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    process = context.Process(target=_run_farm, args=(config, ports),
+                              name="fake-internet", daemon=True)
+    process.start()
+    return process, ports.get(timeout=30)
+
+
+class StubDns:
+    """DnsResolver lookup answering a loopback address for the registered
+    hosts. Hosts get distinct addresses spread over 256 networks, like
+    sites of many hosting providers, so that the scanner's per-IP and
+    per-network limits apply as they do on the internet."""
+
+    def __init__(self, config: FarmConfig):
+        self.config = config
+        self.queries = 0
+
+    async def __call__(self, host: str):
+        self.queries += 1
+        await asyncio.sleep(self.config.dns_latency)
+        if not is_registered(host, self.config):
+            raise NameNotFoundError(host)
+        value = int(_fraction(host, "address") * 2 ** 24)
+        return [f"127.{value >> 16}.{value >> 8 & 0xff}.{value & 0xff}"], 300
+
+
+class LocalPortResolver(ConnectorResolver):
+    """Connect to the farm's http port instead of 80 and to the broken TLS
+    port for https:// urls and hosts with the 'tls' profile"""
+
+    def __init__(self, dns_resolver, ports: dict, config: FarmConfig):
+        super().__init__(dns_resolver)
+        self.ports = ports
+        self.config = config
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        broken_tls = port == 443 or profile_of(host, self.config) == "tls"
+        hosts = await super().resolve(
+            host, self.ports["tls" if broken_tls else "http"], family
+        )
+        # The farm only listens on 127.0.0.1
+        return [{**entry, "host": "127.0.0.1"} for entry in hosts]
+
+
+def whois_lookup(port: int):
+    """Blocking WHOIS lookup against the stub server, run in the
+    WhoisResolver's threads like the real one
+
+    :return: a function returning records in the format of
+    'get_whois_record'
+    """
+    def lookup(domain_name: str) -> dict:
+        with socket.create_connection(("127.0.0.1", port), timeout=10) as conn:
+            conn.sendall(f"{domain_name}\r\n".encode())
+            response = b""
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                response += data
+
+        fields = dict(line.split(": ", 1) for line in
+                      response.decode().splitlines() if ": " in line)
+        return {"domain_name": domain_name, "owner_name": fields["org"],
+                "registrar_name": fields["registrar"].lower(),
+                "abuse_emails": fields["abuse-email"],
+                "creation_date": datetime.datetime.strptime(
+                    fields["created"], "%Y-%m-%dT%H:%M:%SZ"
+                )}
+
+    return lookup
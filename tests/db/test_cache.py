@@ -0,0 +1,46 @@
+from web.backend.db import cache
+
+
+def test_response_cache_stores_responses_until_invalidated():
+    response_cache = cache.ResponseCache(max_size=2)
+    assert response_cache.get("all") is None
+
+    stored = response_cache.put("all", b"[]", None, response_cache.generation)
+    assert response_cache.get("all") is stored
+    assert stored.etag == response_cache.put(
+        "other", b"[]", None, response_cache.generation
+    ).etag
+
+    response_cache.invalidate()
+    assert response_cache.get("all") is None
+    assert response_cache.hits == 1 and response_cache.misses == 2
+
+
+def test_response_cache_drops_responses_computed_before_invalidation():
+    response_cache = cache.ResponseCache()
+    generation = response_cache.generation
+    response_cache.invalidate()
+
+    response = response_cache.put("all", b"[]", None, generation)
+    assert response.body == b"[]"
+    assert response_cache.get("all") is None
+
+
+def test_response_cache_evicts_least_recently_used():
+    response_cache = cache.ResponseCache(max_size=2)
+    for key in ("first", "second"):
+        response_cache.put(key, key.encode(), None, 0)
+    response_cache.get("first")
+    response_cache.put("third", b"third", None, 0)
+
+    assert response_cache.get("second") is None
+    assert response_cache.get("first").body == b"first"
+    assert len(response_cache) == 2
+
+
+def test_disabled_response_cache_stores_nothing():
+    response_cache = cache.ResponseCache()
+    response_cache.enabled = False
+
+    response_cache.put("all", b"[]", None, response_cache.generation)
+    assert response_cache.get("all") is None
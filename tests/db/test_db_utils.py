@@ -0,0 +1,43 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from web.backend.db import db_utils
+
+
+def test_cursor_round_trip():
+    cursor = db_utils.encode_cursor("почта.рф", "https://почта.рф")
+    assert db_utils.decode_cursor(cursor) == ("почта.рф", "https://почта.рф")
+
+    with pytest.raises(ValueError):
+        db_utils.decode_cursor("not a cursor")
+
+
+def test_url_patterns_match_urls_without_protocol():
+    pattern = db_utils.normalize_url_pattern("HTTPS://*Pochta_RF.ru/")
+    assert pattern == "*pochta_rf.ru"
+    assert db_utils._like_pattern(pattern) == "%pochta\\_rf.ru"
+
+    regex = db_utils._pattern_regex(pattern)
+    assert regex.match("www.pochta_rf.ru")
+    assert regex.match("pochta_rf.ru")
+    assert not regex.match("pochta-rf.ru")
+    assert not regex.match("pochta_rf.ru.evil.com")
+
+
+def test_whitelisting_invalid_ids_is_refused():
+    with pytest.raises(ValueError):
+        asyncio.run(db_utils.whitelist_domains(["not an id"]))
+
+
+def test_whitelist_condition_compiles_for_postgres():
+    condition = db_utils._whitelist_condition(
+        [uuid.uuid4()], ["*pochta_rf.ru"]
+    )
+    sql = str(condition.compile(dialect=postgresql.dialect()))
+
+    assert "LIKE ANY (%(patterns)s)" in sql
+    assert "ESCAPE" not in sql
+    assert db_utils._whitelist_condition([], []) is None
@@ -0,0 +1,78 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+
+from web.backend.db import export
+
+DOMAINS = [
+    {"domain_id": "a" * 32, "url": "http://pochta-rf.ru",
+     "owner_name": "", "last_updated": "01.03.2021",
+     "registrar_name": "ru-center-ru", "abuse_emails": "abuse@nic.ru",
+     "final_url": "https://pochta-rf.ru/"},
+    {"domain_id": "b" * 32, "url": "https://почта-трекер.рф",
+     "owner_name": "ООО \"Ромашка\"", "last_updated": "02.03.2021",
+     "registrar_name": "reg.ru", "abuse_emails": "",
+     "final_url": "https://pochta-rf.ru/"},
+]
+
+
+def fake_domains(monkeypatch, domains):
+    async def iter_dangerous_domains(chunk_size, **filters):
+        for start in range(0, len(domains), chunk_size):
+            yield domains[start:start + chunk_size]
+
+    monkeypatch.setattr(export, "iter_dangerous_domains",
+                        iter_dangerous_domains)
+
+
+def collect(export_format, compress=False):
+    async def run():
+        return b"".join([data async for data in
+                         export.iter_export(export_format, compress)])
+
+    return asyncio.run(run())
+
+
+def test_csv_export(monkeypatch):
+    fake_domains(monkeypatch, DOMAINS)
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 1)
+
+    rows = list(csv.reader(io.StringIO(collect("csv").decode("utf-8"))))
+    assert rows[0] == export.EXPORT_COLUMNS
+    assert rows[2][1:3] == ["https://почта-трекер.рф", "ООО \"Ромашка\""]
+    assert len(rows) == 3
+
+
+def test_empty_csv_export_has_a_header(monkeypatch):
+    fake_domains(monkeypatch, [])
+    assert collect("csv").decode("utf-8").split() == [
+        ",".join(export.EXPORT_COLUMNS)
+    ]
+
+
+def test_gzipped_ndjson_export(monkeypatch):
+    fake_domains(monkeypatch, DOMAINS)
+
+    lines = gzip.decompress(collect("ndjson", compress=True)).splitlines()
+    assert [json.loads(line) for line in lines] == DOMAINS
+
+
+def test_snapshot_replaces_the_file_at_once(monkeypatch, tmp_path):
+    fake_domains(monkeypatch, DOMAINS)
+    path = tmp_path / "dangerous_domains.csv"
+    path.write_text("previous snapshot")
+
+    asyncio.run(export.export_to_csv(str(path)))
+    assert path.read_text(encoding="utf-8").startswith("domain_id,url")
+    assert [item.name for item in tmp_path.iterdir()] == [path.name]
+
+    async def failing_domains(chunk_size, **filters):
+        yield DOMAINS
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(export, "iter_dangerous_domains", failing_domains)
+    asyncio.run(export.export_to_csv(str(path)))
+    assert path.read_text(encoding="utf-8").startswith("domain_id,url")
+    assert [item.name for item in tmp_path.iterdir()] == [path.name]
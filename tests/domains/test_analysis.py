@@ -0,0 +1,71 @@
+import asyncio
+
+from web.backend.domains import analysis, domains_checker
+from web.backend.domains.keyword_matcher import default_matcher
+
+PAGE = ("<html><body><h1>Почта России</h1> "
+        "<p>Отслеживание отправлений</p></body></html>")
+
+
+def test_analyse_page_scores_whole_page():
+    score, terms = analysis.analyse_page(PAGE)
+
+    assert score >= default_matcher.threshold
+    assert set(terms) == {"почта", "россии", "отправлений"}
+    assert analysis.analyse_page("<p>domain for sale</p>") == (0, {})
+
+
+def test_analysis_pool_runs_pages_in_workers():
+    pool = analysis.AnalysisPool(workers=1, queue_size=1)
+
+    async def analyse():
+        return await asyncio.gather(
+            *(pool.run(analysis.analyse_page, PAGE) for _ in range(3))
+        )
+
+    try:
+        results = asyncio.run(analyse())
+    finally:
+        pool.close()
+
+    assert pool.tasks_done == 3
+    assert all(result == analysis.analyse_page(PAGE) for result in results)
+
+
+class InlinePool:
+    """Runs the analysis in the caller's thread, as a pool of workers would"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def run(self, function, *args):
+        self.calls.append(function.__name__)
+        return function(*args)
+
+
+def test_domain_analyses_page_in_pool():
+    from tests.domains.test_domains_checker import FakeSession, PHISHING_PAGE
+
+    pool = InlinePool()
+    index = domains_checker.FingerprintIndex()
+    domain = domains_checker.Domain("http://pochta-rf.ru",
+                                    session=FakeSession(PHISHING_PAGE),
+                                    engine=None, index=index, analysis=pool)
+    asyncio.run(domain._check_if_alive())
+
+    assert pool.calls == ["fingerprint_of", "analyse_page"]
+    assert domain.is_alive and domain.is_dangerous
+    assert domain.content_hash and len(index) == 1
+
+
+def test_domain_without_body_is_not_analysed():
+    from tests.domains.test_domains_checker import FakeSession
+
+    pool = InlinePool()
+    domain = domains_checker.Domain("http://pochta-rf.ru",
+                                    session=FakeSession(b""), engine=None,
+                                    analysis=pool)
+    asyncio.run(domain._check_if_alive())
+
+    assert "analyse_page" not in pool.calls
+    assert domain.is_alive and not domain.is_dangerous
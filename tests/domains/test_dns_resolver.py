@@ -0,0 +1,65 @@
+import asyncio
+import socket
+
+import pytest
+
+from web.backend.domains import dns_resolver
+
+
+class StubLookup:
+    """Local stand-in for a DNS server"""
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.queries = []
+
+    async def __call__(self, host):
+        self.queries.append(host)
+        await asyncio.sleep(0.001)
+        if host not in self.zone:
+            raise dns_resolver.NameNotFoundError(host)
+        if self.zone[host] is None:
+            raise OSError("SERVFAIL")
+        return self.zone[host], 300
+
+
+def test_dns_resolver_caches_answers_and_shares_lookups():
+    lookup = StubLookup({"pochta-ems.ru": ["192.0.2.10"],
+                         "broken.ru": None})
+    resolver = dns_resolver.DnsResolver(lookup=lookup)
+
+    async def resolve_all():
+        return await asyncio.gather(*(
+            resolver.resolve(host)
+            for host in ["pochta-ems.ru", "pochta-ems.ru", "unknown.ru",
+                         "unknown.ru", "broken.ru"]
+        ))
+
+    assert asyncio.run(resolve_all()) == [
+        ["192.0.2.10"], ["192.0.2.10"], [], [], None
+    ]
+    assert sorted(lookup.queries) == [
+        "broken.ru", "pochta-ems.ru", "unknown.ru"
+    ]
+
+    asyncio.run(resolve_all())
+    assert len(lookup.queries) == 3
+
+
+def test_connector_resolver_uses_cached_addresses():
+    lookup = StubLookup({"pochta-ems.ru": ["192.0.2.10", "2001:db8::1"]})
+    resolver = dns_resolver.ConnectorResolver(
+        dns_resolver.DnsResolver(lookup=lookup)
+    )
+
+    hosts = asyncio.run(resolver.resolve("pochta-ems.ru", 443, socket.AF_INET))
+    assert [(host["host"], host["port"]) for host in hosts] == [
+        ("192.0.2.10", 443)
+    ]
+    with pytest.raises(OSError):
+        asyncio.run(resolver.resolve("unknown.ru", 80))
+
+
+def test_network_of():
+    assert dns_resolver.network_of("192.0.2.10") == "192.0.2.0/24"
+    assert dns_resolver.network_of("2001:db8::1") == "2001:db8::/48"
@@ -0,0 +1,550 @@
+import asyncio
+import datetime
+import uuid
+
+from web.backend.domains import domains_checker
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+    def scalar(self):
+        return self.rows[0][1] if self.rows else None
+
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def execute(self, statement):
+        params = statement.compile().params
+        urls = [value for key, value in params.items()
+                if key.startswith("url")]
+        self.engine.statements.append(urls)
+        if self.engine.fail_batches and len(urls) > 1:
+            raise RuntimeError("Batch has failed")
+        return FakeResult([(url, uuid.uuid4()) for url in urls])
+
+
+class FakeEngine:
+    def __init__(self, fail_batches=False):
+        self.statements = []
+        self.fail_batches = fail_batches
+
+    def begin(self):
+        engine = self
+
+        class Transaction:
+            async def __aenter__(self):
+                return FakeConnection(engine)
+
+            async def __aexit__(self, *args):
+                return False
+
+        return Transaction()
+
+
+def make_record(url):
+    return dict(url=url, is_alive=False, is_dangerous=False,
+                last_updated=datetime.datetime.utcnow(), whitelisted=False)
+
+
+async def write_records(engine, urls, **kwargs):
+    writer = domains_checker.ResultWriter(engine, **kwargs)
+    writer.start()
+    futures = [writer.put(make_record(url)) for url in urls]
+    await writer.close()
+    return writer, [future.result() for future in futures]
+
+
+def test_result_writer_flushes_in_batches():
+    engine = FakeEngine()
+    urls = [f"http://site{i}.ru" for i in range(25)]
+    writer, domain_ids = asyncio.run(
+        write_records(engine, urls, batch_size=10, max_latency=1)
+    )
+
+    assert [len(statement) for statement in engine.statements] == [10, 10, 5]
+    assert writer.rows_written == 25
+    assert all(domain_ids)
+
+
+def test_result_writer_deduplicates_urls_within_batch():
+    engine = FakeEngine()
+    writer, domain_ids = asyncio.run(
+        write_records(engine, ["http://a.ru", "http://a.ru"], batch_size=10)
+    )
+
+    assert engine.statements == [["http://a.ru"]]
+    assert domain_ids[0] == domain_ids[1]
+
+
+def test_result_writer_falls_back_to_single_rows():
+    engine = FakeEngine(fail_batches=True)
+    urls = ["http://a.ru", "http://b.ru", "http://c.ru"]
+    writer, domain_ids = asyncio.run(
+        write_records(engine, urls, batch_size=10)
+    )
+
+    assert engine.statements[1:] == [[url] for url in urls]
+    assert writer.rows_written == 3
+    assert all(domain_ids)
+
+
+def test_result_writer_notifies_changes_of_listed_rows(monkeypatch):
+    notified = []
+
+    async def notify_changes(conn):
+        notified.append(conn)
+
+    monkeypatch.setattr(domains_checker, "notify_changes", notify_changes)
+
+    async def write(listed):
+        writer = domains_checker.ResultWriter(FakeEngine(), batch_size=10)
+        writer.start()
+        writer.put(make_record("http://a.ru"))
+        writer.put(make_record("http://b.ru"), listed=listed)
+        await writer.close()
+        return writer
+
+    assert asyncio.run(write(listed=False)).listed_written == 0
+    assert not notified
+    assert asyncio.run(write(listed=True)).listed_written == 1
+    assert len(notified) == 1
+
+
+def test_domain_finds_flag_words_split_between_chunks():
+    domain = domains_checker.Domain("http://a.ru", session=None, engine=None)
+    for chunk in ["Почта Рос", "сии: отслеживание отпр", "авлений"]:
+        domain._check_if_dangerous(chunk)
+    assert not domain.is_dangerous
+
+    domain._check_if_dangerous("", final=True)
+    assert domain.is_dangerous
+    assert set(domain.scorer.terms) == {"почта", "россии", "отправлений"}
+
+
+def make_state(**columns):
+    state = dict(url="http://a.ru", last_updated=None, whitelisted=False,
+                 is_alive=None, is_dangerous=None, next_check=None,
+                 dead_checks=None, registered_at=None, danger_score=None,
+                 matched_terms=None, etag=None, last_modified=None,
+                 content_hash=None, simhash=None, similar_to=None)
+    state.update(columns)
+    return state
+
+
+def test_needs_check_follows_next_check_time():
+    now = datetime.datetime.utcnow()
+    hour = datetime.timedelta(hours=1)
+
+    assert domains_checker.needs_check(None)
+    assert domains_checker.needs_check(make_state(next_check=now))
+    assert domains_checker.needs_check(
+        make_state(last_updated=now - hour, next_check=now - hour)
+    )
+    assert not domains_checker.needs_check(
+        make_state(last_updated=now - hour, next_check=now + hour)
+    )
+    assert not domains_checker.needs_check(
+        make_state(last_updated=now - hour, next_check=now - hour,
+                   whitelisted=True)
+    )
+    # Rows checked before next checks were scheduled
+    assert not domains_checker.needs_check(make_state(last_updated=now))
+    assert domains_checker.needs_check(
+        make_state(last_updated=now - 13 * hour)
+    )
+
+
+def test_dead_domain_is_rescheduled_with_backoff():
+    now = datetime.datetime.utcnow()
+    state = make_state(last_updated=now, is_alive=False, dead_checks=3)
+    writer = domains_checker.ResultWriter(engine=None)
+    writer.put = lambda record, listed=None: record
+
+    domain = domains_checker.Domain("http://a.ru", session=None, engine=None,
+                                    state=state, writer=writer)
+    record = domain._save_record()
+
+    assert record["dead_checks"] == 4
+    assert record["next_check"] - now > datetime.timedelta(days=7)
+    assert not domain._has_come_alive()
+
+    domain.is_alive = True
+    assert domain._has_come_alive()
+    assert domain._save_record()["dead_checks"] == 0
+
+
+class FakeContent:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), size):
+            yield self.body[start:start + size]
+
+
+class FakeResponse:
+    def __init__(self, url, status=200, body=b"", headers=None, history=()):
+        self.url = url
+        self.history = history
+        self.status = status
+        self.headers = headers or {}
+        self.content_type = "text/html"
+        self.charset = "utf-8"
+        self.content = FakeContent(body)
+
+    def raise_for_status(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeSession:
+    """Serves the same page to every url unless the request is conditional.
+    Urls of 'redirects' are redirected to the url they are mapped to."""
+
+    def __init__(self, body, etag=None, redirects=None):
+        self.body = body
+        self.etag = etag
+        self.redirects = redirects or {}
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append((url, headers))
+        history = ()
+        if url in self.redirects:
+            history = (FakeResponse(url, status=302),)
+            url = self.redirects[url]
+        if self.etag and (headers or {}).get("If-None-Match") == self.etag:
+            return FakeResponse(url, status=304, headers={"ETag": self.etag},
+                                history=history)
+        return FakeResponse(url, body=self.body, headers={"ETag": self.etag},
+                            history=history)
+
+
+PHISHING_PAGE = ("<html><body><h1>Почта России</h1><p>Отслеживание "
+                 "отправлений</p>" + "<p>Введите трек-номер</p>" * 20 +
+                 "</body></html>").encode("utf-8")
+
+
+def test_pages_served_by_many_domains_are_analysed_once():
+    index = domains_checker.FingerprintIndex()
+    session = FakeSession(PHISHING_PAGE)
+
+    async def check(url):
+        domain = domains_checker.Domain(url, session=session, engine=None,
+                                        index=index)
+        await domain._check_if_alive()
+        return domain
+
+    first = asyncio.run(check("http://pochta-rf.ru"))
+    second = asyncio.run(check("http://pochta-track.su"))
+
+    assert first.is_dangerous and not first.verdict_reused
+    assert second.is_dangerous and second.verdict_reused
+    assert second.similar_to == "http://pochta-rf.ru"
+    assert second.scorer.score == first.scorer.score
+    assert len(index) == 1
+    # The page's text is released once scored
+    assert first._extractor is None and not first._html
+
+
+def test_unmodified_page_is_not_downloaded_again():
+    session = FakeSession(PHISHING_PAGE, etag='"v1"')
+    first = domains_checker.Domain("http://pochta-rf.ru", session=session,
+                                   engine=None)
+    asyncio.run(first._check_if_alive())
+    state = make_state(
+        last_updated=datetime.datetime.utcnow(), is_alive=True,
+        is_dangerous=first.is_dangerous, danger_score=first.scorer.score,
+        matched_terms=", ".join(first.scorer.terms), etag=first.etag,
+        content_hash=first.content_hash, simhash=first.simhash
+    )
+
+    second = domains_checker.Domain("http://pochta-rf.ru", session=session,
+                                    engine=None, state=state)
+    asyncio.run(second._check_if_alive())
+
+    assert session.requests[1][1] == {"If-None-Match": '"v1"'}
+    assert second.not_modified and second.is_alive and second.is_dangerous
+    assert second.content_hash == first.content_hash
+    assert set(second.scorer.terms) == set(first.scorer.terms)
+
+
+def test_fetch_phases_and_analysis_are_measured():
+    fetch = domains_checker.FETCH_SECONDS
+    responses = fetch.value(phase="response")
+    bodies = fetch.value(phase="body")
+    analyses = domains_checker.ANALYSIS_SECONDS.value()
+
+    domain = domains_checker.Domain("http://pochta-rf.ru",
+                                    session=FakeSession(PHISHING_PAGE),
+                                    engine=None)
+    asyncio.run(domain._check_if_alive())
+
+    assert fetch.value(phase="response") == responses + 1
+    assert fetch.value(phase="body") == bodies + 1
+    assert domains_checker.ANALYSIS_SECONDS.value() == analyses + 1
+    assert domain._outcome() == "dangerous"
+
+
+def test_due_domains_are_claimed_chunk_by_chunk(monkeypatch):
+    now = datetime.datetime.utcnow()
+    due = [make_state(url=f"http://{index}.ru", next_check=now)
+           for index in range(5)]
+    claims = []
+
+    async def claim_due_domains(due_before, limit, run_id=None):
+        claims.append(limit)
+        claimed = due[:limit]
+        del due[:limit]
+        return claimed
+
+    monkeypatch.setattr(domains_checker, "claim_due_domains",
+                        claim_due_domains)
+    # Only as many urls as can be checked in half a lease are claimed
+    monkeypatch.setattr(domains_checker, "SCAN_LEASE_TIME", 0.04)
+
+    async def collect():
+        return [url async for url, _ in
+                domains_checker._iter_due_domains(rate=100)]
+
+    assert asyncio.run(collect()) == [f"http://{index}.ru"
+                                      for index in range(5)]
+    assert claims == [2, 2, 2, 2]
+
+
+def test_database_access_is_bounded_by_slots():
+    active = []
+    peak = []
+
+    async def use_database():
+        active.append(1)
+        peak.append(len(active))
+        await asyncio.sleep(0.01)
+        active.pop()
+
+    async def check_all():
+        db_slots = asyncio.Semaphore(2)
+        domains = [domains_checker.Domain(f"http://pochta-{index}.ru",
+                                          session=None, engine=None,
+                                          db_slots=db_slots)
+                   for index in range(6)]
+        await asyncio.gather(*(domain._use_db(use_database())
+                               for domain in domains))
+
+    asyncio.run(check_all())
+
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+def test_domains_redirecting_to_the_same_page_share_its_download():
+    landing = "https://pochta-track.ru/"
+    session = FakeSession(PHISHING_PAGE, redirects={
+        f"http://pochta-{index}.ru": landing for index in range(3)
+    })
+
+    async def check_all():
+        targets = domains_checker.TargetIndex()
+        domains = [domains_checker.Domain(f"http://pochta-{index}.ru",
+                                          session=session, engine=None,
+                                          targets=targets)
+                   for index in range(3)]
+        await asyncio.gather(*(domain._check_if_alive()
+                               for domain in domains))
+        return domains, targets
+
+    domains, targets = asyncio.run(check_all())
+
+    first, *others = domains
+    assert len(targets) == 1
+    assert all(domain.is_dangerous for domain in domains)
+    assert all(domain.final_url == landing for domain in domains)
+    assert first.redirects == ["http://pochta-0.ru"]
+    assert not first.target_reused
+    assert all(domain.target_reused for domain in others)
+    assert all(domain.similar_to == first.url for domain in others)
+    assert others[0].content_hash == first.content_hash
+
+    writer = domains_checker.ResultWriter(engine=None)
+    writer.put = lambda record, listed=None: record
+    first.writer = writer
+    record = first._save_record()
+    assert record["final_url"] == landing
+    assert record["redirects"] == "http://pochta-0.ru"
+
+
+class FlakySession(FakeSession):
+    """Times out before responding to the first 'failures' requests"""
+
+    def __init__(self, body, failures):
+        super().__init__(body)
+        self.failures = failures
+
+    def request(self, method, url, headers=None, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            self.requests.append((url, headers))
+            raise asyncio.TimeoutError()
+        return super().request(method, url, headers, **kwargs)
+
+
+def test_requests_timing_out_before_responding_are_retried(monkeypatch):
+    monkeypatch.setattr(domains_checker, "SCAN_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(domains_checker, "SCAN_FETCH_RETRIES", 2)
+    limiter = domains_checker.AdaptiveLimiter(window=100)
+
+    alive = domains_checker.Domain("http://pochta-rf.ru",
+                                   session=FlakySession(PHISHING_PAGE, 2),
+                                   engine=None, limiter=limiter)
+    asyncio.run(alive._check_if_alive())
+    assert alive.is_alive and alive.is_dangerous
+    assert len(alive.session.requests) == 3
+    assert limiter._errors == 2 and len(limiter._latencies) == 3
+
+    dead = domains_checker.Domain("http://pochta-rf.ru",
+                                  session=FlakySession(PHISHING_PAGE, 5),
+                                  engine=None)
+    asyncio.run(dead._check_if_alive())
+    assert not dead.is_alive
+    assert len(dead.session.requests) == 3
+
+
+class RangeSession(FakeSession):
+    """Serves the ranges of the page it is asked for"""
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append((method, (headers or {}).get("Range")))
+        first, last = headers["Range"][len("bytes="):].split("-")
+        body = self.body[int(first):int(last) + 1]
+        return FakeResponse(url, status=206, body=body)
+
+
+def test_range_probe_asks_for_the_rest_of_the_page_if_needed():
+    profile = domains_checker.HttpClientProfile(probe_mode="range",
+                                                probe_bytes=1024)
+    filler = b"<p>" + b"lorem ipsum " * 100 + b"</p>"
+    session = RangeSession(filler * 4 + PHISHING_PAGE)
+    domain = domains_checker.Domain("http://pochta-rf.ru", session=session,
+                                    engine=None, profile=profile)
+    asyncio.run(domain._check_if_alive())
+
+    assert domain.is_alive and domain.is_dangerous
+    max_bytes = domains_checker.FETCH_MAX_BYTES
+    assert session.requests == [("GET", "bytes=0-1023"),
+                                ("GET", f"bytes=1024-{max_bytes - 1}")]
+
+    session = RangeSession(PHISHING_PAGE)
+    domain = domains_checker.Domain("http://pochta-rf.ru", session=session,
+                                    engine=None, profile=profile)
+    asyncio.run(domain._check_if_alive())
+
+    assert domain.is_dangerous
+    assert session.requests == [("GET", "bytes=0-1023")]
+
+
+def test_idle_passes_back_off_until_next_check(monkeypatch):
+    overdue = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+    async def get_next_check_time():
+        return overdue
+
+    monkeypatch.setattr(domains_checker, "get_next_check_time",
+                        get_next_check_time)
+    monkeypatch.setattr(domains_checker, "SCAN_IDLE_BACKOFF", 5)
+    monkeypatch.setattr(domains_checker, "SCAN_IDLE_INTERVAL", 300)
+
+    delays = [asyncio.run(domains_checker.seconds_until_next_check(idle))
+              for idle in range(8)]
+    assert delays == [1, 5, 10, 20, 40, 80, 160, 300]
+
+
+def test_overlong_redirect_target_does_not_make_record_unwritable():
+    landing = "https://pochta-track.ru/?" + "a" * 4096
+    session = FakeSession(PHISHING_PAGE,
+                          redirects={"http://pochta-0.ru": landing})
+    domain = domains_checker.Domain("http://pochta-0.ru", session=session,
+                                    engine=None)
+    asyncio.run(domain._check_if_alive())
+    assert domain.final_url == landing and domain.is_dangerous
+
+    writer = domains_checker.ResultWriter(engine=None)
+    writer.put = lambda record, listed=None: record
+    domain.writer = writer
+    record = domain._save_record()
+    assert record["final_url"] is None
+    assert record["redirects"] == "http://pochta-0.ru"
+    assert record["is_dangerous"]
+
+
+def test_overlong_validators_are_ignored():
+    session = FakeSession(PHISHING_PAGE, etag='"' + "v" * 1000 + '"')
+    domain = domains_checker.Domain("http://pochta-rf.ru", session=session,
+                                    engine=None)
+    asyncio.run(domain._check_if_alive())
+
+    assert domain.is_alive and domain.is_dangerous
+    assert domain.etag is None
+
+
+class FailingWhois:
+    async def resolve(self, url):
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+
+def test_verdict_is_saved_when_registration_date_lookup_fails():
+    writer = domains_checker.ResultWriter(engine=None)
+    records = []
+    writer.put = lambda record, listed=None: (
+        records.append(record) or asyncio.sleep(0)
+    )
+    domain = domains_checker.Domain(
+        "http://pochta-rf.ru", session=FakeSession(PHISHING_PAGE),
+        engine=None, writer=writer, whois=FailingWhois()
+    )
+    domain._process_whois = lambda domain_id: asyncio.sleep(0)
+    asyncio.run(domain.process_url())
+
+    assert domain.is_dangerous
+    assert len(records) == 1 and records[0]["is_dangerous"]
+
+
+class HeadRedirectSession(FakeSession):
+    """Redirects HEAD and GET requests of every url to different pages"""
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append((method, url))
+        target = ("https://head.ru/" if method == "HEAD"
+                  else "https://get.ru/")
+        return FakeResponse(target, body=self.body,
+                            history=(FakeResponse(url, status=302),))
+
+
+def test_head_probe_releases_the_target_it_has_claimed():
+    profile = domains_checker.HttpClientProfile(probe_mode="head")
+    session = HeadRedirectSession(PHISHING_PAGE)
+
+    async def check_all():
+        targets = domains_checker.TargetIndex()
+        domains = [domains_checker.Domain(f"http://pochta-{index}.ru",
+                                          session=session, engine=None,
+                                          targets=targets, profile=profile)
+                   for index in range(2)]
+        for domain in domains:
+            await asyncio.wait_for(domain._check_if_alive(), timeout=5)
+        return domains
+
+    domains = asyncio.run(check_all())
+    assert all(domain.is_dangerous for domain in domains)
+    assert all(domain.final_url == "https://get.ru/" for domain in domains)
@@ -0,0 +1,66 @@
+from web.backend.domains import fingerprint
+
+KIT_PAGE = ("<html><head><title>Почта России: отслеживание</title></head>"
+            "<body><form>" + "<p>Введите трек-номер отправления</p>" * 30 +
+            "<p>Получатель: {name}</p></form></body></html>")
+
+
+def make_fingerprint(html, window=fingerprint.FINGERPRINT_WINDOW):
+    content_fingerprint = fingerprint.ContentFingerprint(window)
+    content_fingerprint.feed(html)
+    content_fingerprint.close()
+    return content_fingerprint
+
+
+def test_simhash_of_near_identical_pages_is_close():
+    first = make_fingerprint(KIT_PAGE.format(name="pochta-rf.ru"))
+    second = make_fingerprint(KIT_PAGE.format(name="pochta-track.su"))
+    other = make_fingerprint(
+        "<html><body>Domain is for sale. Buy this domain now!</body></html>"
+    )
+
+    assert first.content_hash != second.content_hash
+    assert fingerprint.hamming_distance(first.simhash, second.simhash) <= 3
+    assert fingerprint.hamming_distance(first.simhash, other.simhash) > 3
+    assert -2 ** 63 <= first.simhash < 2 ** 63
+
+
+def test_fingerprint_holds_chunks_back_until_the_window_is_full():
+    content_fingerprint = fingerprint.ContentFingerprint(window=10)
+    content_fingerprint.feed("<html>")
+    assert not content_fingerprint.is_full
+
+    content_fingerprint.feed("<body>text")
+    assert content_fingerprint.is_full
+    content_fingerprint.close()
+    assert content_fingerprint.is_complete
+    assert content_fingerprint.pop_buffer() == "<html><body>text"
+    assert content_fingerprint.content_hash == make_fingerprint(
+        "<html><bod", window=10
+    ).content_hash
+
+
+def test_empty_page_has_no_fingerprint():
+    content_fingerprint = fingerprint.ContentFingerprint()
+    content_fingerprint.close()
+
+    assert content_fingerprint.is_complete
+    assert content_fingerprint.content_hash is None
+
+
+def test_index_finds_identical_and_near_identical_pages():
+    index = fingerprint.FingerprintIndex()
+    page = make_fingerprint(KIT_PAGE.format(name="pochta-rf.ru"))
+    verdict = fingerprint.Verdict("http://pochta-rf.ru", True, 4.0,
+                                  "почта, россии", page.content_hash,
+                                  page.simhash)
+    index.add(verdict)
+
+    assert index.find(
+        make_fingerprint(KIT_PAGE.format(name="pochta-rf.ru"))
+    ) is verdict
+    assert index.find(
+        make_fingerprint(KIT_PAGE.format(name="pochta-track.su"))
+    ) is verdict
+    assert index.find(make_fingerprint("<p>Domain is for sale</p>")) is None
+    assert len(index) == 1
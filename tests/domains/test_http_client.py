@@ -0,0 +1,18 @@
+from web.backend.domains.http_client import HttpClientProfile
+
+
+def test_ranges_are_asked_for_uncompressed():
+    assert "Accept-Encoding" not in HttpClientProfile().headers()
+    assert HttpClientProfile(compression=False).headers()[
+        "Accept-Encoding"] == "identity"
+    assert HttpClientProfile(probe_mode="range").headers()[
+        "Accept-Encoding"] == "identity"
+
+
+def test_tls_context_is_shared_between_connections():
+    profile = HttpClientProfile(tls_verify=False)
+    context = profile.ssl_context()
+
+    assert context is HttpClientProfile(tls_verify=False).ssl_context()
+    assert not context.check_hostname
+    assert HttpClientProfile(tls_verify=True).ssl_context().check_hostname
@@ -0,0 +1,60 @@
+from web.backend.domains import keyword_matcher
+
+
+def make_matcher():
+    return keyword_matcher.KeywordMatcher(
+        stems={"почт": 1.0, "pocht": 1.0, "посылк": 1.0},
+        words={"ems": 2.0},
+        threshold=3.0
+    )
+
+
+def test_matcher_finds_stems_inside_words():
+    matcher = make_matcher()
+
+    assert list(matcher.find_terms("Почтовый трекер pochta.ru")) == [
+        ("почтовый", 1.0), ("pochta", 1.0)
+    ]
+
+
+def test_matcher_finds_brand_terms_as_whole_words_only():
+    matcher = make_matcher()
+
+    assert list(matcher.find_terms("EMS-доставка")) == [("ems", 2.0)]
+    assert list(matcher.find_terms("systems items")) == []
+
+
+def test_scorer_counts_distinct_terms_with_their_weights():
+    matcher = make_matcher()
+    score, terms = matcher.score("почта почта ПОЧТА посылки")
+    assert score == 2.0
+    assert terms == {"почта": 1.0, "посылки": 1.0}
+
+    score, terms = matcher.score("Отправления EMS, почта")
+    assert score == 3.0
+
+
+def test_scorer_gives_same_result_for_any_chunking():
+    matcher = make_matcher()
+    text = "Отслеживание посылок EMS через почтовый сервис pochta"
+    expected = matcher.score(text)
+
+    for chunk_size in (1, 5, 13):
+        scorer = keyword_matcher.KeywordScorer(matcher)
+        for start in range(0, len(text), chunk_size):
+            scorer.feed(text[start:start + chunk_size])
+        scorer.close()
+        assert (scorer.score, scorer.terms) == expected
+        assert scorer.is_dangerous
+
+
+def test_scorer_holds_back_a_bounded_tail_of_text_without_spaces():
+    matcher = make_matcher()
+    scorer = keyword_matcher.KeywordScorer(matcher)
+    chunk = "x" * 1000
+    for _ in range(1000):
+        scorer.feed(chunk)
+        assert len(scorer._tail) <= keyword_matcher.MAX_WORD_LENGTH
+    scorer.feed("почта" + chunk)
+    scorer.close()
+    assert scorer.score == 1.0
@@ -0,0 +1,42 @@
+import datetime
+
+from web.backend.domains import priorities
+
+NOW = datetime.datetime(2021, 3, 1, 12, 0)
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def test_dangerous_domains_are_checked_more_often_than_alive_ones():
+    assert (priorities.check_interval(True, True, now=NOW) <
+            priorities.check_interval(True, False, now=NOW))
+
+
+def test_dead_domains_back_off_exponentially():
+    intervals = [priorities.check_interval(False, False, dead_checks, now=NOW)
+                 for dead_checks in range(1, 12)]
+
+    assert intervals[:3] == [DAY, 2 * DAY, 4 * DAY]
+    assert intervals == sorted(intervals)
+    assert intervals[-1] == priorities.RECHECK_DEAD_MAX_INTERVAL
+
+
+def test_recently_registered_domains_are_checked_soon():
+    registered_at = NOW - datetime.timedelta(days=3)
+
+    assert priorities.check_interval(
+        False, False, 5, registered_at=registered_at, now=NOW
+    ) == priorities.RECHECK_NEW_DOMAIN_INTERVAL
+    assert priorities.check_interval(
+        False, False, 1, registered_at=datetime.datetime(2010, 1, 1), now=NOW
+    ) == DAY
+
+
+def test_next_check_time_is_jittered_around_the_interval():
+    next_checks = {priorities.next_check_time(True, False, now=NOW)
+                   for _ in range(20)}
+
+    assert len(next_checks) > 1
+    for next_check in next_checks:
+        delay = (next_check - NOW).total_seconds()
+        assert DAY * 0.9 <= delay <= DAY * 1.1
@@ -0,0 +1,70 @@
+import asyncio
+import uuid
+
+from web.backend.domains import scan_runs
+
+
+def test_cursor_only_passes_candidates_saved_in_a_row():
+    progress = scan_runs.ScanProgress(cursor=10, checked=10)
+    positions = [progress.add() for _ in range(4)]
+    assert positions == [10, 11, 12, 13]
+
+    progress.done(11)
+    progress.done(13)
+    assert (progress.cursor, progress.checked) == (10, 12)
+    progress.done(10)
+    assert progress.cursor == 12
+    progress.done(12)
+    assert (progress.cursor, progress.checked) == (14, 14)
+
+
+def test_checks_count_once_their_results_are_saved():
+    run = scan_runs.ScanRun("scanner-0", urls=["http://a.ru", "http://b.ru"])
+
+    async def check():
+        first, second = run.progress.add(), run.progress.add()
+        saved = asyncio.get_event_loop().create_future()
+        run.done(second)
+        run.done(first, saved)
+        assert run.progress.cursor == 0
+        saved.set_result(uuid.uuid4())
+        await asyncio.sleep(0)
+
+    asyncio.run(check())
+    assert run.progress.cursor == 2
+    assert run.remaining_urls() == []
+
+
+def test_cursor_stops_before_failed_checks():
+    run = scan_runs.ScanRun("scanner-0", urls=["http://a.ru", "http://b.ru",
+                                                "http://c.ru"])
+
+    async def check():
+        first, second, third = (run.progress.add() for _ in range(3))
+        unwritten = asyncio.get_event_loop().create_future()
+        run.done(first)
+        run.done(second, unwritten)
+        run.done(third, failed=True)
+        unwritten.set_result(None)
+        await asyncio.sleep(0)
+
+    asyncio.run(check())
+    assert (run.progress.cursor, run.progress.failed) == (1, 2)
+    assert run.remaining_urls() == ["http://b.ru", "http://c.ru"]
+
+
+def test_completions_after_a_failure_are_not_held_in_memory():
+    progress = scan_runs.ScanProgress()
+    positions = [progress.add() for _ in range(10000)]
+    progress.fail(positions[0])
+    for position in positions[1:]:
+        progress.done(position)
+        assert len(progress._done) <= 1
+
+    assert (progress.cursor, progress.checked, progress.failed) == (0, 9999, 1)
+
+
+def test_candidates_hash_depends_on_their_order():
+    urls = ["http://a.ru", "http://b.ru"]
+    assert (scan_runs.hash_candidates(urls) !=
+            scan_runs.hash_candidates(urls[::-1]))
@@ -0,0 +1,128 @@
+import asyncio
+
+from web.backend.domains import scheduler
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+def run_scheduler(items, **kwargs):
+    state = {"active": 0, "max_active": 0, "active_per_host": {},
+             "max_per_host": 0, "handled": []}
+
+    async def handler(item):
+        host = scheduler.host_keys(item)[0]
+        state["active"] += 1
+        state["active_per_host"][host] = (
+            state["active_per_host"].get(host, 0) + 1
+        )
+        state["max_active"] = max(state["max_active"], state["active"])
+        state["max_per_host"] = max(state["max_per_host"],
+                                    state["active_per_host"][host])
+        await asyncio.sleep(0.001)
+        state["active"] -= 1
+        state["active_per_host"][host] -= 1
+        if item.endswith("fail.ru"):
+            raise RuntimeError("Handler has failed")
+        state["handled"].append(item)
+
+    async def run():
+        task_scheduler = scheduler.Scheduler(handler, **kwargs)
+        await task_scheduler.run(iterate(items))
+        return task_scheduler
+
+    return asyncio.run(run()), state
+
+
+def test_scheduler_respects_global_and_per_host_limits():
+    urls = [f"http://site{i % 5}.ru" for i in range(100)]
+    task_scheduler, state = run_scheduler(
+        urls, concurrency=8, per_key_limit=2
+    )
+
+    assert task_scheduler.processed == 100
+    assert sorted(state["handled"]) == sorted(urls)
+    assert state["max_active"] <= 8
+    assert state["max_per_host"] <= 2
+    assert len(task_scheduler.limiter) == 0
+
+
+def test_scheduler_survives_handler_errors():
+    urls = ["http://a.ru", "http://fail.ru", "http://b.ru"]
+    task_scheduler, state = run_scheduler(urls, concurrency=2)
+
+    assert task_scheduler.processed == 3
+    assert task_scheduler.failed == 1
+    assert sorted(state["handled"]) == ["http://a.ru", "http://b.ru"]
+
+
+
+def test_scheduler_does_not_wait_behind_a_saturated_key():
+    urls = ["http://parking.ru"] * 40 + [f"http://site{i}.ru"
+                                         for i in range(20)]
+    finished = []
+
+    async def handler(item):
+        await asyncio.sleep(0.02 if item == "http://parking.ru" else 0.001)
+        finished.append(item)
+
+    async def run():
+        task_scheduler = scheduler.Scheduler(handler, concurrency=8,
+                                             per_key_limit=2)
+        await task_scheduler.run(iterate(urls))
+        return task_scheduler
+
+    task_scheduler = asyncio.run(run())
+
+    assert task_scheduler.processed == 60
+    assert task_scheduler.deferred() == 0
+    assert sorted(finished) == sorted(urls)
+    # The other sites are done before the first parked domains, which are
+    # only checked two at a time
+    assert set(finished[:20]) == set(urls[40:])
+
+def test_adaptive_limiter_bounds_operations_in_flight():
+    limiter = scheduler.AdaptiveLimiter(min_limit=1, max_limit=10,
+                                        initial_limit=3)
+    state = {"active": 0, "max_active": 0}
+
+    async def operation():
+        async with limiter.acquire():
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+            await asyncio.sleep(0.001)
+            state["active"] -= 1
+
+    async def run_all():
+        await asyncio.gather(*(operation() for _ in range(20)))
+
+    asyncio.run(run_all())
+    assert state["max_active"] == 3
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_limiter_grows_additively_and_backs_off():
+    decisions = []
+    limiter = scheduler.AdaptiveLimiter(
+        min_limit=2, max_limit=20, initial_limit=10, window=4,
+        decrease=0.5, target_latency=1, max_error_rate=0.25,
+        on_decision=lambda *args: decisions.append(args[:2])
+    )
+
+    # Healthy requests only grow a limit that has been reached
+    for _ in range(4):
+        limiter.observe(0.1)
+    limiter._saturated = True
+    for _ in range(4):
+        limiter.observe(0.1)
+    # Slow requests, then too many failed ones
+    for _ in range(4):
+        limiter.observe(3)
+    for error in (True, True, False, False):
+        limiter.observe(0.1, error=error)
+
+    assert decisions == [("hold", 10), ("increase", 11), ("decrease", 5),
+                         ("decrease", 2)]
+    assert limiter.decisions["decrease"] == 2
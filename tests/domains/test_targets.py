@@ -0,0 +1,30 @@
+import asyncio
+
+from web.backend.domains.fingerprint import Verdict
+from web.backend.domains.targets import TargetIndex
+
+
+def test_concurrent_claims_wait_for_the_first_verdict():
+    verdict = Verdict("http://pochta-rf.ru", True, 4.0, "почта, россии")
+
+    async def claim_twice():
+        targets = TargetIndex()
+        assert targets.claim("https://landing.ru/") is None
+        waiting = targets.claim("https://landing.ru/")
+        assert not waiting.done()
+        targets.publish("https://landing.ru/", verdict)
+        return await waiting, await targets.claim("https://landing.ru/")
+
+    first, later = asyncio.run(claim_twice())
+    assert first is verdict and later is verdict
+
+
+def test_url_can_be_claimed_again_without_a_verdict():
+    async def fail_then_claim():
+        targets = TargetIndex()
+        targets.claim("https://landing.ru/")
+        waiting = targets.claim("https://landing.ru/")
+        targets.publish("https://landing.ru/", None)
+        return await waiting, targets.claim("https://landing.ru/")
+
+    assert asyncio.run(fail_then_claim()) == (None, None)
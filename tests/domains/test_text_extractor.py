@@ -0,0 +1,52 @@
+from web.backend.domains import text_extractor
+
+
+PAGE = (
+    "<html><head><title>Почта</title>"
+    "<style>body {color: red}</style></head>"
+    "<body><script>var tracking = 'почта';</script>"
+    "<p>Отслеживание &laquo;отправлений&raquo;</p></body></html>"
+)
+
+
+def test_text_extractor_skips_scripts_and_styles():
+    extractor = text_extractor.TextExtractor()
+    text = extractor.feed(PAGE) + extractor.close()
+
+    assert text == "ПочтаОтслеживание «отправлений»"
+
+
+def test_text_extractor_gives_same_text_for_any_chunking():
+    whole_page = text_extractor.TextExtractor()
+    expected = whole_page.feed(PAGE) + whole_page.close()
+
+    for chunk_size in (1, 7, 64):
+        extractor = text_extractor.TextExtractor()
+        text = "".join(
+            extractor.feed(PAGE[start:start + chunk_size])
+            for start in range(0, len(PAGE), chunk_size)
+        )
+        assert text + extractor.close() == expected
+
+
+def test_detect_charset():
+    head = b"<html><head><meta charset='windows-1251'>"
+
+    assert text_extractor.detect_charset("koi8-r", head) == "koi8-r"
+    assert text_extractor.detect_charset(None, head) == "cp1251"
+    assert text_extractor.detect_charset(None, b"<html>") == "utf-8"
+    assert text_extractor.detect_charset("unknown", b"<html>") == "utf-8"
+
+
+def test_extract_text_falls_back_to_html_parser():
+    expected = text_extractor.extract_text(PAGE)
+
+    assert expected == "ПочтаОтслеживание «отправлений»"
+    assert text_extractor.extract_text(PAGE, "unknown") == expected
+
+
+def test_extract_text_of_empty_page():
+    for parser in text_extractor.PARSERS:
+        assert text_extractor.extract_text("", parser) == ""
+        assert text_extractor.extract_text(" \n", parser) == ""
+        assert text_extractor.extract_text("<!-- -->", parser) == ""
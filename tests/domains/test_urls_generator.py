@@ -0,0 +1,73 @@
+import itertools
+
+import pytest
+
+from web.backend.domains import urls_generator
+
+
+def test_generate_candidates_yields_unique_domains_with_both_protocols():
+    candidates = list(urls_generator.generate_candidates(strategies=[]))
+
+    assert candidates[:2] == ["http://почта.рф", "https://почта.рф"]
+    assert len(candidates) == len(set(candidates))
+    domains = {candidate.split("://", 1)[1] for candidate in candidates}
+    assert set(urls_generator.generate_base_domains()) == domains
+    assert "http://pochta-rossii.ru" in candidates
+    assert "https://ems-pochta-track.com" in candidates
+
+
+def test_generate_candidates_is_lazy():
+    candidates = urls_generator.generate_candidates(
+        strategies=list(urls_generator.STRATEGIES)
+    )
+    first = list(itertools.islice(candidates, 4))
+
+    assert first == ["http://почта.рф", "https://почта.рф",
+                     "http://почтатрекер.рф", "https://почтатрекер.рф"]
+
+
+@pytest.mark.parametrize("strategy", sorted(urls_generator.STRATEGIES))
+def test_strategies_yield_valid_variants(strategy):
+    variants = set(urls_generator.STRATEGIES[strategy]("pochta", ".ru"))
+
+    assert variants
+    assert ("pochta", ".ru") not in variants or strategy == "tld_swap"
+    for label, zone in variants:
+        assert label.isascii()
+        assert zone.startswith(".")
+
+
+def test_strategies_examples():
+    def variants(strategy, label="pochta"):
+        return {label for label, _ in
+                urls_generator.STRATEGIES[strategy](label, ".ru")}
+
+    assert {"pocta", "pochhta", "pcohta"} <= variants("typo")
+    assert "pochta" + "-" not in variants("hyphenation")
+    assert "po-chta" in variants("hyphenation")
+    assert "p0chta" in variants("homoglyph")
+    assert "emsrnail" in variants("homoglyph", "emsmail")
+    assert not {"emsrail", "emsnail"} & variants("homoglyph", "emsmail")
+    assert "pichta" in variants("keyboard")
+    assert "qochta" in variants("bitsquat")
+    assert ("pochta", ".online") in set(
+        urls_generator.STRATEGIES["tld_swap"]("pochta", ".ru")
+    )
+
+
+def test_is_valid_label():
+    assert urls_generator.is_valid_label("pochta-rossii")
+    assert urls_generator.is_valid_label("xn--80a1acny")
+    assert not urls_generator.is_valid_label("-pochta")
+    assert not urls_generator.is_valid_label("po--chta")
+    assert not urls_generator.is_valid_label("poch.ta")
+    assert not urls_generator.is_valid_label("")
+
+
+def test_bloom_filter():
+    seen = urls_generator.BloomFilter(capacity=1000, error_rate=0.001)
+
+    assert seen.add("pochta.ru")
+    assert not seen.add("pochta.ru")
+    assert "pochta.ru" in seen
+    assert "pochta.su" not in seen
@@ -1,3 +1,5 @@
+import asyncio
+
 from web.backend.domains import whois_parser
 
 
@@ -24,7 +26,7 @@ def test_prepare_url():
 def test_get_whois_record():
     assert whois_parser.get_whois_record("https://nonexisting.url") == {
         "domain_name": "https://nonexisting.url", "owner_name": "",
-        "registrar_name": "", "abuse_emails": ""
+        "registrar_name": "", "abuse_emails": "", "creation_date": None
     }
     assert whois_parser.get_whois_record("https://почта.рф")["owner_name"] == (
         "JSC Russian Post"
@@ -32,3 +34,84 @@ def test_get_whois_record():
     assert whois_parser.get_whois_record("http://почта.рф")[
                "registrar_name"
            ] == "RUCENTER-RF"
+
+
+def test_registrable_domain():
+    assert whois_parser.registrable_domain("http://почта.рф") == "почта.рф"
+    assert whois_parser.registrable_domain(
+        "https://www.Pochta-EMS.ru:443/track"
+    ) == "pochta-ems.ru"
+
+
+class FakeWhoisServer:
+    """Stand-in for a WHOIS server refusing the first 'throttled' queries"""
+
+    def __init__(self, throttled=0):
+        self.queries = []
+        self.throttled = throttled
+
+    def lookup(self, domain_name):
+        self.queries.append(domain_name)
+        if len(self.queries) <= self.throttled:
+            raise whois_parser.WhoisThrottledError("Query rate exceeded")
+        return {"domain_name": domain_name, "owner_name": "Owner",
+                "registrar_name": "RU-CENTER-RU", "abuse_emails": ""}
+
+
+def make_resolver(server, **kwargs):
+    return whois_parser.WhoisResolver(
+        lookup=server.lookup, min_interval=0, backoff=0.01,
+        persistent=False, **kwargs
+    )
+
+
+def test_whois_resolver_shares_lookups_between_url_variants():
+    server = FakeWhoisServer()
+    resolver = make_resolver(server)
+
+    async def resolve_all():
+        return await asyncio.gather(
+            resolver.resolve("http://pochta-ems.ru"),
+            resolver.resolve("https://pochta-ems.ru"),
+            resolver.resolve("https://www.pochta-ems.ru"),
+        )
+
+    records = asyncio.run(resolve_all())
+    assert server.queries == ["pochta-ems.ru"]
+    assert [record["domain_name"] for record in records] == [
+        "http://pochta-ems.ru", "https://pochta-ems.ru",
+        "https://www.pochta-ems.ru"
+    ]
+    assert all(record["registrar_name"] == "RU-CENTER-RU"
+               for record in records)
+
+    asyncio.run(resolver.resolve("http://pochta-ems.ru"))
+    assert server.queries == ["pochta-ems.ru"]
+
+
+def test_whois_resolver_retries_throttled_lookups():
+    server = FakeWhoisServer(throttled=2)
+    resolver = make_resolver(server, retries=3)
+
+    record = asyncio.run(resolver.resolve("http://pochta-ems.ru"))
+    assert len(server.queries) == 3
+    assert record["owner_name"] == "Owner"
+
+
+def test_whois_resolver_gives_up_after_retries():
+    server = FakeWhoisServer(throttled=10)
+    resolver = make_resolver(server, retries=1)
+
+    record = asyncio.run(resolver.resolve("http://pochta-ems.ru"))
+    assert len(server.queries) == 2
+    assert record["owner_name"] == ""
+
+
+def test_normalize_registrar_name():
+    assert whois_parser.normalize_registrar_name(
+        " Registrar of domain names REG.RU LLC "
+    ) == "regru-ru"
+    assert whois_parser.normalize_registrar_name("RU-CENTER-RF") == (
+        "rucenter-ru"
+    )
+    assert whois_parser.normalize_registrar_name("R01-RU") == "r01-ru"
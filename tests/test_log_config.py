@@ -0,0 +1,35 @@
+import json
+import logging
+
+from web.backend import log_config
+
+
+def test_parse_levels():
+    assert log_config.parse_levels(
+        "backend.domains=DEBUG, sqlalchemy.engine=info,,broken"
+    ) == {"backend.domains": "DEBUG", "sqlalchemy.engine": "INFO"}
+
+
+def test_events_are_written_as_json_by_listener(tmp_path):
+    path = tmp_path / "scan.log"
+    log_config.set_up_logging(
+        str(path), level="INFO", levels="test.quiet=ERROR", log_format="json"
+    )
+    try:
+        logger = logging.getLogger("test.events")
+        log_config.log_event(logger, "domain_checked", url="http://a.ru",
+                             is_dangerous=True)
+        logger.debug("Filtered out %s", "message")
+        logging.getLogger("test.quiet").warning("Filtered out too")
+    finally:
+        log_config.stop_logging()
+        logging.getLogger().handlers.clear()
+
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(entries) == 1
+    assert entries[0]["event"] == "domain_checked"
+    assert entries[0]["url"] == "http://a.ru"
+    assert entries[0]["is_dangerous"] is True
+    assert entries[0]["message"] == (
+        "domain_checked url=http://a.ru is_dangerous=True"
+    )
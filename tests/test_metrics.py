@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from web.backend import metrics
+
+
+def test_registry_renders_prometheus_text():
+    registry = metrics.Registry()
+    checked = metrics.Counter("checked_total", "Checked domains", ["outcome"],
+                              registry=registry)
+    depth = metrics.Gauge("queue_depth", "Queued items", ["queue"],
+                          registry=registry)
+    checked.inc(outcome="dead")
+    checked.inc(2, outcome="alive")
+    depth.set_function(lambda: 7, queue='say "hi"')
+
+    assert registry.render().splitlines() == [
+        "# HELP checked_total Checked domains",
+        "# TYPE checked_total counter",
+        'checked_total{outcome="alive"} 2',
+        'checked_total{outcome="dead"} 1',
+        "# HELP queue_depth Queued items",
+        "# TYPE queue_depth gauge",
+        'queue_depth{queue="say \\"hi\\""} 7',
+    ]
+
+
+def test_histogram_counts_values_in_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = metrics.Histogram("latency_seconds", "Latency",
+                                buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_measure_timing_wraps_functions_and_coroutines():
+    registry = metrics.Registry()
+    runtime = metrics.Histogram("runtime_seconds", "Runtime", ["function"],
+                                registry=registry)
+
+    @metrics.measure_timing(runtime, function="add")
+    def add(first, second):
+        return first + second
+
+    @metrics.measure_timing(runtime, function="wait")
+    async def wait():
+        await asyncio.sleep(0)
+        return "done"
+
+    assert add(1, 2) == 3
+    assert asyncio.run(wait()) == "done"
+    assert runtime.value(function="add") == 1
+    assert runtime.value(function="wait") == 1
+
+
+def test_histogram_quantile_interpolates_within_buckets():
+    registry = metrics.Registry()
+    latency = metrics.Histogram("latency_seconds", "Latency",
+                                buckets=(0.1, 1), registry=registry)
+    assert latency.quantile(0.5) is None
+
+    for value in (0.05, 0.05, 0.5, 0.5):
+        latency.observe(value)
+
+    assert latency.quantile(0.5) == 0.1
+    assert latency.quantile(0.75) == pytest.approx(0.55)
+    latency.observe(3)
+    assert latency.quantile(1) == 1
+
+
+def test_counter_totals_its_labelled_values():
+    registry = metrics.Registry()
+    checked = metrics.Counter("checked_total", "Checked domains", ["outcome"],
+                              registry=registry)
+    checked.inc(outcome="dead")
+    checked.inc(2, outcome="alive")
+
+    assert checked.values() == {("dead",): 1, ("alive",): 2}
+    assert checked.total() == 3
@@ -0,0 +1,120 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+from typing import Hashable, NamedTuple, Optional
+
+import asyncpg
+from sqlalchemy import func, select
+
+from .model import async_engine
+
+logger = logging.getLogger(__name__)
+
+# Max number of distinct responses (one per combination of query
+# parameters) kept by the API's response cache
+API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", 256))
+
+# Postgres channel the processes changing the list of dangerous domains
+# (e.g. scanners) notify the API processes on, and number of seconds between
+# attempts to listen to it again after the connection has been lost
+CHANGES_CHANNEL = "dangerous_domains_changed"
+CHANGES_RETRY_INTERVAL = float(os.getenv("CHANGES_RETRY_INTERVAL", 5))
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    next_cursor: Optional[str]
+
+
+class ResponseCache:
+    """In-process cache of serialized API responses.
+
+    It is emptied whenever the data behind the responses changes, so a
+    response computed while the data was changing is only stored if no
+    invalidation has happened since its computation started: callers read
+    'generation' before querying the database and pass it to 'put'.
+    While it is not 'enabled' (changes might be missed) nothing is stored.
+    """
+
+    def __init__(self, max_size: int = API_CACHE_SIZE):
+        self.max_size = max_size
+        self.enabled = True
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._responses = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        response = self._responses.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._responses.move_to_end(key)
+        return response
+
+    def put(self, key: Hashable, body: bytes, next_cursor: Optional[str],
+            generation: int) -> CachedResponse:
+        response = CachedResponse(
+            body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+            next_cursor
+        )
+        if self.enabled and generation == self.generation:
+            self._responses[key] = response
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+        return response
+
+    def invalidate(self):
+        self.generation += 1
+        self._responses.clear()
+
+
+response_cache = ResponseCache()
+
+
+async def notify_changes(conn):
+    """Tell the API processes the list of dangerous domains has changed once
+    the transaction of 'conn' commits"""
+    await conn.execute(select(func.pg_notify(CHANGES_CHANNEL, "")))
+
+
+async def listen_for_changes(cache: ResponseCache = response_cache):
+    """Invalidate the cache whenever another process notifies a change.
+    The cache is disabled while the notifications can't be received."""
+
+    dsn = async_engine.url.set(drivername="postgresql").render_as_string(
+        hide_password=False
+    )
+    while True:
+        cache.enabled = False
+        cache.invalidate()
+        try:
+            connection = await asyncpg.connect(dsn)
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error("Failed to listen for changes: %s", e)
+            await asyncio.sleep(CHANGES_RETRY_INTERVAL)
+            continue
+
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        try:
+            await connection.add_listener(
+                CHANGES_CHANNEL, lambda *args: cache.invalidate()
+            )
+            cache.enabled = True
+            await closed.wait()
+            logger.error("Connection listening for changes has been lost")
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error("Failed to listen for changes: %s", e)
+        finally:
+            cache.enabled = False
+            await connection.close()
+        await asyncio.sleep(CHANGES_RETRY_INTERVAL)
@@ -1,15 +1,46 @@
+import base64
+import datetime
+import itertools
+import json
 import logging
-import csv
+import os
+import re
+import uuid
+from typing import AsyncIterator, Iterable, Optional, Tuple
 
-from sqlalchemy import select, update, delete
+from sqlalchemy import (Text, any_, bindparam, cast, select, update, delete,
+                        func, or_, tuple_)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert
 from sqlalchemy.exc import SQLAlchemyError
 
-from .model import async_engine, all_domains, dangerous_domains, registrars
-from ..domains.whois_parser import prepare_url
+from .cache import notify_changes, response_cache
+from .model import (async_engine, all_domains, dangerous_domains, registrars,
+                    scan_runs, url_sort_key)
 
 
 logger = logging.getLogger(__name__)
 
+# Max number of urls passed to a single 'IN' clause when loading domains' state
+STATE_CHUNK_SIZE = 1000
+
+# Columns of 'all_domains' deciding whether and when a url is checked
+STATE_COLUMNS = [all_domains.c.url, all_domains.c.last_updated,
+                 all_domains.c.whitelisted, all_domains.c.is_alive,
+                 all_domains.c.is_dangerous, all_domains.c.next_check,
+                 all_domains.c.dead_checks, all_domains.c.registered_at,
+                 all_domains.c.danger_score, all_domains.c.matched_terms,
+                 all_domains.c.etag, all_domains.c.last_modified,
+                 all_domains.c.content_hash, all_domains.c.simhash,
+                 all_domains.c.similar_to]
+
+# Rows checked before next checks were scheduled fall due when the former
+# fixed freshness window ends
+LEGACY_FRESHNESS_WINDOW = datetime.timedelta(seconds=43200)
+
+# Number of seconds a scanner process has to check the domains it has
+# claimed before other processes may claim them
+SCAN_LEASE_TIME = float(os.getenv("SCAN_LEASE_TIME", 900))
+
 
 async def get_url_by_id(domain_id):
     select_stmt = (
@@ -26,19 +57,281 @@ async def get_url_by_id(domain_id):
                 return url
 
     except (SQLAlchemyError, Exception) as e:
-        logger.error(
-            f"SQLAlchemy error while selecting dangerous domains: {e}"
-        )
+        logger.error("SQLAlchemy error while selecting dangerous domains: %s",
+                     e)
+
+
+async def get_domains_state(urls: Iterable[str]) -> dict:
+    """Load the stored state of the given urls in one transaction.
+
+    :return: a dict mapping every url that is already present in
+    'all_domains' to its row with the STATE_COLUMNS
+    """
+    urls = list(urls)
+    states = {}
+
+    try:
+        async with async_engine.begin() as conn:
+            for start in range(0, len(urls), STATE_CHUNK_SIZE):
+                select_stmt = (
+                    select(*STATE_COLUMNS).
+                    where(all_domains.c.url.in_(
+                        urls[start:start + STATE_CHUNK_SIZE]
+                    ))
+                )
+                result = await conn.execute(select_stmt)
+                for row in result.fetchall():
+                    states[row["url"]] = row
+                result.close()
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while selecting domains' state: %s", e)
+
+    return states
+
+
+async def add_candidates(urls: Iterable[str]) -> int:
+    """Add the urls that are not in 'all_domains' yet as due right away and
+    schedule the rows checked before next checks were introduced
+
+    :return: the number of added urls
+    """
+    urls = iter(urls)
+    now = datetime.datetime.utcnow()
+    added = 0
+
+    try:
+        async with async_engine.begin() as conn:
+            while True:
+                chunk = list(itertools.islice(urls, STATE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                insert_stmt = (
+                    insert(all_domains).
+                    values([dict(url=url, whitelisted=False, next_check=now)
+                            for url in chunk]).
+                    on_conflict_do_nothing(index_elements=["url"])
+                )
+                result = await conn.execute(insert_stmt)
+                added += max(result.rowcount, 0)
+
+            await conn.execute(
+                update(all_domains).
+                where(all_domains.c.next_check.is_(None)).
+                values(next_check=func.coalesce(
+                    all_domains.c.last_updated + LEGACY_FRESHNESS_WINDOW, now
+                ))
+            )
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while adding candidates: %s", e)
+
+    return added
+
+
+async def claim_due_domains(due_before: datetime.datetime,
+                            limit: int = STATE_CHUNK_SIZE,
+                            lease_time: float = SCAN_LEASE_TIME,
+                            run_id: Optional[uuid.UUID] = None) -> list:
+    """Claim domains due to be checked for 'lease_time' seconds, the most
+    overdue first, on behalf of the scan run 'run_id'. Whitelisted domains
+    are never due.
+
+    Rows locked or claimed by other scanner processes are skipped, so that
+    processes sharing the database never check the same domain at the same
+    time. A claim ends when the domain's check result is written or when
+    the lease runs out (e.g. the process has died).
+
+    :return: claimed rows with the STATE_COLUMNS
+    """
+    now = datetime.datetime.utcnow()
+    due_ids = (
+        select(all_domains.c.domain_id).
+        where(all_domains.c.next_check <= due_before).
+        where(all_domains.c.whitelisted.isnot(True)).
+        where(or_(all_domains.c.lease_until.is_(None),
+                  all_domains.c.lease_until < now)).
+        order_by(all_domains.c.next_check, all_domains.c.url).
+        limit(limit).
+        with_for_update(skip_locked=True)
+    )
+    update_stmt = (
+        update(all_domains).
+        where(all_domains.c.domain_id.in_(due_ids)).
+        values(lease_until=now + datetime.timedelta(seconds=lease_time),
+               lease_run_id=run_id).
+        returning(*STATE_COLUMNS)
+    )
+
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(update_stmt)
+            rows = result.fetchall()
+            result.close()
+            return sorted(rows, key=lambda row: (row["next_check"],
+                                                 row["url"]))
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while claiming due domains: %s", e)
+        return []
+
+
+async def get_next_check_time() -> Optional[datetime.datetime]:
+    """Time the next domain is due to be checked or None if none is.
+    A domain leased by a scanner can't be claimed before its lease runs out,
+    whatever its next check time."""
+
+    select_stmt = (
+        select(func.min(func.greatest(
+            all_domains.c.next_check,
+            func.coalesce(all_domains.c.lease_until, all_domains.c.next_check)
+        ))).
+        where(all_domains.c.whitelisted.isnot(True))
+    )
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(select_stmt)
+            return result.scalar()
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while selecting next check: %s", e)
+
+
+async def start_scan_run(scanner: str, candidates_hash: Optional[str],
+                         due_before: Optional[datetime.datetime]
+                         ) -> Optional[uuid.UUID]:
+    """Record the start of a scan
+
+    :return: the run's id or None if it could not be recorded
+    """
+    now = datetime.datetime.utcnow()
+    insert_stmt = (
+        insert(scan_runs).
+        values(scanner=scanner, candidates_hash=candidates_hash,
+               due_before=due_before, started_at=now, checkpoint_at=now,
+               cursor=0, checked=0).
+        returning(scan_runs.c.run_id)
+    )
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(insert_stmt)
+            return result.scalar()
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while starting a scan run: %s", e)
+
+
+async def find_interrupted_scan_run(scanner: str,
+                                    candidates_hash: Optional[str]):
+    """Latest unfinished run of the scanner over the same candidates (a
+    pass over the due domains if 'candidates_hash' is None)
+
+    :return: the run's row or None
+    """
+    select_stmt = (
+        select(scan_runs).
+        where(scan_runs.c.scanner == scanner).
+        where(scan_runs.c.finished_at.is_(None)).
+        order_by(scan_runs.c.started_at.desc()).
+        limit(1)
+    )
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(select_stmt)
+            row = result.fetchone()
+            result.close()
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while selecting scan runs: %s", e)
+        return None
+
+    if row is None or row["candidates_hash"] != candidates_hash:
+        return None
+    return row
 
 
-async def get_dangerous_domains():
-    select_dangerous_domains_stmt = (
-        select(all_domains.c.domain_id,
+async def resume_scan_run(run_id: uuid.UUID) -> int:
+    """Release the domains still claimed by an interrupted run, so that
+    they are checked again without waiting for their leases to run out
+
+    :return: the number of released domains
+    """
+    update_stmt = (
+        update(all_domains).
+        where(all_domains.c.lease_run_id == run_id).
+        where(all_domains.c.lease_until.isnot(None)).
+        values(lease_until=None, lease_run_id=None)
+    )
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(update_stmt)
+            return max(result.rowcount, 0)
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while resuming a scan run: %s", e)
+        return 0
+
+
+async def checkpoint_scan_run(run_id: uuid.UUID, cursor: int, checked: int,
+                              finished: bool = False):
+    """Save the progress of a scan run and, if 'finished', its end"""
+
+    now = datetime.datetime.utcnow()
+    values = dict(cursor=cursor, checked=checked, checkpoint_at=now)
+    if finished:
+        values["finished_at"] = now
+    update_stmt = (
+        update(scan_runs).
+        where(scan_runs.c.run_id == run_id).
+        values(**values)
+    )
+    try:
+        async with async_engine.begin() as conn:
+            await conn.execute(update_stmt)
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while saving a checkpoint: %s", e)
+
+
+def encode_cursor(sort_key: str, url: str) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([sort_key, url]).encode("utf-8")
+    ).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """:raise ValueError if the cursor has not been made by 'encode_cursor'"""
+    try:
+        sort_key, url = json.loads(base64.urlsafe_b64decode(cursor))
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    return str(sort_key), str(url)
+
+
+def select_dangerous_domains(registrar: Optional[str] = None,
+                             owner: Optional[str] = None,
+                             updated_since: Optional[datetime.date] = None,
+                             target: Optional[str] = None):
+    """Statement selecting dangerous domains ready to be sent to users,
+    ordered by their urls without the protocol ('sort_key')
+
+    :param registrar: only domains registered with this registrar
+    :param owner: only domains whose owner's name contains this string
+    :param updated_since: only domains updated on this day or later
+    :param target: only domains whose requests end up at this url, i.e.
+    the cluster of domains redirecting to the same landing page
+    """
+    select_stmt = (
+        select(func.replace(cast(all_domains.c.domain_id, Text), "-", "").
+               label("domain_id"),
                all_domains.c.url,
                dangerous_domains.c.owner_name,
-               dangerous_domains.c.last_updated,
+               func.to_char(dangerous_domains.c.last_updated, "DD.MM.YYYY").
+               label("last_updated"),
                registrars.c.registrar_name,
-               registrars.c.abuse_emails).
+               registrars.c.abuse_emails,
+               all_domains.c.final_url,
+               url_sort_key.label("sort_key")).
         select_from(
             all_domains.
             join(dangerous_domains,
@@ -46,72 +339,211 @@ async def get_dangerous_domains():
             join(registrars,
                  dangerous_domains.c.registrar_id ==
                  registrars.c.registrar_id)
-        )
+        ).
+        order_by(url_sort_key, all_domains.c.url)
     )
+    if registrar:
+        select_stmt = select_stmt.where(
+            registrars.c.registrar_name == registrar.lower().strip()
+        )
+    if owner:
+        select_stmt = select_stmt.where(
+            func.lower(dangerous_domains.c.owner_name).contains(
+                owner.lower(), autoescape=True
+            )
+        )
+    if updated_since:
+        select_stmt = select_stmt.where(
+            dangerous_domains.c.last_updated >= updated_since
+        )
+    if target:
+        select_stmt = select_stmt.where(all_domains.c.final_url == target)
+    return select_stmt
+
+
+async def get_dangerous_domains_page(
+        limit: Optional[int] = None, cursor: Optional[str] = None,
+        **filters
+) -> Optional[Tuple[list, Optional[str]]]:
+    """Select dangerous domains ready to be sent by the API
+
+    Pages are selected with keyset pagination: 'cursor' is the 'next_cursor'
+    returned with the previous page, so that a page costs the same however
+    far it is in the list.
+    **filters are passed to 'select_dangerous_domains()'
+
+    :return: the page's domains and the cursor of the next page (None if it
+    is the last one), or None if the domains could not be selected
+    """
+    select_stmt = select_dangerous_domains(**filters)
+    if cursor:
+        select_stmt = select_stmt.where(
+            tuple_(url_sort_key, all_domains.c.url) >
+            tuple_(*decode_cursor(cursor))
+        )
+    if limit:
+        # One more row tells whether there is a next page
+        select_stmt = select_stmt.limit(limit + 1)
+
     try:
         async with async_engine.begin() as conn:
-            result = await conn.execute(select_dangerous_domains_stmt)
+            result = await conn.execute(select_stmt)
             rows = result.fetchall()
             result.close()
-            rows = list(sorted(rows, key=lambda row: prepare_url(row["url"])))
-            logger.debug(rows)
-            return rows
-
     except (SQLAlchemyError, Exception) as e:
-        logger.error(
-            f"SQLAlchemy error while selecting dangerous domains: {e}"
-        )
+        logger.error("SQLAlchemy error while selecting dangerous domains: %s",
+                     e)
+        return None
+
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["sort_key"], rows[-1]["url"])
+
+    domains = []
+    for row in rows:
+        domain = dict(row)
+        del domain["sort_key"]
+        domains.append(domain)
+    return domains, next_cursor
 
 
 async def get_dangerous_domains_list() -> list:
-    rows = await get_dangerous_domains()
-    logger.debug(f"There is a result: {rows}")
-    dangerous_domains_list = []
-    if rows:
-        for domain in rows:
-            domain = dict(domain)
-            domain["last_updated"] = domain["last_updated"].strftime("%d.%m.%Y")
-            domain["domain_id"] = domain["domain_id"].hex
-            dangerous_domains_list.append(domain)
-    return dangerous_domains_list
+    page = await get_dangerous_domains_page()
+    return page[0] if page else []
 
 
-async def export_to_csv() -> None:
-    path_to_csv_dir = "/usr/src/app/frontend/assets/csv/"
-    csv_name = "dangerous_domains.csv"
+async def iter_dangerous_domains(chunk_size: int = STATE_CHUNK_SIZE,
+                                 **filters) -> AsyncIterator[list]:
+    """Stream dangerous domains through a server-side cursor, 'chunk_size'
+    of them at a time, so that memory does not grow with their number
+    **filters are passed to 'select_dangerous_domains()'
 
-    with open(f"{path_to_csv_dir + csv_name}", "w") as csv_file:
-        rows = await get_dangerous_domains()
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(dict(rows[0]).keys())
-        csv_writer.writerows(rows)
-        logger.info("Data has been successfully exported to a CSV file")
+    :return: lists of domains as dicts (without 'sort_key')
+    """
+    select_stmt = select_dangerous_domains(**filters)
+    async with async_engine.begin() as conn:
+        result = await conn.stream(select_stmt)
+        async for rows in result.partitions(chunk_size):
+            domains = []
+            for row in rows:
+                domain = dict(row)
+                del domain["sort_key"]
+                domains.append(domain)
+            yield domains
 
 
-async def whitelist_url(url: str):
-    upd_stmt = (
+def normalize_url_pattern(pattern: str) -> str:
+    """Pattern matched against urls without their protocol, in lower case
+    and without a trailing slash"""
+    return re.sub(r"^https?://", "", pattern.strip().lower()).rstrip("/")
+
+
+def _pattern_regex(pattern: str):
+    return re.compile(".*".join(map(re.escape, pattern.split("*"))) + r"\Z")
+
+
+def _like_pattern(pattern: str) -> str:
+    escaped = (pattern.replace("\\", "\\\\").replace("%", "\\%").
+               replace("_", "\\_"))
+    return escaped.replace("*", "%")
+
+
+async def _whitelist(conn, condition) -> list:
+    """Whitelist the domains matching the condition with one UPDATE and
+    remove them from 'dangerous_domains' with one DELETE
+
+    :return: (domain_id, url) rows of the whitelisted domains
+    """
+    result = await conn.execute(
         update(all_domains).
-        where(all_domains.c.url == url).
-        values(is_dangerous=False, whitelisted=True)
+        where(condition).
+        values(is_dangerous=False, whitelisted=True).
+        returning(all_domains.c.domain_id, all_domains.c.url)
     )
+    rows = result.fetchall()
+    if rows:
+        await conn.execute(
+            delete(dangerous_domains).
+            where(dangerous_domains.c.domain_id == any_(bindparam(
+                "domain_ids", [row["domain_id"] for row in rows],
+                type_=ARRAY(UUID(as_uuid=True))
+            )))
+        )
+        await notify_changes(conn)
+    return rows
 
-    select_stmt = (
-        select(all_domains.c.domain_id).
-        where(all_domains.c.url == url)
-    )
 
+async def whitelist_url(url: str):
     try:
         async with async_engine.begin() as conn:
-            await conn.execute(upd_stmt)
-            result = await conn.execute(select_stmt)
-            domain_id = result.fetchone()
-            result.close()
-            if domain_id:
-                domain_id = domain_id[0]
-                await conn.execute(
-                    delete(dangerous_domains).
-                    where(dangerous_domains.c.domain_id == domain_id)
-                )
+            await _whitelist(conn, all_domains.c.url == url)
+        response_cache.invalidate()
 
     except (SQLAlchemyError, Exception) as e:
-        logger.error(f"Unexpected error occurred: {e}")
+        logger.error("Unexpected error occurred: %s", e)
+
+
+def _whitelist_condition(domain_ids: list, patterns: list):
+    """Condition matching the domains with the ids or urls matching the
+    patterns, None if there are neither. Patterns are matched with
+    'LIKE ANY', which takes no ESCAPE clause: their special characters are
+    escaped with a backslash, postgres' default escape character."""
+
+    conditions = []
+    if domain_ids:
+        conditions.append(all_domains.c.domain_id == any_(bindparam(
+            "ids", domain_ids, type_=ARRAY(UUID(as_uuid=True))
+        )))
+    if patterns:
+        conditions.append(url_sort_key.like(any_(bindparam(
+            "patterns", [_like_pattern(normalize_url_pattern(pattern))
+                         for pattern in patterns],
+            type_=ARRAY(Text)
+        ))))
+    return or_(*conditions) if conditions else None
+
+
+async def whitelist_domains(domain_ids: Iterable[str] = (),
+                            patterns: Iterable[str] = ()) -> Optional[list]:
+    """Whitelist domains by their ids and by patterns of their urls in a
+    single transaction: either all of them are whitelisted or none is.
+
+    Patterns are matched against urls without the protocol ('sort_key'),
+    '*' standing for any characters, labels included: '*pochta-rf.ru'
+    matches pochta-rf.ru and its subdomains but also xpochta-rf.ru, while
+    '*.pochta-rf.ru' only matches the subdomains.
+
+    :raise ValueError if an id is not a valid uuid
+    :return: the result of every item in the order they have been given: a
+    dict with its 'id' or 'pattern' and the 'urls' it has whitelisted
+    (none if nothing matched), or None if the transaction has failed
+    """
+    domain_ids = [(domain_id, uuid.UUID(str(domain_id)))
+                  for domain_id in domain_ids]
+    patterns = list(patterns)
+    condition = _whitelist_condition([value for _, value in domain_ids],
+                                     patterns)
+    if condition is None:
+        return []
+
+    try:
+        async with async_engine.begin() as conn:
+            rows = await _whitelist(conn, condition)
+        response_cache.invalidate()
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("SQLAlchemy error while whitelisting domains: %s", e)
+        return None
+
+    urls_by_id = {row["domain_id"]: row["url"] for row in rows}
+    results = [dict(id=domain_id, urls=[urls_by_id[value]]
+                    if value in urls_by_id else [])
+               for domain_id, value in domain_ids]
+    for pattern in patterns:
+        regex = _pattern_regex(normalize_url_pattern(pattern))
+        results.append(dict(pattern=pattern, urls=sorted(
+            row["url"] for row in rows
+            if regex.match(re.sub(r"^https?://", "", row["url"]))
+        )))
+    return results
@@ -0,0 +1,109 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+import zlib
+from typing import AsyncIterator, List
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .db_utils import iter_dangerous_domains
+
+logger = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ["domain_id", "url", "owner_name", "last_updated",
+                  "registrar_name", "abuse_emails", "final_url"]
+# CSV snapshot of the dangerous domains served by nginx as a static asset
+EXPORT_CSV_PATH = os.getenv(
+    "EXPORT_CSV_PATH", "/usr/src/app/frontend/assets/csv/dangerous_domains.csv"
+)
+# Number of rows fetched from the database and encoded at a time
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+
+def encode_csv(domains: List[dict]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [domain[column] for column in EXPORT_COLUMNS] for domain in domains
+    )
+    return buffer.getvalue().encode("utf-8")
+
+
+def encode_ndjson(domains: List[dict]) -> bytes:
+    return "".join(
+        json.dumps(domain, ensure_ascii=False) + "\n" for domain in domains
+    ).encode("utf-8")
+
+
+# Format name -> (content type, file header, rows encoder)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", encode_csv([dict(zip(EXPORT_COLUMNS,
+                                             EXPORT_COLUMNS))]),
+            encode_csv),
+    "ndjson": ("application/x-ndjson", b"", encode_ndjson),
+}
+
+
+async def iter_export(export_format: str = "csv", compress: bool = False,
+                      **filters) -> AsyncIterator[bytes]:
+    """Yield the dangerous domains encoded in one of the EXPORT_FORMATS
+    chunk by chunk, gzipped if 'compress'
+    **filters are passed to 'select_dangerous_domains()'
+    """
+    _, header, encode = EXPORT_FORMATS[export_format]
+    # wbits=31 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def output(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor else data
+
+    if header:
+        yield output(header)
+    async for domains in iter_dangerous_domains(EXPORT_CHUNK_SIZE, **filters):
+        data = output(encode(domains))
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def _sync_to_disk(fp):
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+async def export_to_csv(path: str = EXPORT_CSV_PATH) -> None:
+    """Write the CSV snapshot of the dangerous domains.
+
+    The file is written next to the snapshot and renamed over it once it is
+    complete, so that nginx never serves a half-written file. Disk writes
+    run in the loop's executor.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".export-", suffix=".csv"
+        )
+    except OSError as e:
+        logger.error("Failed to export data to %s: %s", path, e)
+        return
+
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            async for data in iter_export("csv"):
+                await loop.run_in_executor(None, fp.write, data)
+            await loop.run_in_executor(None, _sync_to_disk, fp)
+        # mkstemp creates files readable by their owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+        logger.info("Data has been successfully exported to a CSV file")
+
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("Failed to export data to %s: %s", path, e)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
@@ -0,0 +1,75 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Tuple
+
+from .keyword_matcher import default_matcher
+from .text_extractor import extract_text
+
+# Number of processes pages are analysed in. With 0 pages are analysed in
+# the event loop's thread while they are downloaded
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", 0))
+# Max number of pages waiting for a worker (twice the number of workers by
+# default). Fetching a page's successor waits once that many are queued
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", 0))
+# Parser extracting the text of pages analysed by workers: 'html.parser',
+# 'lxml' or 'selectolax' (if installed)
+ANALYSIS_PARSER = os.getenv("ANALYSIS_PARSER", "html.parser")
+
+
+def analyse_page(html: str, parser: str = ANALYSIS_PARSER
+                 ) -> Tuple[float, Dict[str, float]]:
+    """Extract the text of a whole page and score it
+
+    :return: the page's score and the matched words with their weights
+    """
+    return default_matcher.score(extract_text(html, parser))
+
+
+class AnalysisPool:
+    """Run CPU-bound analysis of pages in worker processes, so that the
+    event loop keeps serving connections while pages are parsed.
+
+    At most 'queue_size' calls wait for a worker at a time, further callers
+    wait for a place in the queue: the fetching side can't get ahead of the
+    analysing one by more than that many pages.
+    """
+
+    def __init__(self, workers: int = ANALYSIS_WORKERS,
+                 queue_size: int = ANALYSIS_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size or workers * 2
+        self.tasks_done = 0
+        self._waiting = 0
+        self._semaphore = None
+        # Workers are spawned rather than forked: the scanner runs threads
+        # (logging, WHOIS lookups) that forked children would inherit locked
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def queued(self) -> int:
+        """Number of calls waiting for a place in the queue or a worker"""
+        return self._waiting
+
+    async def run(self, function: Callable, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.queue_size)
+        self._waiting += 1
+        try:
+            async with self._semaphore:
+                result = await asyncio.get_event_loop().run_in_executor(
+                    self._executor, function, *args
+                )
+        finally:
+            self._waiting -= 1
+        self.tasks_done += 1
+        return result
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,178 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import time
+from typing import List, Optional, Tuple
+
+from aiohttp.abc import AbstractResolver
+
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+logger = logging.getLogger(__name__)
+
+# Number of names resolved at the same time and number of seconds an answer
+# is cached for when the DNS server has not told its TTL. Unregistered names
+# rarely get registered overnight, so they are cached for longer
+DNS_CONCURRENCY = int(os.getenv("DNS_CONCURRENCY", 100))
+DNS_POSITIVE_TTL = float(os.getenv("DNS_POSITIVE_TTL", 3600))
+DNS_NEGATIVE_TTL = float(os.getenv("DNS_NEGATIVE_TTL", 6 * 3600))
+# Answers for names that could not be resolved for other reasons (timeouts,
+# SERVFAIL) are only kept for a short while
+DNS_FAILURE_TTL = float(os.getenv("DNS_FAILURE_TTL", 60))
+
+NOT_FOUND_ERRNOS = {
+    getattr(socket, name) for name in ("EAI_NONAME", "EAI_NODATA")
+    if hasattr(socket, name)
+}
+
+
+class NameNotFoundError(Exception):
+    """Name is not registered or has no address records"""
+
+
+async def getaddrinfo_lookup(host: str) -> Tuple[List[str], Optional[float]]:
+    """Resolve the host with the system resolver in the loop's executor
+
+    :return: the host's addresses and None as the TTL is unknown
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        infos = await loop.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        if e.errno in NOT_FOUND_ERRNOS:
+            raise NameNotFoundError(host) from e
+        raise
+    return sorted({info[4][0] for info in infos}), None
+
+
+class AiodnsLookup:
+    """Resolve hosts with c-ares, getting the TTL of the answers"""
+
+    def __init__(self):
+        self._resolver = None
+
+    async def __call__(self, host: str) -> Tuple[List[str], Optional[float]]:
+        if self._resolver is None:
+            # c-ares channel is bound to the loop it has been created in
+            self._resolver = aiodns.DNSResolver()
+        try:
+            answers = await self._resolver.query(host, "A")
+        except aiodns.error.DNSError as e:
+            if e.args and e.args[0] in (aiodns.error.ARES_ENOTFOUND,
+                                        aiodns.error.ARES_ENODATA):
+                raise NameNotFoundError(host) from e
+            raise OSError(*e.args) from e
+        return (sorted({answer.host for answer in answers}),
+                min(answer.ttl for answer in answers))
+
+
+def default_lookup():
+    return AiodnsLookup() if aiodns else getaddrinfo_lookup
+
+
+def network_of(address: str) -> str:
+    """Network the address belongs to, roughly one hosting provider's
+    block: /24 for IPv4 and /48 for IPv6"""
+    prefix = 48 if ":" in address else 24
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+class DnsResolver:
+    """Resolve candidates' hosts concurrently with a TTL cache.
+
+    Concurrent lookups of the same host (e.g. for the 'http://' and
+    'https://' variants of a candidate) share one query.
+    'lookup' is an async callable returning (addresses, ttl) and raising
+    NameNotFoundError for unregistered names.
+    """
+
+    def __init__(self, lookup=None, concurrency: int = DNS_CONCURRENCY,
+                 positive_ttl: float = DNS_POSITIVE_TTL,
+                 negative_ttl: float = DNS_NEGATIVE_TTL,
+                 failure_ttl: float = DNS_FAILURE_TTL):
+        self.lookup = lookup or default_lookup()
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.failure_ttl = failure_ttl
+        self.concurrency = concurrency
+        self.lookups_made = 0
+        self._semaphore = None
+        self._cache = {}
+        self._pending = {}
+
+    async def resolve(self, host: str) -> Optional[List[str]]:
+        """Resolve the host
+
+        :return: the host's addresses, an empty list if the name does not
+        exist or None if it could not be resolved
+        """
+        cached = self._cache.get(host)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        pending = self._pending.get(host)
+        if pending is None:
+            pending = asyncio.ensure_future(self._resolve(host))
+            self._pending[host] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(host, None))
+        return await asyncio.shield(pending)
+
+    async def _resolve(self, host: str) -> Optional[List[str]]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            self.lookups_made += 1
+            try:
+                addresses, ttl = await self.lookup(host)
+            except NameNotFoundError:
+                addresses, ttl = [], self.negative_ttl
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.debug("Could not resolve %s: %r", host, e)
+                addresses, ttl = None, self.failure_ttl
+            else:
+                ttl = self.positive_ttl if ttl is None else ttl
+
+        self._cache[host] = (time.monotonic() + ttl, addresses)
+        return addresses
+
+
+class ConnectorResolver(AbstractResolver):
+    """Let aiohttp's connector reuse the addresses found by a DnsResolver
+    instead of resolving every host once more"""
+
+    def __init__(self, dns_resolver: DnsResolver):
+        self.dns_resolver = dns_resolver
+
+    async def resolve(self, host: str, port: int = 0,
+                      family: int = socket.AF_INET) -> List[dict]:
+        addresses = await self.dns_resolver.resolve(host)
+        if not addresses:
+            raise OSError(f"Could not resolve {host}")
+
+        hosts = []
+        for address in addresses:
+            address_family = (socket.AF_INET6 if ":" in address
+                              else socket.AF_INET)
+            if family not in (socket.AF_UNSPEC, address_family):
+                continue
+            hosts.append({"hostname": host, "host": address, "port": port,
+                          "family": address_family, "proto": 0,
+                          "flags": socket.AI_NUMERICHOST})
+        if not hosts:
+            raise OSError(f"{host} has no addresses of family {family}")
+        return hosts
+
+    async def close(self):
+        pass
+
+
+dns_resolver = DnsResolver()
@@ -2,222 +2,1117 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import codecs
+import contextlib
 import datetime
 import functools
+import itertools
 import logging
+import os
+import random
 import time
-from typing import Optional
+from typing import AsyncIterator, Iterable, List, Optional
+from urllib.parse import urlsplit
 
 import aiohttp
-from aiohttp import ClientSession, ClientTimeout
-from bs4 import BeautifulSoup
-from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 
-from .urls_generator import domains_list
-from .whois_parser import get_whois_record, save_whois_record, executor
-from ..db.db_utils import export_to_csv, whitelist_url
-from ..db.model import async_engine, metadata, all_domains
+from .analysis import ANALYSIS_WORKERS, AnalysisPool, analyse_page
+from .fingerprint import (SIMHASH_DISTANCE, ContentFingerprint,
+                          FingerprintIndex, Verdict, fingerprint_of,
+                          hamming_distance)
+from .http_client import HttpClientProfile, default_profile
+from .keyword_matcher import KeywordScorer, default_matcher
+from .dns_resolver import (ConnectorResolver, DnsResolver, dns_resolver,
+                           network_of)
+from .priorities import next_check_time
+from .scan_runs import SCANNER_NAME, ScanRun
+from .targets import TargetIndex
+from .scheduler import (SCAN_CONCURRENCY, SCAN_PER_HOST_LIMIT,
+                        SCAN_PER_NETWORK_LIMIT, AdaptiveLimiter, Scheduler)
+from .text_extractor import TextExtractor, detect_charset
+from .urls_generator import generate_candidates
+from .whois_parser import (WhoisResolver, save_whois_record, registrar_cache,
+                           whois_resolver)
+from ..db.cache import notify_changes, response_cache
+from ..db.db_utils import (LEGACY_FRESHNESS_WINDOW, SCAN_LEASE_TIME,
+                           STATE_CHUNK_SIZE, add_candidates,
+                           claim_due_domains, get_domains_state,
+                           get_next_check_time, whitelist_url)
+from ..db.export import export_to_csv
+from ..db.model import (DB_POOL_SIZE, async_engine, create_schema,
+                        all_domains)
+from ..log_config import log_event
+from ..metrics import Counter, Gauge, Histogram, measure_timing
 
 logger = logging.getLogger(__name__)
 
+# Max number of records written with a single upsert statement and max number
+# of seconds a record may wait in the writer's buffer before being flushed
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", 500))
+RESULT_MAX_LATENCY = float(os.getenv("RESULT_MAX_LATENCY", 2))
 
-async def measure_timing(function):
-    @functools.wraps(function)
-    def _measure(*args, **kwargs):
+# Max number of 'Domain' tasks using the database at the same time, whatever
+# the number of urls checked concurrently. The rest of the pool is left to
+# the result writer, the claims of due urls and WHOIS caching.
+SCAN_DB_CONCURRENCY = int(os.getenv("SCAN_DB_CONCURRENCY",
+                                    max(1, DB_POOL_SIZE // 2)))
+
+# Number of times a request failing transiently before getting a response
+# is retried and seconds before the first retry, doubled for the next ones
+SCAN_FETCH_RETRIES = int(os.getenv("SCAN_FETCH_RETRIES", 2))
+SCAN_RETRY_BACKOFF = float(os.getenv("SCAN_RETRY_BACKOFF", 1))
+# Failures our own congestion may cause: timeouts and failed connections,
+# but not TLS errors, which retrying does not fix
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+PERMANENT_ERRORS = (aiohttp.ClientSSLError,)
+
+# Pages are downloaded by chunks of FETCH_CHUNK_SIZE bytes and no more than
+# FETCH_MAX_BYTES of a page are analysed
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", 16384))
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", 1048576))
+HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+
+# Max number of due urls handed to the workers per second, so that checks
+# are spread evenly instead of coming in bursts (0 for no limit), and max
+# number of seconds between two passes over the due urls
+SCAN_RATE = float(os.getenv("SCAN_RATE", 50))
+SCAN_IDLE_INTERVAL = float(os.getenv("SCAN_IDLE_INTERVAL", 300))
+# Seconds waited at least after a pass that has found nothing to check (e.g.
+# the due urls are leased by other scanners), doubled after every such pass
+# in a row up to SCAN_IDLE_INTERVAL
+SCAN_IDLE_BACKOFF = float(os.getenv("SCAN_IDLE_BACKOFF", 5))
+
+
+FETCH_SECONDS = Histogram(
+    "scan_fetch_seconds",
+    "Time spent fetching pages by phase: resolving the host (dns), waiting "
+    "for the response's headers (response) and downloading the body (body)",
+    ["phase"]
+)
+ANALYSIS_SECONDS = Histogram("scan_analysis_seconds",
+                             "Time spent analysing a page")
+DOMAINS_CHECKED = Counter(
+    "scan_domains_total",
+    "Domains handled by the scanner by outcome: unregistered, dead, alive, "
+    "dangerous, whitelisted or skipped",
+    ["outcome"]
+)
+VERDICTS_REUSED = Counter(
+    "scan_verdicts_reused_total",
+    "Pages not analysed because of the verdict of the last check, of the "
+    "same page or of the page of the same redirect target", ["source"]
+)
+CHECK_SECONDS = Histogram("scan_check_seconds",
+                          "Time spent checking a domain")
+FETCH_RETRIES = Counter("scan_fetch_retries_total",
+                        "Requests retried after a transient failure")
+CONCURRENCY_LIMIT = Gauge("scan_concurrency_limit",
+                          "Current adaptive limit of requests in flight")
+REQUESTS_IN_FLIGHT = Gauge("scan_requests_in_flight",
+                           "Requests made by the scanner at the moment")
+CONCURRENCY_DECISIONS = Counter(
+    "scan_concurrency_decisions_total",
+    "Decisions of the adaptive concurrency limiter", ["decision"]
+)
+SCAN_ERRORS = Counter("scan_errors_total",
+                      "Errors of the scanner by stage and exception class",
+                      ["stage", "error"])
+QUEUE_DEPTH = Gauge("scan_queue_depth",
+                    "Items waiting in the scanner's queues", ["queue"])
+SCAN_DURATION = Histogram(
+    "scan_duration_seconds", "Duration of the passes over the candidates",
+    buckets=(10, 60, 300, 900, 1800, 3600, 7200, 21600, 86400)
+)
+
+
+def _updated_columns(insert_stmt, record: dict) -> dict:
+    """Columns overwritten when a checked url is already in 'all_domains'.
+    Whitelisting is left to the user."""
+    return {column: insert_stmt.excluded[column] for column in record
+            if column not in ("url", "whitelisted")}
+
+
+def _bounded(column, value: Optional[str]) -> Optional[str]:
+    """The value if it fits the string column, otherwise None: a value the
+    column can't hold would make the whole record unwritable"""
+    length = column.type.length
+    if value is not None and length is not None and len(value) > length:
+        logger.debug("Not storing %s, longer than %s characters: %.80s...",
+                     column.name, length, value)
+        return None
+    return value
+
+
+async def save_record(engine, record: dict):
+    """Write a single check result to 'all_domains'
+
+    :return: the domain's id or None if the record has not been written
+    """
+    insert_stmt = insert(all_domains).values(**record)
+    do_update_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=["url"], set_=_updated_columns(insert_stmt, record)
+    ).returning(all_domains.c.domain_id)
+    try:
+        async with engine.begin() as conn:
+            result = await conn.execute(do_update_stmt)
+            domain_id = result.scalar()
+            logger.info("Successfully written %s to database", record["url"])
+            return domain_id
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("Unexpected error occurred: %s", e)
+
+
+async def upsert_records(engine, records: List[dict]) -> dict:
+    """Write check results to 'all_domains' with a single multi-row upsert
+
+    :return: a dict mapping written urls to their domains' ids
+    """
+    insert_stmt = insert(all_domains).values(records)
+    do_update_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=["url"], set_=_updated_columns(insert_stmt, records[0])
+    ).returning(all_domains.c.url, all_domains.c.domain_id)
+
+    async with engine.begin() as conn:
+        result = await conn.execute(do_update_stmt)
+        return {url: domain_id for url, domain_id in result.fetchall()}
+
+
+class ResultWriter:
+    """Collect check results from all the 'Domain' tasks and write them to
+    the database in batches.
+
+    A batch is flushed as soon as it has 'batch_size' records or its oldest
+    record has waited for 'max_latency' seconds. Records of a batch that
+    could not be written at once are retried one by one. Once a batch
+    changing listed rows (dangerous ones, or ones that were dangerous) has
+    been written, the API processes are told to drop their cached lists.
+    """
+
+    def __init__(self, engine, batch_size: int = RESULT_BATCH_SIZE,
+                 max_latency: float = RESULT_MAX_LATENCY):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.rows_written = 0
+        # Rows written that have changed the list of dangerous domains
+        self.listed_written = 0
+        self.flush_time = 0.0
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def queued(self) -> int:
+        """Number of records waiting to be written"""
+        return self._queue.qsize()
+
+    def put(self, record: dict, listed: Optional[bool] = None
+            ) -> asyncio.Future:
+        """Queue a record for writing
+
+        :param listed: whether the record changes the list of dangerous
+        domains served by the API, by default whether it is dangerous
+        :return: a future resolving to the domain's id once the record has
+        been written (None if writing has failed)
+        """
+        if listed is None:
+            listed = bool(record["is_dangerous"])
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((record, future, listed))
+        return future
+
+    async def close(self):
+        """Flush all the queued records and stop the writer"""
+        self._queue.put_nowait(None)
+        await self._task
+        rate = self.rows_written / self.flush_time if self.flush_time else 0
+        logger.info(
+            "Result writer has written %s rows in %.3f seconds "
+            "(%.1f rows/sec)", self.rows_written, self.flush_time, rate
+        )
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        closing = False
+
+        while not closing:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_latency
+
+            while len(batch) < self.batch_size:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(
+                            self._queue.get(), timeout
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        # The same row can't be updated twice by one statement, so only
+        # the latest result for every url is kept
+        records = {record["url"]: record for record, _, _ in batch}
         start = time.perf_counter()
+
         try:
-            return function(*args, **kwargs)
-        finally:
-            runtime = time.perf_counter() - start
-            executor.submit(
-                logger.info,
-                f"{function.__name__} finished in {runtime} seconds."
+            domain_ids = await upsert_records(
+                self.engine, list(records.values())
+            )
+        except (SQLAlchemyError, Exception) as e:
+            logger.error(
+                "Failed to write a batch of %s records, falling back to "
+                "writing them one by one: %s", len(records), e
             )
+            domain_ids = {}
+            for url, record in records.items():
+                domain_ids[url] = await save_record(self.engine, record)
 
-    return _measure
+        latency = time.perf_counter() - start
+        written = sum(1 for domain_id in domain_ids.values() if domain_id)
+        self.rows_written += written
+        self.flush_time += latency
+        logger.debug("Flushed %s rows in %.3f seconds (%.1f rows/sec)",
+                     written, latency, written / latency if latency else 0)
+
+        listed_written = len({record["url"] for record, _, listed in batch
+                              if listed and domain_ids.get(record["url"])})
+        if listed_written:
+            self.listed_written += listed_written
+            await self._notify_changes()
+        for record, future, _ in batch:
+            if not future.done():
+                future.set_result(domain_ids.get(record["url"]))
+
+    async def _notify_changes(self):
+        try:
+            async with self.engine.begin() as conn:
+                await notify_changes(conn)
+        except (SQLAlchemyError, Exception) as e:
+            logger.error("Failed to notify changes of dangerous domains: %s",
+                         e)
+        response_cache.invalidate()
+
+
+def needs_check(state) -> bool:
+    """Whether a url has to be checked given its stored state: it has never
+    been checked or it is due to be checked again and has not been
+    whitelisted by the user"""
+
+    if not state or not state["last_updated"]:
+        return True
+    if state["whitelisted"]:
+        return False
+    next_check = (state["next_check"] or
+                  state["last_updated"] + LEGACY_FRESHNESS_WINDOW)
+    return next_check <= datetime.datetime.utcnow()
 
 
 class Domain:
-    def __init__(self, url, session, engine):
+    def __init__(self, url, session, engine, state=None, writer=None,
+                 dns=None, index=None, analysis=None, whois=None,
+                 db_slots=None, targets=None, limiter=None, profile=None):
         self.url = url
+        self.host = urlsplit(url).hostname
+        # Row of 'all_domains' loaded by 'find_dangerous_domains' or None
+        # if the url has never been checked before
+        self.state = state
         self.is_alive = False
         self.is_dangerous = False
+        self.registered_at = state["registered_at"] if state else None
         self.session = session
         self.engine = engine
-        self.text = ""
+        self.writer = writer
+        self.dns = dns
+        self.whois = whois or whois_resolver
+        # Semaphore bounding the tasks using the database or None
+        self.db_slots = db_slots
+        # Verdicts of the pages analysed during the current scan
+        self.index = index
+        # TargetIndex of the final urls reached during the current scan
+        self.targets = targets
+        # AdaptiveLimiter of the requests in flight or None
+        self.limiter = limiter
+        self.profile = profile or default_profile
+        # AnalysisPool the page is analysed in or None to analyse it in the
+        # loop's thread
+        self.analysis = analysis
+        self.scorer = KeywordScorer(default_matcher)
+        # Text extractor and html held back for the analysis pool, only
+        # while the page is being downloaded
+        self._extractor = None
+        self._html = []
+        self.etag = None
+        self.last_modified = None
+        self.not_modified = False
+        self.content_hash = None
+        self.simhash = None
+        self.similar_to = None
+        self.verdict_reused = False
+        # Url the request has ended up at and the urls redirecting to it
+        self.final_url = None
+        self.redirects = []
+        self.target_reused = False
+        # Url claimed in 'targets', kept apart from 'final_url' as the
+        # download may end up elsewhere than the HEAD request
+        self._claimed_target = None
+        # Future of the domain's id once its check result is saved
+        self.saved = None
+        # Exception the last request has failed with
+        self.error = None
+        # Bytes of the page read so far and their decoder
+        self._bytes_read = 0
+        self._decoder = None
+        self.is_registered = True
+        # Seconds spent extracting and scoring the page's text
+        self.analysis_time = 0.0
+
+    def _on_response(self, response, start: float):
+        latency = time.perf_counter() - start
+        FETCH_SECONDS.observe(latency, phase="response")
+        if self.limiter is not None:
+            self.limiter.observe(latency)
+        self.final_url = str(response.url)
+        self.redirects = [str(redirect.url) for redirect in response.history]
+
+    def _read_validators(self, response):
+        """Validators of the page for the next check's conditional request.
+        Any site may send over-long ones, they are ignored rather than make
+        the domain's record unwritable."""
+        self.etag = _bounded(all_domains.c.etag,
+                             response.headers.get("ETag"))
+        self.last_modified = _bounded(all_domains.c.last_modified,
+                                      response.headers.get("Last-Modified"))
 
-    async def _fetch_html_async(self, **kwargs) -> str:
-        """Fetch html from the url asynchronously
+    async def _probe(self, headers: dict, **kwargs) -> bool:
+        """Ask for the page's headers only before downloading it
 
-        :return: the requested page's html
+        :return: whether the page has to be downloaded: it is an html page,
+        it has been modified since the last check and its redirect target
+        has not been analysed during this scan yet. Errors are left for the
+        download to tell, as many servers do not handle HEAD requests.
+        """
+        start = time.perf_counter()
+        async with self.session.request(
+                method="HEAD", url=self.url, headers=headers, **kwargs
+        ) as response:
+            self._on_response(response, start)
+            if response.status >= 400:
+                return True
+            self._read_validators(response)
+            if response.status == 304:
+                self.not_modified = True
+                return False
+            if response.content_type not in HTML_CONTENT_TYPES:
+                return False
+            return not await self._reuse_target_verdict()
+
+    async def _fetch_html_async(self, **kwargs) -> AsyncIterator[str]:
+        """Fetch html from the url asynchronously chunk by chunk
+
+        Yields decoded chunks of the requested page's html, no more than
+        FETCH_MAX_BYTES of it. The body is not downloaded at all if the
+        response is not an html page or the page has not been modified
+        since the last check. In the "range" probe mode only the first
+        'probe_bytes' of the page are asked for, the rest is only if they
+        have all been read and the page goes on.
         **kwargs are passed to 'self.session.request()'
         """
-        timeout = ClientTimeout(total=1800)
-        response = await self.session.request(
-            method="GET", url=self.url, timeout=timeout, **kwargs
-        )
-        response.raise_for_status()
-        logging.info(f"Got response {response.status} for URL: {self.url}")
-        html = await response.text()
-        return html
+        headers = {**self._conditional_headers(),
+                   **(kwargs.pop("headers", None) or {})}
+        self._bytes_read = 0
+        self._decoder = None
+        probe_mode = self.profile.probe_mode
+        if probe_mode == "head" and not await self._probe(headers, **kwargs):
+            return
+
+        max_bytes = FETCH_MAX_BYTES
+        if probe_mode == "range":
+            max_bytes = min(self.profile.probe_bytes, FETCH_MAX_BYTES)
+            headers = {**headers, "Range": f"bytes=0-{max_bytes - 1}"}
+        start = time.perf_counter()
+        async with self.session.request(
+                method="GET", url=self.url, headers=headers, **kwargs
+        ) as response:
+            self._on_response(response, start)
+            response.raise_for_status()
+            logger.debug("Got response %s for URL: %s", response.status,
+                         self.url)
+            self._read_validators(response)
+            if response.status == 304:
+                self.not_modified = True
+                return
+            if await self._reuse_target_verdict():
+                return
+            if response.content_type not in HTML_CONTENT_TYPES:
+                return
+
+            if response.status != 206:
+                # The server has ignored the range and sends the whole page
+                max_bytes = FETCH_MAX_BYTES
+            charset = response.charset
+            async for html in self._read_body(response, charset, max_bytes):
+                yield html
+            partial = (response.status == 206 and max_bytes < FETCH_MAX_BYTES
+                       and self._bytes_read == max_bytes)
+
+        if partial:
+            # The whole first part has been read without the page being
+            # recognised or found dangerous
+            headers = {**headers,
+                       "Range": f"bytes={max_bytes}-{FETCH_MAX_BYTES - 1}"}
+            if self.etag or self.last_modified:
+                headers["If-Range"] = self.etag or self.last_modified
+            async with self.session.request(
+                    method="GET", url=self.final_url, headers=headers,
+                    **kwargs
+            ) as response:
+                # A server sending the whole page again sends the part
+                # read already first
+                skip = max_bytes if response.status == 200 else 0
+                if response.status in (200, 206):
+                    async for html in self._read_body(response, charset,
+                                                      FETCH_MAX_BYTES, skip):
+                        yield html
+
+        if self._decoder is not None:
+            yield self._decoder.decode(b"", final=True)
+
+    async def _read_body(self, response, charset: Optional[str],
+                         max_bytes: int, skip: int = 0
+                         ) -> AsyncIterator[str]:
+        """Decode the response's body until the page's first 'max_bytes'
+        have been read, skipping its first 'skip' bytes"""
+
+        with FETCH_SECONDS.time(phase="body"):
+            async for chunk in response.content.iter_chunked(
+                    FETCH_CHUNK_SIZE
+            ):
+                if skip:
+                    chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                    if not chunk:
+                        continue
+                chunk = chunk[:max_bytes - self._bytes_read]
+                self._bytes_read += len(chunk)
+                if self._decoder is None:
+                    self._decoder = codecs.getincrementaldecoder(
+                        detect_charset(charset, chunk)
+                    )("replace")
+                yield self._decoder.decode(chunk)
+                if self._bytes_read >= max_bytes:
+                    break
+
+    @contextlib.asynccontextmanager
+    async def _request_slot(self):
+        if self.limiter is None:
+            yield
+            return
+        async with self.limiter.acquire():
+            yield
+
+    def _failed_transiently(self) -> bool:
+        """Whether the last request has failed before getting a response
+        in a way that congestion may have caused"""
+        return (self.final_url is None
+                and isinstance(self.error, TRANSIENT_ERRORS)
+                and not isinstance(self.error, PERMANENT_ERRORS))
 
     async def _check_if_alive(self, **kwargs):
-        """Check whether the site is alive
+        """Check whether the site is alive, retrying requests that fail
+        transiently before getting a response (up to SCAN_FETCH_RETRIES
+        times), so that the site is not considered dead because of our own
+        congestion. Requests wait for a slot of the adaptive limiter and
+        report their latency or failure to it.
+            **kwargs are passed to 'session.request()'
+        """
+
+        for attempt in itertools.count():
+            self.error = None
+            start = time.perf_counter()
+            async with self._request_slot():
+                result = await self._try_check_if_alive(**kwargs)
+            if not self._failed_transiently():
+                return result
+            if self.limiter is not None:
+                self.limiter.observe(time.perf_counter() - start, error=True)
+            if attempt >= SCAN_FETCH_RETRIES:
+                return result
+            FETCH_RETRIES.inc()
+            await asyncio.sleep(SCAN_RETRY_BACKOFF * 2 ** attempt
+                                * random.uniform(0.5, 1.5))
+
+    async def _try_check_if_alive(self, **kwargs):
+        """Check whether the site is alive, analysing its page as it is
+        downloaded. Download stops as soon as the page is found dangerous
+        or as soon as its first FINGERPRINT_WINDOW characters show that it
+        is the page seen at the last check or one analysed during this scan.
             **kwargs are passed to 'session.request()'
         """
 
+        fingerprint = ContentFingerprint()
+        self._extractor = TextExtractor()
+        chunks = self._fetch_html_async(**kwargs)
         try:
-            executor.submit(logger.info, f"Trying to reach {self.url}")
-            html = await self._fetch_html_async(**kwargs)
+            logger.debug("Trying to reach %s", self.url)
+            async for html in chunks:
+                if not fingerprint.is_complete:
+                    fingerprint.feed(html)
+                    if not fingerprint.is_full:
+                        continue
+                    await self._complete_fingerprint(fingerprint)
+                    if self._reuse_known_verdict(fingerprint):
+                        break
+                    html = fingerprint.pop_buffer()
+                await self._analyse(html)
+                if self.is_dangerous:
+                    break
 
         except (aiohttp.ClientError, aiohttp.http.HttpProcessingError) as e:
-            executor.submit(
-                logger.error, f"aiohttp exception for {self.url}: {e}"
-            )
+            logger.info("aiohttp exception for %s: %s", self.url, e)
+            SCAN_ERRORS.inc(stage="fetch", error=type(e).__name__)
+            self.error = e
             self.is_alive = False
             return False
 
         except Exception as e:
-            executor.submit(
-                logger.error,
-                f"Non-aiohttp exception for {self.url} occurred: {e}"
-            )
+            logger.error("Non-aiohttp exception for %s occurred: %s",
+                         self.url, e)
+            SCAN_ERRORS.inc(stage="fetch", error=type(e).__name__)
+            self.error = e
             self.is_alive = False
             return False
 
         else:
-            executor.submit(logger.info, f"Site {self.url} has responded")
+            logger.debug("Site %s has responded", self.url)
             self.is_alive = True
-            domain_page = BeautifulSoup(html, "html.parser")
-            page_text = domain_page.get_text()
-            self.text = page_text
-
-    def _check_if_dangerous(self):
-        flag_words = ["почт", "росси", "отправлени", "посылк", "письм", "писем"]
-        self.text.replace("\n", " ")
-        page_text = self.text.split()
-        potential_infringements = set(
-            word.lower() for word in page_text for flag_word in flag_words
-            if flag_word in word.lower()
+            if self.not_modified:
+                self._reuse_previous_verdict()
+                return
+            if self.target_reused:
+                return
+            if not fingerprint.is_complete:
+                # The whole page is shorter than the fingerprint's window
+                await self._complete_fingerprint(fingerprint)
+                if not self._reuse_known_verdict(fingerprint):
+                    await self._analyse(fingerprint.pop_buffer())
+            # Responses without a body (e.g. pages that are not html) have
+            # nothing to analyse
+            if (self._bytes_read and not self.verdict_reused
+                    and not self.is_dangerous):
+                await self._analyse("", final=True)
+            self._remember_fingerprint(fingerprint)
+            if self.analysis_time:
+                ANALYSIS_SECONDS.observe(self.analysis_time)
+
+        finally:
+            await chunks.aclose()
+            self._publish_target_verdict()
+            # The page's text is not needed once it has been scored, while
+            # the domain may still wait for WHOIS and the database
+            self._extractor = None
+            self._html = []
+
+    def _previous_verdict(self) -> Optional[Verdict]:
+        """Results of the last check if it has analysed the page"""
+        if not (self.state and self.state["is_alive"]
+                and self.state["content_hash"]):
+            return None
+        return Verdict(self.url, self.state["is_dangerous"],
+                       self.state["danger_score"],
+                       self.state["matched_terms"],
+                       self.state["content_hash"], self.state["simhash"])
+
+    def _conditional_headers(self) -> dict:
+        """Headers letting the server answer '304 Not Modified' if the page
+        is the one analysed at the last check"""
+        headers = {}
+        if self._previous_verdict():
+            if self.state["etag"]:
+                headers["If-None-Match"] = self.state["etag"]
+            if self.state["last_modified"]:
+                headers["If-Modified-Since"] = self.state["last_modified"]
+        return headers
+
+    def _apply_verdict(self, verdict: Verdict, source: str):
+        VERDICTS_REUSED.inc(source=source)
+        self.is_dangerous = bool(verdict.is_dangerous)
+        self.scorer.score = verdict.danger_score or 0.0
+        # Weights of the terms are not stored, only their total
+        self.scorer.terms = dict.fromkeys(
+            filter(None, (verdict.matched_terms or "").split(", ")), 0.0
         )
+        self.verdict_reused = True
+
+    def _reuse_previous_verdict(self):
+        self._apply_verdict(self._previous_verdict(), "previous")
+        self.etag = self.etag or self.state["etag"]
+        self.last_modified = self.last_modified or self.state["last_modified"]
+        self.content_hash = self.state["content_hash"]
+        self.simhash = self.state["simhash"]
+        self.similar_to = self.state["similar_to"]
+        logger.debug("%s has not been modified since last check", self.url)
 
-        if len(potential_infringements) > 2:
-            executor.submit(
-                logger.info,
-                f"Potentially dangerous: "
-                f"{len(potential_infringements)} have been found: "
-                f"{potential_infringements}"
+    def _reuse_known_verdict(self, fingerprint: ContentFingerprint) -> bool:
+        """Take over the verdict of the same or a near-identical page: the
+        one seen at the last check or one analysed during this scan
+
+        :return: whether the page does not have to be analysed
+        """
+        if fingerprint.content_hash is None:
+            return False
+        self.content_hash = fingerprint.content_hash
+        self.simhash = fingerprint.simhash
+
+        previous = self._previous_verdict()
+        if previous and (
+                fingerprint.content_hash == self.state["content_hash"]
+                or self.state["simhash"] is not None
+                and hamming_distance(fingerprint.simhash,
+                                     self.state["simhash"]) <= SIMHASH_DISTANCE
+        ):
+            self._apply_verdict(previous, "previous")
+            self.similar_to = self.state["similar_to"]
+            logger.debug("Page of %s has not changed", self.url)
+            return True
+
+        verdict = self.index.find(fingerprint) if self.index else None
+        if verdict is not None:
+            self._apply_verdict(verdict, "fingerprint")
+            self.similar_to = verdict.url
+            logger.debug("Page of %s is the same as the one of %s",
+                         self.url, self.similar_to)
+            return True
+        return False
+
+    async def _reuse_target_verdict(self) -> bool:
+        """Take over the verdict on the page of the url the request has
+        ended up at if another domain has reached it during this scan,
+        waiting for it while that domain analyses the page
+
+        :return: whether the page does not have to be downloaded
+        """
+        if self.targets is None or self._claimed_target is not None:
+            return False
+        verdict = self.targets.claim(self.final_url)
+        if verdict is None:
+            self._claimed_target = self.final_url
+            return False
+        verdict = await verdict
+        if verdict is None:
+            return False
+        self._apply_verdict(verdict, "target")
+        self.content_hash = verdict.content_hash
+        self.simhash = verdict.simhash
+        self.similar_to = verdict.url
+        self.target_reused = True
+        logger.debug("%s redirects to %s, which has been analysed already",
+                     self.url, self.final_url)
+        return True
+
+    def _publish_target_verdict(self):
+        """Share the verdict on the page of the claimed redirect target with
+        the domains waiting for it, or let them download it if the page
+        could not be analysed. The verdict is only on the claimed url's page
+        if the download has ended up there too."""
+        claimed, self._claimed_target = self._claimed_target, None
+        if claimed is None:
+            return
+        self.targets.publish(claimed, self._verdict()
+                             if self.is_alive and self.final_url == claimed
+                             else None)
+
+    def _remember_fingerprint(self, fingerprint: ContentFingerprint):
+        """Share the verdict on the page with the rest of the scan"""
+        if (self.index is None or fingerprint.content_hash is None
+                or self.similar_to):
+            return
+        self.index.add(self._verdict())
+
+    def _verdict(self) -> Verdict:
+        return Verdict(self.url, self.is_dangerous, self.scorer.score,
+                       ", ".join(self.scorer.terms), self.content_hash,
+                       self.simhash)
+
+    async def _complete_fingerprint(self, fingerprint: ContentFingerprint):
+        start = time.perf_counter()
+        if self.analysis is None:
+            fingerprint.close()
+        else:
+            fingerprint.complete(*await self.analysis.run(
+                fingerprint_of, fingerprint.head()
+            ))
+        self.analysis_time += time.perf_counter() - start
+
+    async def _analyse(self, html: str, final: bool = False):
+        """Analyse the next chunk of the page's html: right away in the
+        loop's thread or, with an analysis pool, all at once in a worker
+        process when the page has ended"""
+
+        start = time.perf_counter()
+        if self.analysis is None:
+            self._check_if_dangerous(self._extractor.feed(html))
+            if final:
+                self._check_if_dangerous(self._extractor.close(), final=True)
+        else:
+            self._html.append(html)
+            if final:
+                html, self._html = "".join(self._html), []
+                self.scorer.score, self.scorer.terms = (
+                    await self.analysis.run(analyse_page, html)
+                )
+                self._update_danger()
+        self.analysis_time += time.perf_counter() - start
+
+    def _check_if_dangerous(self, text: str, final: bool = False):
+        """Score the next piece of the page's text"""
+        self.scorer.feed(text)
+        if final:
+            self.scorer.close()
+        self._update_danger()
+
+    def _update_danger(self):
+        if self.scorer.is_dangerous and not self.is_dangerous:
+            logger.info(
+                "Potentially dangerous: %s has scored %s, matched terms: %s",
+                self.url, self.scorer.score, list(self.scorer.terms)
             )
             self.is_dangerous = True
 
-    async def _get_last_updated(self) -> Optional[datetime.datetime]:
-        select_stmt = (
-            select(all_domains.c.last_updated).
-                where(all_domains.c.url == self.url)
-        )
-
-        try:
-            async with async_engine.begin() as conn:
-                result = await conn.execute(select_stmt)
-                last_updated = result.fetchone()
-                result.close()
-                return last_updated[0] if last_updated else None
-        except (SQLAlchemyError, Exception) as e:
-            executor.submit(logger.error, f"Unexpected error occurred: {e}")
-            return None
+    async def _check_if_registered(self) -> bool:
+        """Resolve the domain's host before trying to reach it. Names that
+        do not exist are considered dead without making any request."""
 
-    async def _check_if_whitelisted(self):
-        select_stmt = (
-            select(all_domains.c.whitelisted).
-                where(all_domains.c.url == self.url)
-        )
-        try:
-            async with async_engine.begin() as conn:
-                result = await conn.execute(select_stmt)
-                whitelisted = result.fetchone()
-                result.close()
-                return (whitelisted[0]
-                        if whitelisted
-                        else False)
-        except (SQLAlchemyError, Exception) as e:
-            executor.submit(logger.error, f"Unexpected error occurred: {e}")
+        if self.dns is None:
+            return True
+        with FETCH_SECONDS.time(phase="dns"):
+            addresses = await self.dns.resolve(self.host)
+        if addresses == []:
+            logger.debug("%s is not registered, skipping it", self.host)
+            self.is_registered = False
             return False
+        return True
 
     async def _make_checks(self, **kwargs):
-        await self._check_if_alive(**kwargs)
+        if await self._check_if_registered():
+            await self._check_if_alive(**kwargs)
+
+    def _outcome(self) -> str:
+        if self.is_dangerous:
+            return "dangerous"
         if self.is_alive:
-            self._check_if_dangerous()
+            return "alive"
+        return "dead" if self.is_registered else "unregistered"
+
+    def _has_come_alive(self) -> bool:
+        """Whether the site has responded although it was dead when it was
+        checked last time, which usually means it has just been registered"""
+        return bool(self.is_alive and self.state and
+                    self.state["last_updated"] and not self.state["is_alive"])
+
+    async def _check_registration_date(self):
+        """Look up when the domain was registered. A failed lookup leaves
+        the previous date: it must not cost the check's verdict."""
+        try:
+            whois_record = await self.whois.resolve(self.url)
+        except Exception as e:
+            logger.warning("Could not look up the registration date of %s: "
+                           "%r", self.url, e)
+            SCAN_ERRORS.inc(stage="whois", error=type(e).__name__)
+            return
+        self.registered_at = (whois_record.get("creation_date")
+                              or self.registered_at)
 
-    async def _save_record(self):
+    def _save_record(self) -> asyncio.Future:
+        """Hand the check results over to the result writer along with the
+        time of the next check
+
+        :return: a future resolving to the domain's id once its record has
+        been written to the database (None if writing has failed)
+        """
         now = datetime.datetime.utcnow()
-        insert_stmt = (
-            insert(all_domains).
-                values(
-                url=self.url, is_alive=self.is_alive,
-                is_dangerous=self.is_dangerous, last_updated=now,
-                whitelisted=False
-            )
+        dead_checks = 0 if self.is_alive else (
+            (self.state["dead_checks"] or 0) + 1 if self.state else 1
         )
-        do_update_stmt = insert_stmt.on_conflict_do_update(
-            index_elements=["url"],
-            set_=dict(is_alive=self.is_alive, is_dangerous=self.is_dangerous,
-                      last_updated=now)
+        record = dict(
+            url=self.url, is_alive=self.is_alive,
+            is_dangerous=self.is_dangerous,
+            last_updated=now, whitelisted=False,
+            danger_score=self.scorer.score,
+            matched_terms=", ".join(self.scorer.terms),
+            next_check=next_check_time(self.is_alive, self.is_dangerous,
+                                       dead_checks, self.registered_at, now),
+            dead_checks=dead_checks, registered_at=self.registered_at,
+            etag=self.etag, last_modified=self.last_modified,
+            content_hash=self.content_hash, simhash=self.simhash,
+            similar_to=self.similar_to,
+            final_url=_bounded(all_domains.c.final_url, self.final_url),
+            redirects=" ".join(self.redirects) or None, lease_until=None,
+            lease_run_id=None
+        )
+        log_event(logger, "domain_checked", url=self.url,
+                  is_alive=self.is_alive, is_dangerous=self.is_dangerous,
+                  danger_score=self.scorer.score,
+                  verdict_reused=self.verdict_reused,
+                  final_url=self.final_url,
+                  next_check=record["next_check"])
+        if self.writer:
+            # Domains found dangerous before stay listed through their WHOIS
+            # record, so changes of their rows are changes of the list too
+            return self.writer.put(record, listed=self.is_dangerous or bool(
+                self.state and self.state["is_dangerous"]
+            ))
+        return asyncio.ensure_future(
+            self._use_db(save_record(self.engine, record))
         )
-        try:
-            async with self.engine.begin() as conn:
-                await conn.execute(do_update_stmt)
-                executor.submit(
-                    logger.info,
-                    f"Successfully written {self.url} to database"
-                )
-        except (SQLAlchemyError, Exception) as e:
-            executor.submit(logger.error, f"Unexpected error occurred: {e}")
 
-    async def _process_whois(self):
-        whois_record = get_whois_record(self.url)
+    async def _use_db(self, coro):
+        """Await a coroutine accessing the database once a slot is free"""
+        if self.db_slots is None:
+            return await coro
+        async with self.db_slots:
+            return await coro
+
+    async def _process_whois(self, domain_id=None):
+        whois_record = await self.whois.resolve(self.url)
 
         if whois_record["owner_name"] == "JSC Russian Post":
-            await whitelist_url(self.url)
+            await self._use_db(whitelist_url(self.url))
 
-        await save_whois_record(whois_record)
+        await self._use_db(save_whois_record(whois_record, domain_id))
 
+    @measure_timing(CHECK_SECONDS)
     async def process_url(self, **kwargs):
-        last_updated = await self._get_last_updated()
-        whitelisted = await self._check_if_whitelisted()
-        if last_updated:
-            delta = time.time() - last_updated.replace(
-                tzinfo=datetime.timezone.utc).timestamp()
-            executor.submit(
-                logger.debug, f"Delta between now and last updated: {delta}"
-            )
-
         # Skip making checks if the domain info was recently updated or
         # the domain has been whitelisted by the user
-        if not last_updated or (delta >= 43200 and not whitelisted):
-            await self._make_checks(**kwargs)
-            await self._save_record()
+        if not needs_check(self.state):
+            DOMAINS_CHECKED.inc(outcome="whitelisted"
+                                if self.state["whitelisted"] else "skipped")
+            return
+
+        await self._make_checks(**kwargs)
+        if self.is_dangerous or self._has_come_alive():
+            # Recently registered domains are checked more often
+            await self._check_registration_date()
+        saved = self.saved = self._save_record()
+        DOMAINS_CHECKED.inc(outcome=self._outcome())
+
+        if self.is_dangerous:
+            # WHOIS record refers to the domain's row so it must be
+            # written first
+            await self._process_whois(await saved)
+
+
+async def _iter_candidates(urls: Iterable[str]) -> AsyncIterator[tuple]:
+    """Yield (url, state) pairs for the urls to be checked.
+
+    The stored state is loaded chunk by chunk so that freshness and whitelist
+    checks neither cost a round-trip per url nor need the state of the whole
+    candidate set in memory.
+    """
+    urls = iter(urls)
+    while True:
+        chunk = list(itertools.islice(urls, STATE_CHUNK_SIZE))
+        if not chunk:
+            return
+        states = await get_domains_state(chunk)
+        for url in chunk:
+            yield url, states.get(url)
+
+
+async def _iter_due_domains(rate: float = SCAN_RATE,
+                            due_before: datetime.datetime = None,
+                            run_id=None) -> AsyncIterator[tuple]:
+    """Yield (url, state) pairs for the urls that are due to be checked, the
+    most overdue first, at no more than 'rate' urls per second.
+
+    Urls are claimed a chunk at a time on behalf of the scan run 'run_id',
+    so that other scanner processes get the following ones. Only urls that
+    are due before 'due_before' (by default when the pass starts) are
+    yielded, the ones rescheduled during the pass wait for the next one.
+    """
+    loop = asyncio.get_event_loop()
+    due_before = due_before or datetime.datetime.utcnow()
+    interval = 1 / rate if rate else 0
+    next_time = loop.time()
+    # Claimed urls must be checked well before their lease runs out
+    chunk_size = STATE_CHUNK_SIZE
+    if rate:
+        chunk_size = max(1, min(chunk_size, int(rate * SCAN_LEASE_TIME / 2)))
 
-            if self.is_dangerous:
-                await self._process_whois()
+    while True:
+        rows = await claim_due_domains(due_before, chunk_size, run_id=run_id)
+        if not rows:
+            return
+        for row in rows:
+            delay = next_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_time = max(next_time, loop.time()) + interval
+            yield row["url"], row
 
 
-async def find_dangerous_domains(**kwargs) -> None:
-    timeout = ClientTimeout(total=1800)
-    connection_pool_size = aiohttp.TCPConnector(limit=1000)
-    urls = domains_list
-    tasks = []
+async def seconds_until_next_check(idle_passes: int = 0) -> float:
+    """Number of seconds to wait before the next pass over the due urls
+
+    :param idle_passes: number of the last passes in a row that have found
+    nothing to check
+    """
+    min_delay = 1
+    if idle_passes:
+        min_delay = min(SCAN_IDLE_BACKOFF * 2 ** (idle_passes - 1),
+                        SCAN_IDLE_INTERVAL)
+    next_check = await get_next_check_time()
+    if next_check is None:
+        return SCAN_IDLE_INTERVAL
+    delay = (next_check - datetime.datetime.utcnow()).total_seconds()
+    return min(max(delay, min_delay), SCAN_IDLE_INTERVAL)
+
+
+async def _limit_keys(dns: DnsResolver, item: tuple) -> list:
+    """Resolve a candidate's host so that requests are limited per IP
+    address and per network rather than per name"""
+
+    url, state = item[:2]
+    if not needs_check(state):
+        return []
+    host = urlsplit(url).hostname
+    addresses = await dns.resolve(host)
+    if addresses is None:
+        return [("host", host)]
+    if not addresses:
+        return []
+    return [("ip", addresses[0]), ("network", network_of(addresses[0]))]
+
+
+def _per_key_limit(key: tuple) -> int:
+    return (SCAN_PER_NETWORK_LIMIT if key[0] == "network"
+            else SCAN_PER_HOST_LIMIT)
+
+
+def _record_concurrency_decision(decision: str, limit: int, p95: float,
+                                 error_rate: float):
+    CONCURRENCY_DECISIONS.inc(decision=decision)
+    log_event(logger, "concurrency_decision",
+              logging.INFO if decision == "decrease" else logging.DEBUG,
+              decision=decision, limit=limit, p95_latency=round(p95, 3),
+              error_rate=round(error_rate, 3))
+
+
+@measure_timing(SCAN_DURATION)
+async def find_dangerous_domains(urls: Iterable[str] = None,
+                                 dns: DnsResolver = None, seed: bool = True,
+                                 export: bool = True,
+                                 connector: aiohttp.BaseConnector = None,
+                                 whois: WhoisResolver = None,
+                                 rate: float = SCAN_RATE,
+                                 scanner: str = SCANNER_NAME,
+                                 resume: bool = True,
+                                 profile: HttpClientProfile = None,
+                                 **kwargs) -> int:
+    """Check the given urls or, by default, the candidates that are due
+
+    :return: the number of urls processed
+
+    :param seed: whether to add new candidates to the database first
+    :param export: whether to update the CSV snapshot afterwards if the
+    list of dangerous domains has changed
+    :param connector: connector the requests are made through, by default
+    one of 'profile' resolving hosts with 'dns'
+    :param profile: settings of the HTTP client, by default the SCAN_*
+    environment variables of http_client.py
+    :param rate: max number of due urls checked per second
+    :param scanner: name the scan run is recorded under
+    :param resume: whether to resume the scanner's interrupted run over the
+    same candidates rather than start a new one
+    """
+    dns = dns or dns_resolver
+    profile = profile or default_profile
+    # Requests reuse the addresses found while pre-resolving candidates
+    connector = connector or profile.connector(SCAN_CONCURRENCY,
+                                               ConnectorResolver(dns))
 
     async with async_engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
-
-    async with ClientSession(
-            timeout=timeout, connector=connection_pool_size
-    ) as session:
-        for url in urls:
-            domain = Domain(url=url, session=session, engine=async_engine)
-            tasks.append(domain.process_url(**kwargs))
-        await asyncio.gather(*tasks)
-    executor.submit(logger.debug, "Finished searching for dangerous domains")
-    await export_to_csv()
+        await conn.run_sync(create_schema)
+    await registrar_cache.warm()
+    if urls is None:
+        if seed:
+            added = await add_candidates(generate_candidates())
+            logger.info("Added %s new candidates", added)
+    run = ScanRun(scanner, urls=None if urls is None else list(urls))
+    await run.start(resume)
+    if urls is None:
+        candidates = _iter_due_domains(rate, run.due_before, run.run_id)
+    else:
+        candidates = _iter_candidates(run.remaining_urls())
+
+    writer = ResultWriter(async_engine)
+    writer.start()
+    index = FingerprintIndex()
+    analysis = AnalysisPool() if ANALYSIS_WORKERS else None
+    targets = TargetIndex()
+    limiter = AdaptiveLimiter(on_decision=_record_concurrency_decision)
+    CONCURRENCY_LIMIT.set_function(lambda: limiter.limit)
+    REQUESTS_IN_FLIGHT.set_function(lambda: limiter.in_flight)
+    db_slots = asyncio.Semaphore(SCAN_DB_CONCURRENCY)
+
+    async with profile.session(connector) as session:
+        async def check_url(item: tuple):
+            url, state, position = item
+            domain = Domain(url=url, session=session, engine=async_engine,
+                            state=state, writer=writer, dns=dns,
+                            index=index, analysis=analysis, whois=whois,
+                            db_slots=db_slots, targets=targets,
+                            limiter=limiter, profile=profile)
+            failed = False
+            try:
+                await domain.process_url(**kwargs)
+            except Exception as e:
+                SCAN_ERRORS.inc(stage="check", error=type(e).__name__)
+                failed = True
+                raise
+            finally:
+                run.done(position, domain.saved, failed)
+
+        scheduler = Scheduler(check_url, per_key_limit=_per_key_limit,
+                              keys=functools.partial(_limit_keys, dns))
+        QUEUE_DEPTH.set_function(scheduler.queued, queue="scheduler")
+        QUEUE_DEPTH.set_function(scheduler.deferred, queue="deferred")
+        QUEUE_DEPTH.set_function(writer.queued, queue="writer")
+        if analysis:
+            QUEUE_DEPTH.set_function(analysis.queued, queue="analysis")
+        finished = False
+        try:
+            await scheduler.run(run.track(candidates))
+            finished = True
+        finally:
+            await writer.close()
+            if analysis:
+                analysis.close()
+            # Interrupted runs are resumed from their last checkpoint
+            await run.close(finished)
+
+    logger.info(
+        "Finished searching for dangerous domains: %s urls processed, "
+        "%s failed, %s distinct pages analysed, %s distinct redirect "
+        "targets reached, concurrency limit %s", scheduler.processed,
+        scheduler.failed, len(index), len(targets), limiter.limit
+    )
+    if export and writer.listed_written:
+        await export_to_csv()
+    return scheduler.processed
@@ -0,0 +1,195 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import os
+import re
+import sys
+from typing import Iterable, Optional, Tuple
+
+# Number of characters at the start of a page its fingerprint is taken from,
+# so that a page is recognised before being downloaded in full
+FINGERPRINT_WINDOW = int(os.getenv("FINGERPRINT_WINDOW", 65536))
+# Max number of differing SimHash bits for two pages to be considered
+# near-identical (e.g. the same phishing kit with another domain name in it)
+SIMHASH_DISTANCE = int(os.getenv("SIMHASH_DISTANCE", 3))
+
+SIMHASH_BITS = 64
+SIMHASH_MASK = (1 << SIMHASH_BITS) - 1
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Every bit of a token's hash gets its own 32 bit lane of a big integer, so
+# that the per-bit weights of all the tokens are summed with one addition per
+# token instead of one per bit. BYTE_LANES[b] spreads the 8 bits of b
+_LANE_WIDTH = 32
+_LANE_MASK = (1 << _LANE_WIDTH) - 1
+BYTE_LANES = [
+    sum(1 << (bit * _LANE_WIDTH) for bit in range(8) if byte >> bit & 1)
+    for byte in range(256)
+]
+
+
+def _spread(value: int) -> int:
+    lanes = 0
+    for index in range(SIMHASH_BITS // 8):
+        lanes |= BYTE_LANES[value >> (index * 8) & 0xff] << (
+            index * 8 * _LANE_WIDTH
+        )
+    return lanes
+
+
+def simhash(tokens: Iterable[str]) -> int:
+    """SimHash of the tokens weighted by their frequency: similar texts get
+    hashes differing in a few bits only
+
+    :return: a signed 64 bit integer, as stored by postgres' bigint
+    """
+    counts = collections.Counter(tokens)
+    lanes = 0
+    for token, count in counts.items():
+        token_hash = int.from_bytes(hashlib.blake2b(
+            token.encode("utf-8"), digest_size=SIMHASH_BITS // 8
+        ).digest(), "little")
+        lanes += count * _spread(token_hash)
+
+    half = sum(counts.values()) / 2
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        if (lanes >> (bit * _LANE_WIDTH) & _LANE_MASK) > half:
+            value |= 1 << bit
+    return value - (1 << SIMHASH_BITS) if value >> 63 else value
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin((first ^ second) & SIMHASH_MASK).count("1")
+
+
+def fingerprint_of(head: str) -> Tuple[Optional[str], Optional[int]]:
+    """Content hash and SimHash of the start of a page (None for an empty
+    one, e.g. the page is not html)"""
+    if not head:
+        return None, None
+    return (hashlib.sha256(head.encode("utf-8")).hexdigest(),
+            simhash(TOKEN_PATTERN.findall(head.lower())))
+
+
+class ContentFingerprint:
+    """Fingerprint of a page fed to it chunk by chunk: a hash of its first
+    'window' characters and their SimHash.
+
+    Chunks are held back until the window 'is_full' (or the page has
+    ended) so that the caller can decide whether the page has to be
+    analysed at all before analysing any of it. The fingerprint is taken
+    by 'close()' or, if it is computed elsewhere (e.g. by an AnalysisPool)
+    from 'head()', set by 'complete()'.
+    """
+
+    def __init__(self, window: int = FINGERPRINT_WINDOW):
+        self.window = window
+        self.is_complete = False
+        self.content_hash = None
+        self.simhash = None
+        self._buffer = []
+        self._length = 0
+
+    @property
+    def is_full(self) -> bool:
+        return self._length >= self.window
+
+    def feed(self, html: str):
+        self._buffer.append(html)
+        self._length += len(html)
+
+    def head(self) -> str:
+        """The characters the fingerprint is taken from"""
+        return "".join(self._buffer)[:self.window]
+
+    def complete(self, content_hash: Optional[str], simhash: Optional[int]):
+        self.content_hash = content_hash
+        self.simhash = simhash
+        self.is_complete = True
+
+    def close(self):
+        if not self.is_complete:
+            self.complete(*fingerprint_of(self.head()))
+
+    def pop_buffer(self) -> str:
+        """The html held back so far"""
+        html = "".join(self._buffer)
+        self._buffer.clear()
+        return html
+
+
+class Verdict:
+    """Verdict on a page shared with the rest of a scan: the 'url' of the
+    domain the page has been analysed for, the analysis' results and the
+    page's fingerprint.
+
+    A scan keeps one per distinct page and redirect target until it ends, so
+    they are slotted records rather than dicts, and the matched terms, which
+    the pages of a phishing kit share, are interned.
+    """
+
+    __slots__ = ("url", "is_dangerous", "danger_score", "matched_terms",
+                 "content_hash", "simhash")
+
+    def __init__(self, url: str, is_dangerous: bool, danger_score: float,
+                 matched_terms: Optional[str],
+                 content_hash: Optional[str] = None,
+                 simhash: Optional[int] = None):
+        self.url = url
+        self.is_dangerous = is_dangerous
+        self.danger_score = danger_score
+        self.matched_terms = (sys.intern(matched_terms) if matched_terms
+                              else matched_terms)
+        self.content_hash = content_hash
+        self.simhash = simhash
+
+
+class FingerprintIndex:
+    """Verdicts of the pages analysed during a scan by their fingerprints,
+    so that pages served by many domains (parking pages, phishing kits) are
+    analysed once.
+
+    Near-identical pages are found with the pigeonhole principle: the hash
+    is split into 'distance + 1' bands and two hashes differing in at most
+    'distance' bits have at least one band in common.
+    """
+
+    def __init__(self, distance: int = SIMHASH_DISTANCE):
+        self.distance = distance
+        self._band_width = SIMHASH_BITS // (distance + 1)
+        self._by_hash = {}
+        self._by_band = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._by_hash)
+
+    def _bands(self, value: int):
+        value &= SIMHASH_MASK
+        band_mask = (1 << self._band_width) - 1
+        for index in range(self.distance + 1):
+            yield index, value >> (index * self._band_width) & band_mask
+
+    def find(self, fingerprint: ContentFingerprint) -> Optional[Verdict]:
+        """Verdict of an identical or near-identical page or None"""
+
+        verdict = self._by_hash.get(fingerprint.content_hash)
+        if verdict is not None:
+            return verdict
+        for band in self._bands(fingerprint.simhash):
+            for verdict in self._by_band.get(band, ()):
+                if hamming_distance(verdict.simhash, fingerprint.simhash) <= (
+                        self.distance):
+                    return verdict
+        return None
+
+    def add(self, verdict: Verdict):
+        """Remember the verdict of a page by the fingerprint it carries"""
+
+        if verdict.content_hash in self._by_hash:
+            return
+        self._by_hash[verdict.content_hash] = verdict
+        for band in self._bands(verdict.simhash):
+            self._by_band[band].append(verdict)
@@ -0,0 +1,123 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import inspect
+import os
+import ssl
+from typing import NamedTuple, Optional
+
+import aiohttp
+from aiohttp import ClientSession, ClientTimeout
+from aiohttp.abc import AbstractResolver
+
+
+def _flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+# Seconds allowed for establishing a connection, for waiting on the next
+# chunk of the response (including the first byte) and for a whole request
+SCAN_CONNECT_TIMEOUT = float(os.getenv("SCAN_CONNECT_TIMEOUT", 10))
+SCAN_FIRST_BYTE_TIMEOUT = float(os.getenv("SCAN_FIRST_BYTE_TIMEOUT", 15))
+SCAN_TOTAL_TIMEOUT = float(os.getenv("SCAN_TOTAL_TIMEOUT", 60))
+# Seconds an idle connection is kept open for the next request to the same
+# host (e.g. the 'https://' variant of a candidate after the 'http://' one)
+SCAN_KEEPALIVE_TIMEOUT = float(os.getenv("SCAN_KEEPALIVE_TIMEOUT", 15))
+# Seconds before trying the next address of a host while connecting to the
+# previous one (RFC 8305), if the installed aiohttp supports it
+SCAN_HAPPY_EYEBALLS_DELAY = float(os.getenv("SCAN_HAPPY_EYEBALLS_DELAY",
+                                            0.25))
+# Squatted sites often serve self-signed or expired certificates, their pages
+# are analysed anyway unless certificates are verified
+SCAN_TLS_VERIFY = _flag("SCAN_TLS_VERIFY", "false")
+# Whether pages are asked for compressed
+SCAN_COMPRESSION = _flag("SCAN_COMPRESSION", "true")
+SCAN_USER_AGENT = os.getenv(
+    "SCAN_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
+)
+SCAN_ACCEPT_LANGUAGE = os.getenv("SCAN_ACCEPT_LANGUAGE", "ru,en;q=0.8")
+# How a site is probed: "get" downloads its page right away, "head" sends a
+# HEAD request first and skips the download when it tells the page is not
+# html or has not been modified, "range" asks for the first
+# SCAN_PROBE_BYTES of the page and only for the rest if it is still needed
+# (any other value stands for "get")
+SCAN_PROBE_MODE = os.getenv("SCAN_PROBE_MODE", "get")
+SCAN_PROBE_BYTES = int(os.getenv("SCAN_PROBE_BYTES", 65536))
+PROBE_MODES = ("get", "head", "range")
+
+_CONNECTOR_PARAMETERS = inspect.signature(aiohttp.TCPConnector).parameters
+
+
+class HttpClientProfile(NamedTuple):
+    """Settings of the HTTP client the scanner checks sites with"""
+
+    connect_timeout: float = SCAN_CONNECT_TIMEOUT
+    first_byte_timeout: float = SCAN_FIRST_BYTE_TIMEOUT
+    total_timeout: float = SCAN_TOTAL_TIMEOUT
+    keepalive_timeout: float = SCAN_KEEPALIVE_TIMEOUT
+    happy_eyeballs_delay: float = SCAN_HAPPY_EYEBALLS_DELAY
+    tls_verify: bool = SCAN_TLS_VERIFY
+    compression: bool = SCAN_COMPRESSION
+    user_agent: str = SCAN_USER_AGENT
+    accept_language: str = SCAN_ACCEPT_LANGUAGE
+    probe_mode: str = SCAN_PROBE_MODE
+    probe_bytes: int = SCAN_PROBE_BYTES
+
+    def timeout(self) -> ClientTimeout:
+        return ClientTimeout(total=self.total_timeout,
+                             connect=self.connect_timeout,
+                             sock_read=self.first_byte_timeout)
+
+    def headers(self) -> dict:
+        headers = {"User-Agent": self.user_agent,
+                   "Accept": "text/html,application/xhtml+xml;q=0.9,"
+                             "*/*;q=0.8",
+                   "Accept-Language": self.accept_language}
+        # Ranges of a compressed page can't be decompressed separately
+        if not self.compression or self.probe_mode == "range":
+            headers["Accept-Encoding"] = "identity"
+        return headers
+
+    def ssl_context(self) -> ssl.SSLContext:
+        return _ssl_context(self.tls_verify)
+
+    def connector(self, limit: int,
+                  resolver: Optional[AbstractResolver] = None
+                  ) -> aiohttp.TCPConnector:
+        """Connector sharing one TLS context between all the connections.
+        Names are resolved by 'resolver' (which caches them itself) rather
+        than by the connector's own cache."""
+        kwargs = {}
+        if "happy_eyeballs_delay" in _CONNECTOR_PARAMETERS:
+            kwargs["happy_eyeballs_delay"] = self.happy_eyeballs_delay
+        return aiohttp.TCPConnector(
+            limit=limit, resolver=resolver, use_dns_cache=resolver is None,
+            keepalive_timeout=self.keepalive_timeout, ssl=self.ssl_context(),
+            **kwargs
+        )
+
+    def session(self, connector: aiohttp.BaseConnector) -> ClientSession:
+        return ClientSession(connector=connector, timeout=self.timeout(),
+                             headers=self.headers())
+
+
+_ssl_contexts = {}
+
+
+def _ssl_context(verify: bool) -> ssl.SSLContext:
+    """TLS context created once per process: loading the CA certificates
+    for every connection would cost more than the handshake itself"""
+
+    context = _ssl_contexts.get(verify)
+    if context is None:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        _ssl_contexts[verify] = context
+    return context
+
+
+default_profile = HttpClientProfile()
@@ -0,0 +1,168 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+from typing import Dict, Iterator, Optional, Tuple
+
+# Stems are looked for inside words ("почт" matches "почтовый"), words must
+# match a whole word ("ems" matches "EMS-доставка" but not "systems").
+# Every distinct matched word adds the keyword's weight to the page's score
+RU_STEMS = {"почт": 1.0, "росси": 1.0, "отправлени": 1.0, "посылк": 1.0,
+            "письм": 1.0, "писем": 1.0}
+LATIN_STEMS = {"pocht": 1.0, "rossii": 1.0, "rossiya": 1.0,
+               "otpravleni": 1.0, "posylk": 1.0, "pisem": 1.0}
+BRAND_WORDS = {"ems": 1.0, "russianpost": 2.0, "почтароссии": 2.0}
+
+# A page is considered dangerous when its score reaches the threshold
+DANGER_THRESHOLD = float(os.getenv("DANGER_THRESHOLD", 3))
+
+# Path to a json file with "stems", "words" and "threshold" keys overriding
+# the default keyword sets
+KEYWORDS_FILE = os.getenv("KEYWORDS_FILE")
+
+WORD_END_PATTERN = re.compile(r"\w*")
+# Everything up to the last whitespace of a text, found in linear time
+LAST_SPACE_PATTERN = re.compile(r".*\s", re.DOTALL)
+# Max number of characters of an unfinished word a KeywordScorer holds back
+# for the next piece (at least the longest keyword's length): a page without
+# whitespace is scored as it comes rather than rescanned with every piece
+MAX_WORD_LENGTH = 256
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _build_trie_pattern(keywords) -> str:
+    """Build a regex alternation of the keywords with their common prefixes
+    factored out, so that the regex engine tries every branch only once"""
+
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = (branches[0] if len(branches) == 1
+                   else f"(?:{'|'.join(branches)})")
+        if "" in node:
+            # Greedy optional suffix, so the longest keyword wins
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """Find weighted flag keywords in a text with a single compiled regex"""
+
+    def __init__(self, stems: Dict[str, float],
+                 words: Optional[Dict[str, float]] = None,
+                 threshold: float = DANGER_THRESHOLD):
+        self.threshold = threshold
+        # keyword -> (weight, whether it must match a whole word)
+        self._keywords = {stem.lower(): (weight, False)
+                          for stem, weight in stems.items()}
+        self._keywords.update({word.lower(): (weight, True)
+                               for word, weight in (words or {}).items()})
+        self._pattern = re.compile(
+            _build_trie_pattern(self._keywords) or r"(?!x)x"
+        )
+        self.max_length = max(map(len, self._keywords), default=0)
+
+    @classmethod
+    def from_file(cls, path: str) -> "KeywordMatcher":
+        with open(path, "r") as fp:
+            config = json.load(fp)
+        return cls(config.get("stems", {}), config.get("words", {}),
+                   config.get("threshold", DANGER_THRESHOLD))
+
+    def find_terms(self, text: str) -> Iterator[Tuple[str, float]]:
+        """Yield (matched word, weight) pairs found in the text"""
+        text = text.lower()
+        search = self._pattern.search
+        position = 0
+
+        match = search(text, position)
+        while match:
+            keyword_start, keyword_end = match.span()
+            word_start = keyword_start
+            while (word_start > position
+                   and _is_word_char(text[word_start - 1])):
+                word_start -= 1
+            word_end = WORD_END_PATTERN.match(text, keyword_end).end()
+
+            weight, whole_word = self._keywords[match.group()]
+            if not whole_word or (word_start, word_end) == match.span():
+                yield text[word_start:word_end], weight
+
+            # Every word is matched once, even if it holds several keywords
+            position = max(word_end, keyword_start + 1)
+            match = search(text, position)
+
+    def score(self, text: str) -> Tuple[float, Dict[str, float]]:
+        """Score a whole text
+
+        :return: the text's score and the distinct matched words with their
+        weights
+        """
+        scorer = KeywordScorer(self)
+        scorer.feed(text)
+        scorer.close()
+        return scorer.score, scorer.terms
+
+
+class KeywordScorer:
+    """Score a text fed to it piece by piece, e.g. while a page is being
+    downloaded. A word split between two pieces is matched as a whole."""
+
+    def __init__(self, matcher: KeywordMatcher):
+        self.matcher = matcher
+        self.terms = {}
+        self.score = 0.0
+        self._tail = ""
+        self._max_tail = max(MAX_WORD_LENGTH, matcher.max_length)
+
+    @property
+    def is_dangerous(self) -> bool:
+        return self.score >= self.matcher.threshold
+
+    def feed(self, text: str):
+        # The last word may continue in the next piece
+        match = LAST_SPACE_PATTERN.match(text)
+        if match:
+            end = match.end()
+            self._scan(self._tail + text[:end])
+            self._tail = text[end:]
+        else:
+            self._tail += text
+        if len(self._tail) > self._max_tail:
+            self._scan(self._tail[:-self._max_tail])
+            self._tail = self._tail[-self._max_tail:]
+
+    def close(self):
+        self._scan(self._tail)
+        self._tail = ""
+
+    def _scan(self, text: str):
+        for term, weight in self.matcher.find_terms(text):
+            if term not in self.terms:
+                self.terms[term] = weight
+                self.score += weight
+
+
+def load_default_matcher() -> KeywordMatcher:
+    if KEYWORDS_FILE:
+        return KeywordMatcher.from_file(KEYWORDS_FILE)
+    return KeywordMatcher({**RU_STEMS, **LATIN_STEMS}, BRAND_WORDS)
+
+
+default_matcher = load_default_matcher()
@@ -0,0 +1,72 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import random
+from typing import Optional
+
+# Seconds between checks of a domain depending on what its last checks have
+# found. Dangerous sites are watched closely, live ones are checked daily and
+# dead ones back off exponentially: every consecutive check finding a domain
+# dead doubles its interval up to RECHECK_DEAD_MAX_INTERVAL
+RECHECK_DANGEROUS_INTERVAL = float(
+    os.getenv("RECHECK_DANGEROUS_INTERVAL", 6 * 3600)
+)
+RECHECK_ALIVE_INTERVAL = float(os.getenv("RECHECK_ALIVE_INTERVAL", 24 * 3600))
+RECHECK_DEAD_INTERVAL = float(os.getenv("RECHECK_DEAD_INTERVAL", 24 * 3600))
+RECHECK_DEAD_MAX_INTERVAL = float(
+    os.getenv("RECHECK_DEAD_MAX_INTERVAL", 30 * 24 * 3600)
+)
+# Domains registered less than RECENTLY_REGISTERED_AGE seconds ago (as told
+# by their WHOIS record) are usually still being set up, so they are checked
+# every RECHECK_NEW_DOMAIN_INTERVAL seconds
+RECHECK_NEW_DOMAIN_INTERVAL = float(
+    os.getenv("RECHECK_NEW_DOMAIN_INTERVAL", 3600)
+)
+RECENTLY_REGISTERED_AGE = float(
+    os.getenv("RECENTLY_REGISTERED_AGE", 30 * 24 * 3600)
+)
+# Share of an interval by which next checks are randomly moved, so that
+# domains checked together do not all fall due at the same moment again
+RECHECK_JITTER = float(os.getenv("RECHECK_JITTER", 0.1))
+
+
+def check_interval(is_alive: bool, is_dangerous: bool, dead_checks: int = 0,
+                   registered_at: Optional[datetime.datetime] = None,
+                   now: Optional[datetime.datetime] = None) -> float:
+    """Number of seconds until a domain should be checked again
+
+    :param dead_checks: number of consecutive checks (the last one included)
+    that have found the domain dead
+    :param registered_at: the domain's creation date from its WHOIS record
+    """
+    now = now or datetime.datetime.utcnow()
+
+    if is_dangerous:
+        interval = RECHECK_DANGEROUS_INTERVAL
+    elif is_alive:
+        interval = RECHECK_ALIVE_INTERVAL
+    else:
+        interval = min(
+            RECHECK_DEAD_INTERVAL * 2 ** max(dead_checks - 1, 0),
+            RECHECK_DEAD_MAX_INTERVAL
+        )
+
+    if (registered_at and (now - registered_at).total_seconds()
+            < RECENTLY_REGISTERED_AGE):
+        interval = min(interval, RECHECK_NEW_DOMAIN_INTERVAL)
+    return interval
+
+
+def next_check_time(is_alive: bool, is_dangerous: bool, dead_checks: int = 0,
+                    registered_at: Optional[datetime.datetime] = None,
+                    now: Optional[datetime.datetime] = None
+                    ) -> datetime.datetime:
+    """Time (utc) a domain is due to be checked again"""
+
+    now = now or datetime.datetime.utcnow()
+    interval = check_interval(is_alive, is_dangerous, dead_checks,
+                              registered_at, now)
+    interval *= 1 + random.uniform(-RECHECK_JITTER, RECHECK_JITTER)
+    return now + datetime.timedelta(seconds=interval)
@@ -0,0 +1,187 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+from typing import AsyncIterator, List, Optional
+
+from ..db.db_utils import (checkpoint_scan_run, find_interrupted_scan_run,
+                           resume_scan_run, start_scan_run)
+
+logger = logging.getLogger(__name__)
+
+# Name the runs of a scanner process are recorded under, so that the process
+# taking its place after a restart resumes them, and number of seconds
+# between two checkpoints of a run's progress
+SCANNER_NAME = os.getenv("SCANNER_NAME", "scanner")
+SCAN_CHECKPOINT_INTERVAL = float(os.getenv("SCAN_CHECKPOINT_INTERVAL", 30))
+
+
+def hash_candidates(urls: List[str]) -> str:
+    digest = hashlib.sha256()
+    for url in urls:
+        digest.update(url.encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+
+class ScanProgress:
+    """Positions of the candidates of a scan whose checks have been saved.
+
+    Checks complete out of order, 'cursor' is the number of candidates from
+    the start of the scan that have all been saved: a resumed scan starts
+    from there. The cursor never passes a failed check, so that a resumed
+    scan checks its candidate again (the ones after it that have been
+    saved are not due anymore and are skipped). Failed positions are kept
+    apart, so the saved ones after them are not held in memory meanwhile.
+    """
+
+    def __init__(self, cursor: int = 0, checked: int = 0):
+        self.checked = checked
+        self.failed = 0
+        self._next = cursor
+        # Number of candidates from the start that have all completed,
+        # saved or failed, and positions of the ones completed after them
+        self._completed = cursor
+        self._done = set()
+        self._failed = set()
+        self._first_failed = None
+
+    @property
+    def cursor(self) -> int:
+        if self._first_failed is None:
+            return self._completed
+        return min(self._completed, self._first_failed)
+
+    def add(self) -> int:
+        """:return: the position of the next candidate"""
+        position = self._next
+        self._next += 1
+        return position
+
+    def done(self, position: int):
+        self.checked += 1
+        self._done.add(position)
+        self._advance()
+
+    def fail(self, position: int):
+        self.failed += 1
+        self._failed.add(position)
+        if self._first_failed is None or position < self._first_failed:
+            self._first_failed = position
+        self._advance()
+
+    def _advance(self):
+        while (self._completed in self._done
+               or self._completed in self._failed):
+            self._done.discard(self._completed)
+            self._completed += 1
+
+
+class ScanRun:
+    """A scan recorded in 'scan_runs' with periodic checkpoints of its
+    progress.
+
+    A run is either a pass over the domains due before 'due_before' or a
+    scan of given 'urls'. Starting a run resumes the scanner's interrupted
+    run over the same candidates if there is one: a pass keeps its
+    'due_before' and takes back the domains it had claimed, a scan of urls
+    skips the ones before its cursor. Domains checked since are not due
+    anymore, so they are not checked again either way.
+    """
+
+    def __init__(self, scanner: str = SCANNER_NAME,
+                 urls: Optional[List[str]] = None,
+                 interval: float = SCAN_CHECKPOINT_INTERVAL):
+        self.scanner = scanner
+        self.urls = urls
+        self.interval = interval
+        self.candidates_hash = (hash_candidates(urls) if urls is not None
+                                else None)
+        self.run_id = None
+        self.due_before = None
+        self.resumed = False
+        self.progress = ScanProgress()
+        self._task = None
+
+    async def start(self, resume: bool = True):
+        run = await find_interrupted_scan_run(
+            self.scanner, self.candidates_hash
+        ) if resume else None
+        if run is not None:
+            self.run_id = run["run_id"]
+            self.due_before = run["due_before"]
+            self.progress = ScanProgress(run["cursor"] or 0,
+                                         run["checked"] or 0)
+            self.resumed = True
+            released = await resume_scan_run(self.run_id)
+            logger.info(
+                "Resuming scan run %s started at %s: %s candidates checked, "
+                "%s claimed ones released", self.run_id, run["started_at"],
+                self.progress.checked, released
+            )
+        else:
+            if self.urls is None:
+                self.due_before = datetime.datetime.utcnow()
+            self.run_id = await start_scan_run(
+                self.scanner, self.candidates_hash, self.due_before
+            )
+        self._task = asyncio.ensure_future(self._checkpoint_periodically())
+
+    def remaining_urls(self) -> List[str]:
+        """Urls of a scan of given urls that are left to check"""
+        return self.urls[self.progress.cursor:]
+
+    async def track(self, candidates: AsyncIterator[tuple]
+                    ) -> AsyncIterator[tuple]:
+        """Add the candidate's position to the (url, state) pairs"""
+        async for url, state in candidates:
+            yield url, state, self.progress.add()
+
+    def done(self, position: int, saved: Optional[asyncio.Future] = None,
+             failed: bool = False):
+        """Count the candidate's check once its result has been saved
+
+        :param saved: future of the domain's id once its record is written,
+        None if the candidate has been skipped
+        :param failed: whether the check has raised
+        """
+        if failed:
+            self.progress.fail(position)
+        elif saved is None:
+            self.progress.done(position)
+        elif saved.done():
+            self._saved(position, saved)
+        else:
+            saved.add_done_callback(
+                lambda _: self._saved(position, saved)
+            )
+
+    def _saved(self, position: int, saved: asyncio.Future):
+        if (not saved.cancelled() and saved.exception() is None
+                and saved.result()):
+            self.progress.done(position)
+        else:
+            self.progress.fail(position)
+
+    async def checkpoint(self, finished: bool = False):
+        if self.run_id is not None:
+            await checkpoint_scan_run(self.run_id, self.progress.cursor,
+                                      self.progress.checked, finished)
+
+    async def close(self, finished: bool):
+        """Stop checkpointing and save the last checkpoint, recording the
+        end of the run if it has 'finished'"""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.checkpoint(finished)
+
+    async def _checkpoint_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.checkpoint()
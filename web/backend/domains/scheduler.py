@@ -0,0 +1,299 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import contextlib
+import inspect
+import logging
+import os
+from typing import (AsyncIterable, Awaitable, Callable, Hashable, Iterable,
+                    Optional, Union)
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger(__name__)
+
+# Number of urls processed at the same time during a scan and max number
+# of them that may target the same host (or IP address) and the same network,
+# i.e. roughly the same hosting provider
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", 200))
+SCAN_PER_HOST_LIMIT = int(os.getenv("SCAN_PER_HOST_LIMIT", 4))
+SCAN_PER_NETWORK_LIMIT = int(os.getenv("SCAN_PER_NETWORK_LIMIT", 16))
+
+# Max number of urls set aside because one of their hosts or networks is
+# already at its limit: workers take the next url meanwhile instead of
+# waiting for that host, and only wait once this many urls are set aside
+SCAN_MAX_DEFERRED = int(os.getenv("SCAN_MAX_DEFERRED", 1000))
+
+# Requests in flight are limited adaptively between SCAN_MIN_CONCURRENCY and
+# SCAN_CONCURRENCY, starting at SCAN_INITIAL_CONCURRENCY: the limit grows by
+# one after every SCAN_AIMD_WINDOW requests as long as their p95 latency
+# stays under SCAN_TARGET_LATENCY seconds and the share of them that time out
+# or fail to connect under SCAN_MAX_ERROR_RATE, and is multiplied by
+# SCAN_AIMD_DECREASE otherwise
+SCAN_MIN_CONCURRENCY = int(os.getenv("SCAN_MIN_CONCURRENCY", 10))
+SCAN_INITIAL_CONCURRENCY = int(os.getenv("SCAN_INITIAL_CONCURRENCY", 50))
+SCAN_AIMD_WINDOW = int(os.getenv("SCAN_AIMD_WINDOW", 50))
+SCAN_AIMD_DECREASE = float(os.getenv("SCAN_AIMD_DECREASE", 0.7))
+SCAN_TARGET_LATENCY = float(os.getenv("SCAN_TARGET_LATENCY", 5))
+SCAN_MAX_ERROR_RATE = float(os.getenv("SCAN_MAX_ERROR_RATE", 0.2))
+
+
+def host_keys(item) -> Iterable[Hashable]:
+    """Default limit keys of a queued item: the host of its url"""
+    url = item[0] if isinstance(item, tuple) else item
+    return [urlsplit(url).hostname or url]
+
+
+class KeyedLimiter:
+    """Limit the number of concurrent operations sharing the same key
+    (e.g. the same host or IP address).
+
+    Semaphores only exist while someone holds or waits for them, so memory
+    does not grow with the number of distinct keys seen during a scan.
+    'limit' is either the same limit for all keys or a function giving the
+    limit of a key.
+    """
+
+    def __init__(self, limit: Union[int, Callable[[Hashable], int]]):
+        self.limit = limit if callable(limit) else (lambda key: limit)
+        self._semaphores = {}
+
+    def __len__(self):
+        return len(self._semaphores)
+
+    def saturated(self, keys: Iterable[Hashable]) -> Optional[Hashable]:
+        """First of the keys that is at its limit, None if there is none"""
+        for key in keys:
+            entry = self._semaphores.get(key)
+            if entry is not None and entry[0].locked():
+                return key
+        return None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, key: Hashable):
+        entry = self._semaphores.get(key)
+        if entry is None:
+            entry = self._semaphores[key] = [
+                asyncio.Semaphore(self.limit(key)), 0
+            ]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._semaphores[key]
+
+
+class AdaptiveLimiter:
+    """Limit the number of concurrent operations (e.g. requests) with AIMD:
+    additive increase while they are healthy, multiplicative decrease as
+    soon as they are not.
+
+    Operations report their latency and whether they have failed in a way
+    that overload causes (timeouts, failed connections) to 'observe()'.
+    After every 'window' observations the limit is decided on: it grows by
+    one if the p95 latency and the error rate of the window are under their
+    targets and the limit has actually been reached, it is multiplied by
+    'decrease' if either is over. 'on_decision' is called with the decision
+    ("increase", "decrease" or "hold"), the new limit, the p95 latency and
+    the error rate.
+    """
+
+    def __init__(self, min_limit: int = SCAN_MIN_CONCURRENCY,
+                 max_limit: int = SCAN_CONCURRENCY,
+                 initial_limit: int = SCAN_INITIAL_CONCURRENCY,
+                 window: int = SCAN_AIMD_WINDOW,
+                 decrease: float = SCAN_AIMD_DECREASE,
+                 target_latency: float = SCAN_TARGET_LATENCY,
+                 max_error_rate: float = SCAN_MAX_ERROR_RATE,
+                 on_decision: Optional[Callable] = None):
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.max_limit = max_limit
+        self.limit = max(self.min_limit, min(initial_limit, max_limit))
+        self.window = window
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.on_decision = on_decision
+        self.in_flight = 0
+        self.decisions = collections.Counter()
+        self._saturated = False
+        self._latencies = []
+        self._errors = 0
+        self._waiters = collections.deque()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        while self.in_flight >= self.limit:
+            self._saturated = True
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    # Pass the wake-up on to another waiter
+                    self._wake()
+                raise
+        self.in_flight += 1
+        if self.in_flight >= self.limit:
+            self._saturated = True
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        for _ in range(min(self.limit - self.in_flight, len(self._waiters))):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def observe(self, latency: float, error: bool = False):
+        self._latencies.append(latency)
+        self._errors += bool(error)
+        if len(self._latencies) >= self.window:
+            self._decide()
+
+    def _decide(self):
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        error_rate = self._errors / len(latencies)
+
+        if p95 > self.target_latency or error_rate > self.max_error_rate:
+            decision = "decrease"
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+        elif self._saturated and self.limit < self.max_limit:
+            # Growing a limit that is not reached tells nothing about the
+            # load the next requests can take
+            decision = "increase"
+            self.limit += 1
+            self._wake()
+        else:
+            decision = "hold"
+
+        self.decisions[decision] += 1
+        self._saturated = self.in_flight >= self.limit
+        self._latencies = []
+        self._errors = 0
+        if self.on_decision is not None:
+            self.on_decision(decision, self.limit, p95, error_rate)
+
+
+class Scheduler:
+    """Process items with a fixed pool of workers consuming a bounded queue.
+
+    At most 'concurrency' items are handled at once and at most
+    'per_key_limit' of them may share any of the keys returned by
+    'keys(item)', which may also be a coroutine function. Items are pulled
+    from the source only as fast as workers take them, so memory stays flat
+    regardless of the source's length.
+
+    An item one of whose keys is at its limit is set aside rather than
+    waited for, and the worker takes the next one: many items sharing a key
+    (e.g. parked domains on the same IP address) hold up no more than the
+    workers handling them. Whoever releases the key then handles the item.
+    Workers only wait for keys once 'max_deferred' items are set aside.
+    """
+
+    def __init__(self, handler: Callable[..., Awaitable],
+                 concurrency: int = SCAN_CONCURRENCY,
+                 per_key_limit: Union[int, Callable] = SCAN_PER_HOST_LIMIT,
+                 keys: Callable[..., Iterable[Hashable]] = host_keys,
+                 max_deferred: int = SCAN_MAX_DEFERRED):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.keys = keys
+        self.limiter = KeyedLimiter(per_key_limit)
+        self.max_deferred = max_deferred
+        self.processed = 0
+        self.failed = 0
+        self._queue = asyncio.Queue(maxsize=concurrency * 2)
+        self._deferred = {}
+        self._deferred_count = 0
+
+    def queued(self) -> int:
+        """Number of items waiting for a worker"""
+        return self._queue.qsize()
+
+    def deferred(self) -> int:
+        """Number of items set aside until one of their keys is released"""
+        return self._deferred_count
+
+    async def run(self, items: AsyncIterable):
+        """Handle all the items and return once the last one is done"""
+        workers = [asyncio.ensure_future(self._work())
+                   for _ in range(self.concurrency)]
+        try:
+            async for item in items:
+                await self._queue.put(item)
+            for _ in workers:
+                await self._queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            try:
+                keys = self.keys(item)
+                if inspect.isawaitable(keys):
+                    keys = await keys
+                keys = list(keys)
+            except Exception as e:
+                self._fail(item, e)
+                continue
+
+            # Items set aside on the keys just released are handled by the
+            # same worker: the key is known to have a free slot for them
+            while item is not None:
+                busy = self.limiter.saturated(keys)
+                if (busy is not None
+                        and self._deferred_count < self.max_deferred):
+                    self._deferred.setdefault(
+                        busy, collections.deque()
+                    ).append((item, keys))
+                    self._deferred_count += 1
+                    break
+                await self._handle(item, keys)
+                item, keys = self._take_deferred(keys)
+
+    async def _handle(self, item, keys: list):
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                for key in keys:
+                    await stack.enter_async_context(self.limiter.acquire(key))
+                await self.handler(item)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.processed += 1
+
+    def _take_deferred(self, keys: list) -> tuple:
+        """Oldest item set aside on one of the keys, (None, None) if none"""
+        for key in keys:
+            deferred = self._deferred.get(key)
+            if deferred:
+                item = deferred.popleft()
+                if not deferred:
+                    del self._deferred[key]
+                self._deferred_count -= 1
+                return item
+        return None, None
+
+    def _fail(self, item, error: Exception):
+        self.failed += 1
+        self.processed += 1
+        logger.error("Failed to process %r: %r", item, error)
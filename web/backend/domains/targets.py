@@ -0,0 +1,56 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+from typing import Optional
+
+from .fingerprint import Verdict
+
+
+class TargetIndex:
+    """Verdicts on the pages of the final urls reached during a scan, after
+    redirects, so that a landing page many squatted domains redirect to is
+    downloaded and analysed once.
+
+    The first domain reaching a url claims it and analyses its page. The
+    others reaching it meanwhile wait for its verdict instead of
+    downloading the page as well (single-flight), the later ones take it
+    over right away. Once published, a verdict is kept without its future.
+    """
+
+    def __init__(self):
+        self._verdicts = {}
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    def claim(self, url: str) -> Optional[asyncio.Future]:
+        """Claim the url's page for the caller unless a domain already has
+
+        :return: None if the caller has to analyse the page and 'publish()'
+        its verdict, otherwise a future resolving to the Verdict (None if
+        the page could not be analysed)
+        """
+        loop = asyncio.get_event_loop()
+        verdict = self._verdicts.get(url)
+        if isinstance(verdict, asyncio.Future):
+            return verdict
+        if verdict is not None:
+            future = loop.create_future()
+            future.set_result(verdict)
+            return future
+        self._verdicts[url] = loop.create_future()
+        return None
+
+    def publish(self, url: str, verdict: Optional[Verdict]):
+        """Hand the verdict on a claimed url's page to the domains waiting
+        for it. Without a verdict the url may be claimed again."""
+
+        future = self._verdicts.get(url)
+        if not isinstance(future, asyncio.Future) or future.done():
+            return
+        future.set_result(verdict)
+        if verdict is None:
+            del self._verdicts[url]
+        else:
+            self._verdicts[url] = verdict
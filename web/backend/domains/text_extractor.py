@@ -0,0 +1,127 @@
+#! usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import codecs
+import re
+from html.parser import HTMLParser
+from typing import Optional
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.parser import HTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+META_CHARSET_PATTERN = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w.:-]+)""", re.IGNORECASE
+)
+
+
+def detect_charset(header_charset: Optional[str], head: bytes) -> str:
+    """Choose the encoding of a page: the one sent in the 'Content-Type'
+    header, else the one declared in a <meta> tag of the page's first bytes,
+    else utf-8"""
+
+    candidates = [header_charset]
+    meta_match = META_CHARSET_PATTERN.search(head)
+    if meta_match:
+        candidates.append(meta_match.group(1).decode("ascii", "ignore"))
+
+    for charset in candidates:
+        if not charset:
+            continue
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            continue
+    return "utf-8"
+
+
+class TextExtractor(HTMLParser):
+    """Extract the visible text of an html page fed to it chunk by chunk.
+
+    Unlike building a whole DOM, only the text found since the previous
+    call is kept, so a page can be analysed while it is still downloading.
+    """
+
+    SKIPPED_TAGS = {"script", "style", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skipped_depth = 0
+        self._pieces = []
+
+    def feed(self, html: str) -> str:
+        """Parse the next chunk of html
+
+        :return: the text extracted from the html fed so far that has not
+        been returned yet
+        """
+        super().feed(html)
+        return self._pop_text()
+
+    def close(self) -> str:
+        super().close()
+        return self._pop_text()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipped_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skipped_depth:
+            self._skipped_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skipped_depth:
+            self._pieces.append(data)
+
+    def _pop_text(self) -> str:
+        text = "".join(self._pieces)
+        self._pieces.clear()
+        return text
+
+
+def _extract_with_lxml(html: str) -> str:
+    try:
+        root = lxml.html.document_fromstring(html)
+    except lxml.etree.ParserError:
+        # lxml refuses documents without any element
+        return ""
+    for element in root.iter(*TextExtractor.SKIPPED_TAGS):
+        element.drop_tree()
+    return " ".join(root.itertext())
+
+
+def _extract_with_selectolax(html: str) -> str:
+    tree = SelectolaxParser(html)
+    for node in tree.css(", ".join(TextExtractor.SKIPPED_TAGS)):
+        node.decompose()
+    return tree.root.text(separator=" ") if tree.root else ""
+
+
+def _extract_with_html_parser(html: str) -> str:
+    extractor = TextExtractor()
+    return extractor.feed(html) + extractor.close()
+
+
+# Parsers extracting the text of a whole page at once, by name. lxml and
+# selectolax are several times faster than the standard library's parser
+# but they are optional
+PARSERS = {"html.parser": _extract_with_html_parser}
+if lxml:
+    PARSERS["lxml"] = _extract_with_lxml
+if SelectolaxParser:
+    PARSERS["selectolax"] = _extract_with_selectolax
+
+
+def extract_text(html: str, parser: str = "html.parser") -> str:
+    """Extract the visible text of a whole page with one of the PARSERS,
+    the standard library's one if the requested parser is not installed"""
+    if not html or html.isspace():
+        return ""
+    return PARSERS.get(parser, _extract_with_html_parser)(html)
@@ -1,6 +1,11 @@
 #! usr/bin/env python3
 # -*- coding: utf-8
 
+import hashlib
+import math
+import os
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
 CONNECTORS = ["", "-"]
 
 RU_PREFIXES = ["", "заказное", "отправка", "кабинет", "российская"]
@@ -15,44 +20,240 @@ EN_POSTFIXES = ["", "track", "tracker", "rossii", "russia",
                 "service", "servise", "kabinet", "cabinet"]
 EN_DOMAIN_ZONES = [".ru", ".net", ".info", ".org", ".site", ".su", ".com", ".ru.com"]
 
+PROTOCOLS = ["http://", "https://"]
+
+# Zones tried by the 'tld_swap' strategy in addition to the ones above
+EXTRA_DOMAIN_ZONES = [".online", ".store", ".shop", ".xyz", ".top", ".pro",
+                      ".biz", ".ru.net", ".msk.ru", ".spb.ru", ".com.ru"]
+
+# Comma separated names of permutation strategies applied to the base
+# candidates, e.g. "typo,tld_swap". None are applied by default
+CANDIDATE_STRATEGIES = os.getenv("CANDIDATE_STRATEGIES", "")
+# Expected number of distinct candidates and acceptable share of candidates
+# wrongly dropped as duplicates by the Bloom filter
+CANDIDATE_BLOOM_CAPACITY = int(os.getenv("CANDIDATE_BLOOM_CAPACITY", 2000000))
+CANDIDATE_BLOOM_ERROR_RATE = float(
+    os.getenv("CANDIDATE_BLOOM_ERROR_RATE", 0.0001)
+)
+
+# A strategy takes a domain split into its first label and zone and yields
+# (label, zone) variants of it
+Strategy = Callable[[str, str], Iterator[Tuple[str, str]]]
+STRATEGIES: Dict[str, Strategy] = {}
+
+LATIN_KEYBOARD_ROWS = ["1234567890-", "qwertyuiop", "asdfghjkl", "zxcvbnm"]
+CYRILLIC_KEYBOARD_ROWS = ["йцукенгшщзхъ", "фывапролджэ", "ячсмитьбю"]
+
+# Latin letters and their look-alikes: Cyrillic letters for IDN homographs
+# and ascii characters or sequences of them that read the same
+HOMOGLYPHS = {
+    "a": ("а",), "c": ("с",), "e": ("е",), "o": ("о", "0"), "p": ("р",),
+    "x": ("х",), "y": ("у",), "i": ("1", "l"), "l": ("1", "i"),
+    "s": ("5",), "b": ("6",), "m": ("rn",),
+    "а": ("a",), "с": ("c",), "е": ("e",), "о": ("o", "0"), "р": ("p",),
+    "х": ("x",), "у": ("y",),
+}
+
+
+def register_strategy(name: str) -> Callable[[Strategy], Strategy]:
+    """Make a permutation strategy available under the given name"""
+
+    def register(strategy: Strategy) -> Strategy:
+        STRATEGIES[name] = strategy
+        return strategy
+
+    return register
+
+
+def split_domain(domain: str) -> Tuple[str, str]:
+    label, _, zone = domain.partition(".")
+    return label, "." + zone
+
+
+def is_valid_label(label: str) -> bool:
+    return (0 < len(label) <= 63
+            and not label.startswith("-") and not label.endswith("-")
+            and (label[2:4] != "--" or label.startswith("xn--"))
+            and all(char.isalnum() or char == "-" for char in label))
+
+
+def _keyboard_neighbours(rows: list) -> Dict[str, str]:
+    neighbours = {}
+    for row_index, row in enumerate(rows):
+        for column, char in enumerate(row):
+            adjacent = []
+            for other_index in (row_index - 1, row_index, row_index + 1):
+                if 0 <= other_index < len(rows):
+                    other_row = rows[other_index]
+                    adjacent.extend(other_row[max(column - 1, 0):column + 2])
+            neighbours[char] = "".join(
+                other for other in adjacent if other != char
+            )
+    return neighbours
+
+
+KEYBOARD_NEIGHBOURS = {
+    **_keyboard_neighbours(LATIN_KEYBOARD_ROWS),
+    **_keyboard_neighbours(CYRILLIC_KEYBOARD_ROWS),
+}
+
+
+@register_strategy("typo")
+def typo_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """Omitted, doubled and swapped characters"""
+    for index in range(len(label)):
+        yield label[:index] + label[index + 1:], zone
+        yield label[:index] + label[index] + label[index:], zone
+        if index + 1 < len(label):
+            yield (label[:index] + label[index + 1] + label[index] +
+                   label[index + 2:]), zone
+
+
+@register_strategy("bitsquat")
+def bitsquat_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """Characters with one flipped bit, as produced by memory errors"""
+    for index, char in enumerate(label):
+        if ord(char) > 127:
+            continue
+        for bit in range(7):
+            flipped = chr(ord(char) ^ (1 << bit)).lower()
+            if flipped != char and (flipped.isalnum() or flipped == "-"):
+                yield label[:index] + flipped + label[index + 1:], zone
+
+
+@register_strategy("homoglyph")
+def homoglyph_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """Characters replaced with look-alikes, including IDN homographs.
+    Variants are yielded in their punycode form if they are not ascii."""
+    for index, char in enumerate(label):
+        for glyph in HOMOGLYPHS.get(char, ()):
+            variant = label[:index] + glyph + label[index + 1:]
+            try:
+                yield variant.encode("idna").decode("ascii"), zone
+            except UnicodeError:
+                continue
+
+
+@register_strategy("tld_swap")
+def tld_swap_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """The same name in other zones"""
+    is_ascii = label.isascii()
+    for other_zone in [*EN_DOMAIN_ZONES, *EXTRA_DOMAIN_ZONES]:
+        if other_zone != zone and is_ascii:
+            yield label, other_zone
+
+
+@register_strategy("hyphenation")
+def hyphenation_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """A hyphen inserted between two characters or a hyphen removed"""
+    for index in range(1, len(label)):
+        if label[index - 1] == "-":
+            yield label[:index - 1] + label[index:], zone
+        elif label[index] != "-":
+            yield label[:index] + "-" + label[index:], zone
+
+
+@register_strategy("keyboard")
+def keyboard_variants(label: str, zone: str) -> Iterator[Tuple[str, str]]:
+    """Characters replaced with their neighbours on the keyboard"""
+    for index, char in enumerate(label):
+        for neighbour in KEYBOARD_NEIGHBOURS.get(char, ""):
+            yield label[:index] + neighbour + label[index + 1:], zone
+
+
+class BloomFilter:
+    """Set membership test in constant memory: m bits for the expected
+    capacity, with a small share of false positives and no false negatives"""
+
+    def __init__(self, capacity: int = CANDIDATE_BLOOM_CAPACITY,
+                 error_rate: float = CANDIDATE_BLOOM_ERROR_RATE):
+        self.size = max(
+            8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hash_count = max(
+            1, round(self.size / capacity * math.log(2))
+        )
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterator[int]:
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for index in range(self.hash_count):
+            yield (first + index * second) % self.size
+
+    def add(self, item: str) -> bool:
+        """Add the item
+
+        :return: False if the item has (probably) been added before
+        """
+        is_new = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                is_new = True
+                self._bits[byte] |= 1 << bit
+        return is_new
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position // 8] & (1 << position % 8)
+                   for position in self._positions(item))
+
 
 def generate_single_domains_list(
     connectors: list, prefixes: list, main_names: list,
     postfixes: list, domain_zones: list
-) -> list:
-
-    domains = []
+) -> Iterator[str]:
 
     for connector in connectors:
         for prefix in prefixes:
             for name in main_names:
                 for postfix in postfixes:
                     for domain_zone in domain_zones:
-                        if not prefix and not postfix:
-                            domains.append(name + domain_zone)
-                        elif postfix and not prefix:
-                            domains.append(name + connector + postfix + domain_zone)
-                        elif prefix and not postfix:
-                            domains.append(prefix + connector + name + domain_zone)
-                        else:
-                            domains.append(prefix + connector + name + connector +
-                                           postfix + domain_zone)
-
-    return domains
+                        yield connector.join(
+                            part for part in (prefix, name, postfix) if part
+                        ) + domain_zone
 
 
-def generate_final_domains_list() -> list:
-    ru_domains = generate_single_domains_list(
+def generate_base_domains() -> Iterator[str]:
+    yield from generate_single_domains_list(
         CONNECTORS, RU_PREFIXES, RU_MAIN_NAMES,
         RU_POSTFIX_NAMES, RU_DOMAIN_ZONES
     )
-    en_domains = generate_single_domains_list(
-        CONNECTORS, EN_PREFIXES, EN_MAIN_NAMES,EN_POSTFIXES, EN_DOMAIN_ZONES
+    yield from generate_single_domains_list(
+        CONNECTORS, EN_PREFIXES, EN_MAIN_NAMES, EN_POSTFIXES, EN_DOMAIN_ZONES
     )
 
-    return [protocol + url for url in [*ru_domains, *en_domains]
-            for protocol in ["http://", "https://"]]
 
+def generate_domains(strategies: Iterable[str] = ()) -> Iterator[str]:
+    """Yield the base candidates and then their variants produced by every
+    strategy in turn (duplicates included)"""
+
+    strategies = [STRATEGIES[name] for name in strategies]
+    yield from generate_base_domains()
+
+    for strategy in strategies:
+        for domain in generate_base_domains():
+            for label, zone in strategy(*split_domain(domain)):
+                if is_valid_label(label):
+                    yield label + zone
+
+
+def generate_candidates(strategies: Optional[Iterable[str]] = None,
+                        seen: Optional[BloomFilter] = None) -> Iterator[str]:
+    """Lazily yield the urls of candidate domains, every domain once with
+    each protocol
+
+    :param strategies: names of permutation strategies to apply, the ones
+    listed in CANDIDATE_STRATEGIES by default
+    :param seen: filter of the domains yielded so far
+    """
+    if strategies is None:
+        strategies = [name.strip() for name in CANDIDATE_STRATEGIES.split(",")
+                      if name.strip()]
+    seen = seen if seen is not None else BloomFilter()
 
-domains_list = generate_final_domains_list()
-print(len(domains_list))
+    for domain in generate_domains(strategies):
+        if seen.add(domain):
+            for protocol in PROTOCOLS:
+                yield protocol + domain
@@ -1,10 +1,13 @@
 #! usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 import datetime
 import logging
+import os
 import re
+import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import Optional
+from typing import Callable, Optional
 
 import sqlalchemy.sql
 import whois_alt
@@ -13,18 +16,46 @@ from sqlalchemy import select, insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.dialects.postgresql import insert
 
-from ..db.model import async_engine, all_domains, dangerous_domains, registrars
+from ..db.cache import notify_changes, response_cache
+from ..db.model import (async_engine, all_domains, dangerous_domains,
+                        registrars, whois_records)
+from ..metrics import Histogram
 
 logger = logging.getLogger(__name__)
 
-# Executor is needed to run blocking logging operations in a separate thread
-executor = ThreadPoolExecutor(max_workers=1)
-
 REG_RU_NAMES = ["registrar of domain names reg.ru llc",
                 "registrar of domain names reg.ru, llc",
                 "regru-ru"]
 RUCENTER_NAMES = ["regional network information center, jsc dba ru-center",
                   "ru-center-ru", "ru-center-rf"]
+# Registrar names as found in whois records -> name they are saved under
+REGISTRAR_ALIASES = {
+    **{name: "regru-ru" for name in REG_RU_NAMES},
+    **{name: "rucenter-ru" for name in RUCENTER_NAMES},
+}
+
+# Number of WHOIS lookups run at the same time, min number of seconds between
+# two queries to the same WHOIS server and how throttled queries are retried
+WHOIS_WORKERS = int(os.getenv("WHOIS_WORKERS", 4))
+WHOIS_MIN_INTERVAL = float(os.getenv("WHOIS_MIN_INTERVAL", 1))
+WHOIS_RETRIES = int(os.getenv("WHOIS_RETRIES", 3))
+WHOIS_BACKOFF = float(os.getenv("WHOIS_BACKOFF", 5))
+# Seconds a parsed WHOIS record is reused for
+WHOIS_CACHE_TTL = float(os.getenv("WHOIS_CACHE_TTL", 7 * 86400))
+
+THROTTLED_RESPONSE_PATTERN = re.compile(
+    r"limit exceeded|exceeded .*(limit|rate)|too many (requests|queries)|"
+    r"try again later|access denied|query rate",
+    re.IGNORECASE
+)
+
+WHOIS_SECONDS = Histogram("whois_lookup_seconds",
+                          "Time spent querying WHOIS servers")
+
+
+class WhoisThrottledError(Exception):
+    """WHOIS server has not answered or has refused to answer for now"""
+
 
 def prepare_url(url: str):
     """Drop 'http://' or 'https://' in the beginning of a url so that it
@@ -35,25 +66,35 @@ def prepare_url(url: str):
         main_url_part = url_match.group(1)
         return main_url_part
     except AttributeError:
-        executor.submit(
-            logger.error, f"Regexp did not find a match for url: {url}"
-        )
+        logger.error("Regexp did not find a match for url: %s", url)
         return url
 
 
 def get_whois_record(url: str) -> dict:
     """Get whois information on url.
-        :return a dict containing four parameters of a retrieved whois record:
-        'domain_name', 'owner_name', 'registrar_name', 'abuse_emails'
+        :return a dict containing five parameters of a retrieved whois record:
+        'domain_name', 'owner_name', 'registrar_name', 'abuse_emails',
+        'creation_date'
+        :raise WhoisThrottledError if the server has sent nothing or has
+        refused to answer
     """
 
     prepared_url = prepare_url(url)
     try:
         whois_record = whois_alt.get_whois(prepared_url)
+        raw_response = "\n".join(whois_record.get("raw") or [])
+        if (not raw_response.strip()
+                or THROTTLED_RESPONSE_PATTERN.search(raw_response)):
+            raise WhoisThrottledError(
+                f"WHOIS server has not answered for {prepared_url}"
+            )
         registrar_name = whois_record["registrar"][0] if (
             "registrar" in whois_record and whois_record["registrar"]) else ""
         abuse_emails = ", ".join(whois_record["emails"]) if (
             "emails" in whois_record and whois_record["emails"]) else ""
+        creation_date = min(whois_record["creation_date"]) if (
+            "creation_date" in whois_record and whois_record["creation_date"]
+        ) else None
 
         if "contacts" in whois_record and whois_record["contacts"]:
             owner_name = whois_record["contacts"]["registrant"]
@@ -63,66 +104,86 @@ def get_whois_record(url: str) -> dict:
             owner_name = ""
 
         return {"domain_name": url, "owner_name": owner_name,
-                "registrar_name": registrar_name, "abuse_emails": abuse_emails}
+                "registrar_name": registrar_name, "abuse_emails": abuse_emails,
+                "creation_date": creation_date}
 
     except whois_alt.shared.WhoisException as e:
-        executor.submit(
-            logger.info,
-            f"Have not found whois record for {prepared_url}. "
-            f"Error message: {e}")
+        logger.info("Have not found whois record for %s. Error message: %s",
+                    prepared_url, e)
         return {"domain_name": url, "owner_name": "", "registrar_name": "",
-                "abuse_emails": ""}
+                "abuse_emails": "", "creation_date": None}
+
+
+def normalize_registrar_name(registrar_name: str) -> str:
+    registrar_name = registrar_name.lower().strip()
+    return REGISTRAR_ALIASES.get(registrar_name, registrar_name)
+
 
+class RegistrarCache:
+    """Registrar name -> registrar id cache, warmed from the 'registrars'
+    table at the start of a scan so that known registrars are resolved
+    without a query"""
 
-async def find_domain_id(domain_name: str) -> Optional[int]:
+    def __init__(self):
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, registrar_name: str) -> Optional[int]:
+        return self._ids.get(registrar_name)
+
+    def remember(self, registrar_name: str, registrar_id: int):
+        self._ids[registrar_name] = registrar_id
+
+    async def warm(self):
+        select_stmt = select(registrars.c.registrar_name,
+                             registrars.c.registrar_id)
+        try:
+            async with async_engine.begin() as conn:
+                result = await conn.execute(select_stmt)
+                self._ids.update(
+                    (registrar_name, registrar_id)
+                    for registrar_name, registrar_id in result.fetchall()
+                )
+                result.close()
+        except (SQLAlchemyError, Exception) as e:
+            logger.error("Unexpected error occurred: %s", e)
+
+
+registrar_cache = RegistrarCache()
+
+
+async def find_domain_id(conn, domain_name: str) -> Optional[int]:
     select_stmt = (
         select(all_domains.c.domain_id).
         where(all_domains.c.url == domain_name)
     )
+    result = await conn.execute(select_stmt)
+    return result.scalar()
 
-    try:
-        async with async_engine.begin() as conn:
-            result = await conn.execute(select_stmt)
-            domain_id = result.fetchone()
-            result.close()
-            if domain_id:
-                domain_id = domain_id[0]
-            return domain_id
-    except Exception as e:
-        executor.submit(logger.error, f"Unexpected error occurred: {e}")
-        return sqlalchemy.sql.null()
-
-
-async def find_registrar_id(registrar_name: str) -> Optional[int]:
-    select_stmt = select(registrars.c.registrar_id). \
-        where(registrars.c.registrar_name == registrar_name)
-
-    try:
-        async with async_engine.begin() as conn:
-            result = await conn.execute(select_stmt)
-            registrar_id = result.fetchone()
-            result.close()
-            if registrar_id:
-                registrar_id = registrar_id[0]
-            return registrar_id
-    except Exception as e:
-        logger.error(f"Unexpected error occurred: {e}")
 
+async def save_registrar_info(conn, registrar_name: str,
+                              abuse_emails: str) -> int:
+    """Insert the registrar unless it already exists
 
-async def save_registrar_info(registrar_name: str, abuse_emails: str):
+    :return: the registrar's id
+    """
     insert_stmt = (
         insert(registrars).
         values(registrar_name=registrar_name, abuse_emails=abuse_emails)
     )
+    # Updating the conflicting row with its own name makes RETURNING give
+    # the id of an existing registrar too, even one inserted concurrently
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=["registrar_name"],
+        set_=dict(registrar_name=insert_stmt.excluded.registrar_name)
+    ).returning(registrars.c.registrar_id)
+    result = await conn.execute(upsert_stmt)
+    return result.scalar()
 
-    try:
-        async with async_engine.begin() as conn:
-            await conn.execute(insert_stmt)
-    except SQLAlchemyError as e:
-        logger.error(f"SQL error occurred: {e}")
 
-
-async def save_domain_info(domain_id: int, owner_name: str,
+async def save_domain_info(conn, domain_id: int, owner_name: str,
                            registrar_id: Optional[int]):
     now = datetime.datetime.utcnow()
     insert_stmt = (
@@ -135,29 +196,212 @@ async def save_domain_info(domain_id: int, owner_name: str,
         set_=dict(owner_name=owner_name, registrar_id=registrar_id,
                   last_updated=now)
     )
+    await conn.execute(update_stmt)
+
 
-    async with async_engine.begin() as conn:
-        await conn.execute(update_stmt)
-
-
-async def save_whois_record(whois_record: dict):
-    domain_id = await find_domain_id(whois_record["domain_name"])
-    registrar_name = whois_record["registrar_name"].lower().strip()
-    abuse_emails = whois_record["abuse_emails"]
-    owner_name = whois_record["owner_name"]
-    registrar_id = sqlalchemy.sql.null()
-
-    if registrar_name:
-        if registrar_name in REG_RU_NAMES:
-            registrar_name = "regru-ru"
-        if registrar_name in RUCENTER_NAMES:
-            registrar_name = "rucenter-ru"
-        registrar_id = await find_registrar_id(registrar_name)
-        if not registrar_id:
-            await save_registrar_info(registrar_name, abuse_emails)
-            registrar_id = await find_registrar_id(registrar_name)
-
-    await save_domain_info(domain_id, owner_name, registrar_id)
-    logger.info(
-        f"Saved whois record for {whois_record['domain_name']} to database"
+async def save_whois_record(whois_record: dict, domain_id=None):
+    """Save the whois record of a dangerous domain in a single transaction
+
+    :param domain_id: the id of the domain's row in 'all_domains', looked
+    up by the record's 'domain_name' if not given
+    """
+    registrar_name = normalize_registrar_name(whois_record["registrar_name"])
+    registrar_id = (registrar_cache.get(registrar_name)
+                    if registrar_name else None)
+
+    try:
+        async with async_engine.begin() as conn:
+            if domain_id is None:
+                domain_id = await find_domain_id(
+                    conn, whois_record["domain_name"]
+                )
+            if registrar_name and registrar_id is None:
+                registrar_id = await save_registrar_info(
+                    conn, registrar_name, whois_record["abuse_emails"]
+                )
+            await save_domain_info(
+                conn, domain_id, whois_record["owner_name"],
+                registrar_id if registrar_id else sqlalchemy.sql.null()
+            )
+            await notify_changes(conn)
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("Unexpected error occurred: %s", e)
+        return
+
+    response_cache.invalidate()
+    # Only remember the registrar once its row has been committed
+    if registrar_id:
+        registrar_cache.remember(registrar_name, registrar_id)
+    logger.info("Saved whois record for %s to database",
+                whois_record["domain_name"])
+
+
+def registrable_domain(url: str) -> str:
+    """Get the domain a WHOIS record is registered for from a url, so that
+    'http://', 'https://' and 'www.' variants share one record"""
+
+    host = prepare_url(url).split("/", 1)[0].split(":", 1)[0]
+    host = host.lower().rstrip(".")
+    return host[4:] if host.startswith("www.") else host
+
+
+async def load_cached_whois_record(domain_name: str,
+                                   max_age: float) -> Optional[dict]:
+    fetched_after = (datetime.datetime.utcnow() -
+                     datetime.timedelta(seconds=max_age))
+    select_stmt = (
+        select(whois_records.c.owner_name,
+               whois_records.c.registrar_name,
+               whois_records.c.abuse_emails,
+               whois_records.c.creation_date,
+               whois_records.c.fetched_at).
+        where(whois_records.c.domain_name == domain_name).
+        where(whois_records.c.fetched_at > fetched_after)
+    )
+
+    try:
+        async with async_engine.begin() as conn:
+            result = await conn.execute(select_stmt)
+            row = result.fetchone()
+            result.close()
+            return dict(row) if row else None
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("Unexpected error occurred: %s", e)
+
+
+async def save_cached_whois_record(domain_name: str, whois_record: dict):
+    values = dict(owner_name=whois_record["owner_name"],
+                  registrar_name=whois_record["registrar_name"],
+                  abuse_emails=whois_record["abuse_emails"],
+                  creation_date=whois_record.get("creation_date"),
+                  fetched_at=datetime.datetime.utcnow())
+    insert_stmt = (
+        insert(whois_records).
+        values(domain_name=domain_name, **values).
+        on_conflict_do_update(index_elements=["domain_name"], set_=values)
     )
+
+    try:
+        async with async_engine.begin() as conn:
+            await conn.execute(insert_stmt)
+    except (SQLAlchemyError, Exception) as e:
+        logger.error("Unexpected error occurred: %s", e)
+
+
+class WhoisResolver:
+    """Resolve WHOIS records without blocking the event loop.
+
+    Lookups run in a dedicated thread pool, queries to the same WHOIS server
+    (approximated by the domain's zone) are spaced by 'min_interval' seconds
+    and throttled queries are retried with exponential backoff. Parsed
+    records are cached by registrable domain in memory and, if 'persistent',
+    in the 'whois_records' table for 'cache_ttl' seconds. Concurrent lookups
+    of the same domain share one query.
+    """
+
+    def __init__(self, lookup: Callable[[str], dict] = get_whois_record,
+                 workers: int = WHOIS_WORKERS,
+                 min_interval: float = WHOIS_MIN_INTERVAL,
+                 retries: int = WHOIS_RETRIES,
+                 backoff: float = WHOIS_BACKOFF,
+                 cache_ttl: float = WHOIS_CACHE_TTL,
+                 persistent: bool = True):
+        self.lookup = lookup
+        self.min_interval = min_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_ttl = cache_ttl
+        self.persistent = persistent
+        self.lookups_made = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="whois"
+        )
+        self._cache = {}
+        self._pending = {}
+        self._next_query_time = {}
+
+    async def resolve(self, url: str) -> dict:
+        """Get the whois record of the url in the format of
+        'get_whois_record'"""
+
+        domain_name = registrable_domain(url)
+        cached = self._cache.get(domain_name)
+        if cached and cached[0] > time.monotonic():
+            return {**cached[1], "domain_name": url}
+
+        pending = self._pending.get(domain_name)
+        if pending is None:
+            pending = asyncio.ensure_future(self._resolve(domain_name))
+            self._pending[domain_name] = pending
+            pending.add_done_callback(
+                lambda _: self._pending.pop(domain_name, None)
+            )
+        whois_record = await asyncio.shield(pending)
+        return {**whois_record, "domain_name": url}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _resolve(self, domain_name: str) -> dict:
+        whois_record = None
+        if self.persistent:
+            whois_record = await load_cached_whois_record(
+                domain_name, self.cache_ttl
+            )
+            if whois_record:
+                age = (datetime.datetime.utcnow() -
+                       whois_record.pop("fetched_at")).total_seconds()
+                self._remember(domain_name, whois_record, self.cache_ttl - age)
+                return whois_record
+
+        whois_record = await self._lookup(domain_name)
+        if whois_record is None:
+            return {"owner_name": "", "registrar_name": "",
+                    "abuse_emails": "", "creation_date": None}
+
+        whois_record.pop("domain_name", None)
+        self._remember(domain_name, whois_record, self.cache_ttl)
+        if self.persistent:
+            await save_cached_whois_record(domain_name, whois_record)
+        return whois_record
+
+    async def _lookup(self, domain_name: str) -> Optional[dict]:
+        loop = asyncio.get_event_loop()
+        server = domain_name.rsplit(".", 1)[-1]
+
+        for attempt in range(self.retries + 1):
+            await self._wait_for_server(server)
+            try:
+                self.lookups_made += 1
+                with WHOIS_SECONDS.time():
+                    return await loop.run_in_executor(
+                        self._executor, self.lookup, domain_name
+                    )
+            except WhoisThrottledError as e:
+                delay = self.backoff * 2 ** attempt
+                logger.warning(
+                    "WHOIS lookup of %s has been throttled (attempt %s), "
+                    "retrying in %ss: %s", domain_name, attempt + 1, delay, e
+                )
+                # Let the whole server cool down, not only this domain
+                self._next_query_time[server] = max(
+                    self._next_query_time.get(server, 0),
+                    time.monotonic() + delay
+                )
+
+        logger.error("Giving up WHOIS lookup of %s after %s attempts",
+                     domain_name, self.retries + 1)
+        return None
+
+    async def _wait_for_server(self, server: str):
+        now = time.monotonic()
+        query_time = max(now, self._next_query_time.get(server, 0))
+        self._next_query_time[server] = query_time + self.min_interval
+        if query_time > now:
+            await asyncio.sleep(query_time - now)
+
+    def _remember(self, domain_name: str, whois_record: dict, ttl: float):
+        self._cache[domain_name] = (time.monotonic() + ttl, whois_record)
+
+
+whois_resolver = WhoisResolver()
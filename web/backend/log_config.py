@@ -0,0 +1,111 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Dict, Optional
+
+# Level of the messages logged by default and per-logger overrides, e.g.
+# "backend.domains.dns_resolver=DEBUG,sqlalchemy.engine=INFO"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# "text" for human-readable lines or "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s:%(processName)s:%(name)s: %(message)s"
+TEXT_DATE_FORMAT = "%d-%b-%y %H:%M:%S"
+
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """Parse 'logger=LEVEL' pairs separated by commas"""
+    parsed = {}
+    for pair in levels.split(","):
+        name, _, level = pair.partition("=")
+        if name.strip() and level.strip():
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON objects including the fields of their 'event'
+    (see 'log_event()')"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.utcfromtimestamp(
+                record.created
+            ).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "message": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry.update(event)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO,
+              **fields):
+    """Log a structured event, e.g. the result of a domain's check: its
+    fields are output as keys of the JSON object in the JSON format and
+    appended to the message in the text one"""
+
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s", event,
+                   " ".join(f"{key}={value}" for key, value in fields.items()),
+                   extra={"event": dict(event=event, **fields)})
+
+
+_listener = None
+
+
+def set_up_logging(filename: Optional[str] = None, level: str = LOG_LEVEL,
+                   levels: str = LOG_LEVELS, log_format: str = LOG_FORMAT):
+    """Send the records of every logger to a queue and write them to the
+    file (or stderr) from a listener thread, so that logging never blocks
+    the event loop on disk writes. Messages are only formatted for records
+    that pass the loggers' levels.
+    """
+    global _listener
+
+    stop_logging()
+
+    if filename:
+        handler = logging.FileHandler(filename, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level.upper())
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def stop_logging():
+    """Write out the records still queued and stop the listener thread"""
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,234 @@
+import bisect
+import contextlib
+import functools
+import inspect
+import logging
+import math
+import time
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return (value.replace("\\", r"\\").replace("\n", r"\n")
+            .replace('"', r'\"'))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                          for name, value in labels.items()) + "}"
+
+
+class Registry:
+    """Metrics exposed in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional["Metric"]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} "
+                             f"{_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric:
+    """A metric with a value per combination of the values of its labels,
+    passed to its methods as keyword arguments"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (), registry: Registry = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labels, key))
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        for key, value in sorted(self._values.items()):
+            yield "", self._labels(key), value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """Values by the combinations of labels they have been set for"""
+        return {key: self.value(**self._labels(key)) for key in self._values}
+
+    def total(self) -> float:
+        """Sum of the values for all the combinations of labels"""
+        return sum(self.values().values())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value going up and down, either set directly or read from a
+    function whenever the metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        for key, function in self._functions.items():
+            try:
+                self._values[key] = function()
+            except Exception as e:
+                logger.error("Failed to collect %s: %s", self.name, e)
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. latencies) over buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # Counts per bucket, sum and count of the observed values
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def value(self, **labels) -> int:
+        """Number of observed values"""
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Estimate the q-quantile of the observed values by linear
+        interpolation within their bucket, as Prometheus'
+        histogram_quantile() does"""
+
+        entry = self._values.get(self._key(labels))
+        if not entry or not entry[2]:
+            return None
+        rank = q * entry[2]
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, entry[0]):
+            if count and cumulative + count >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return lower
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield ("_bucket", {**labels, "le": _format_value(bound)},
+                       cumulative)
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+def measure_timing(histogram: Histogram, **labels):
+    """Decorator observing the run time of a function or coroutine
+    function in the histogram"""
+
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def _measure(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def _measure(*args, **kwargs):
+                with histogram.time(**labels):
+                    return function(*args, **kwargs)
+        return _measure
+
+    return decorator
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    body = registry.render().encode("utf-8")
+    return web.Response(body=body, headers={"Content-Type": CONTENT_TYPE})
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0") -> web.AppRunner:
+    """Serve '/metrics' on its own port, for processes without a web
+    application (e.g. scanners)"""
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
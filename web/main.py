@@ -1,54 +1,226 @@
 import asyncio
-from multiprocessing import Process
+import datetime
+import json
 import logging
+import os
+import time
 
 import aiohttp.web_response
 from aiohttp import web
 
-from backend.db.db_utils import get_dangerous_domains_list, whitelist_url, get_url_by_id
-from backend.domains.domains_checker import find_dangerous_domains
+from backend.db.cache import listen_for_changes, response_cache
+from backend.db.db_utils import (decode_cursor, get_dangerous_domains_page,
+                                 whitelist_domains)
+from backend.db.export import EXPORT_FORMATS, iter_export
+from backend.log_config import set_up_logging
+from backend.metrics import Histogram, handle_metrics
 
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s:%(name)s: %(message)s",
-    level=logging.DEBUG,
-    datefmt="%d-%b-%y %H:%M:%S",
-    filename=".log"
-)
 logger = logging.getLogger(__name__)
 routes = web.RouteTableDef()
 
-
-async def run_background_search():
-    while True:
-        await find_dangerous_domains()
-
-        # Schedule next search in 24 hours
-        await asyncio.sleep(86400)
-
-
+# Max number of domains a client may ask for in one page
+API_MAX_PAGE_SIZE = int(os.getenv("API_MAX_PAGE_SIZE", 1000))
+# Max number of ids and url patterns whitelisted by one request
+API_MAX_WHITELIST_SIZE = int(os.getenv("API_MAX_WHITELIST_SIZE", 1000))
+# File the web application logs to
+LOG_FILE = os.getenv("LOG_FILE", ".log")
+
+REQUEST_SECONDS = Histogram("http_request_seconds",
+                            "Time spent handling API requests",
+                            ["method", "route", "status"])
+
+
+@web.middleware
+async def measure_requests(request: web.Request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else "unmatched"
+    status = 500
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                method=request.method, route=route,
+                                status=status)
+
+
+async def set_up_app_logging(app: web.Application):
+    set_up_logging(LOG_FILE)
+
+
+# Domains are checked by the scanner service (scanner.py), the web
+# application only listens for the changes it makes
 async def set_up_background_tasks(app: web.Application):
-    app["run_background_search"] = asyncio.create_task(run_background_search())
+    app["listen_for_changes"] = asyncio.create_task(listen_for_changes())
 
 
 async def cleanup_background_tasks(app):
-    app["run_background_search"].cancel()
-    await app["run_background_search"]
+    app["listen_for_changes"].cancel()
+    try:
+        await app["listen_for_changes"]
+    except asyncio.CancelledError:
+        pass
+
+
+def parse_domains_query(query) -> dict:
+    """Validate the query parameters of '/api/dangerous-urls'
+
+    :raise ValueError if a parameter is invalid
+    """
+    params = {}
+    if query.get("limit"):
+        params["limit"] = int(query["limit"])
+        if not 0 < params["limit"] <= API_MAX_PAGE_SIZE:
+            raise ValueError(
+                f"limit must be between 1 and {API_MAX_PAGE_SIZE}"
+            )
+    if query.get("cursor"):
+        decode_cursor(query["cursor"])
+        params["cursor"] = query["cursor"]
+    for name in ("registrar", "owner", "target"):
+        if query.get(name):
+            params[name] = query[name]
+    if query.get("updated_since"):
+        params["updated_since"] = datetime.datetime.strptime(
+            query["updated_since"], "%Y-%m-%d"
+        ).date()
+    return params
 
 
 @routes.get("/api/dangerous-urls")
 async def output_current_results(request: web.Request):
-    found_dangerous_domains = await get_dangerous_domains_list()
-    return aiohttp.web_response.json_response(found_dangerous_domains)
+    """List dangerous domains. Without a 'limit' all of them are sent,
+    otherwise the cursor of the next page is sent in 'X-Next-Cursor'.
+    Responses are cached until a scan or a user changes the list."""
+
+    try:
+        params = parse_domains_query(request.query)
+    except ValueError as e:
+        return aiohttp.web_response.Response(status=400, text=str(e))
+
+    key = tuple(sorted(params.items()))
+    response = response_cache.get(key)
+    if response is None:
+        generation = response_cache.generation
+        page = await get_dangerous_domains_page(**params)
+        if page is None:
+            return aiohttp.web_response.json_response([])
+        domains, next_cursor = page
+        response = response_cache.put(
+            key, json.dumps(domains).encode("utf-8"),
+            next_cursor, generation
+        )
+
+    headers = {"ETag": response.etag, "Cache-Control": "no-cache"}
+    if response.next_cursor:
+        headers["X-Next-Cursor"] = response.next_cursor
+    if_none_match = request.headers.get("If-None-Match", "")
+    if response.etag in {etag.strip() for etag in if_none_match.split(",")}:
+        return aiohttp.web_response.Response(status=304, headers=headers)
+    return aiohttp.web_response.Response(
+        body=response.body, content_type="application/json", headers=headers
+    )
+
+
+@routes.get("/api/dangerous-urls/export")
+async def export_dangerous_domains(request: web.Request):
+    """Stream all the dangerous domains matching the filters of
+    '/api/dangerous-urls' as CSV or NDJSON ('format' parameter), gzipped if
+    the client accepts it"""
+
+    export_format = request.query.get("format", "csv")
+    try:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(
+                f"format must be one of {', '.join(EXPORT_FORMATS)}"
+            )
+        filters = parse_domains_query(request.query)
+    except ValueError as e:
+        return aiohttp.web_response.Response(status=400, text=str(e))
+    filters.pop("limit", None)
+    filters.pop("cursor", None)
+
+    compress = "gzip" in request.headers.get("Accept-Encoding", "")
+    response = web.StreamResponse(headers={
+        "Content-Disposition":
+            f'attachment; filename="dangerous_domains.{export_format}"'
+    })
+    response.content_type = EXPORT_FORMATS[export_format][0]
+    response.charset = "utf-8"
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    await response.prepare(request)
+
+    try:
+        async for data in iter_export(export_format, compress, **filters):
+            await response.write(data)
+    except Exception as e:
+        # Headers are sent already, so the client can only tell the export
+        # has failed by the connection being dropped
+        logger.error("Export of dangerous domains has failed: %s", e)
+        raise
+    await response.write_eof()
+    return response
+
+
+def parse_whitelist_request(body) -> dict:
+    """Validate the body of a bulk whitelist request: a JSON object with
+    lists of domains' 'ids' and of url 'patterns'
+
+    :raise ValueError if the body is invalid
+    """
+    if not isinstance(body, dict):
+        raise ValueError("body must be an object with 'ids' and 'patterns'")
+    items = {}
+    for name in ("ids", "patterns"):
+        values = body.get(name) or []
+        if not (isinstance(values, list)
+                and all(isinstance(value, str) and value.strip()
+                        for value in values)):
+            raise ValueError(f"{name} must be a list of strings")
+        items[name] = values
+    size = len(items["ids"]) + len(items["patterns"])
+    if not 0 < size <= API_MAX_WHITELIST_SIZE:
+        raise ValueError(f"between 1 and {API_MAX_WHITELIST_SIZE} ids and "
+                         f"patterns must be given")
+    return items
+
+
+@routes.patch("/api/dangerous-urls")
+async def do_whitelist_urls(request: web.Request):
+    """Whitelist domains by ids and url patterns (e.g. '*pochta-rf.ru') in
+    one transaction and send the urls whitelisted by every item"""
+
+    try:
+        items = parse_whitelist_request(await request.json())
+        results = await whitelist_domains(items["ids"], items["patterns"])
+    except ValueError as e:
+        return aiohttp.web_response.Response(status=400, text=str(e))
+    if results is None:
+        return aiohttp.web_response.Response(
+            status=503, text="Domains could not be whitelisted"
+        )
+    logger.info("%s urls have been whitelisted",
+                len({url for result in results for url in result["urls"]}))
+    return aiohttp.web_response.json_response(results)
 
 
 @routes.patch("/api/dangerous-urls/{url_id}")
 async def do_whitelist_url(request: web.Request):
     url_id = request.match_info.get("url_id", "")
-    logger.debug(f"url_id = {url_id}")
-    url_to_whitelist = await get_url_by_id(url_id)
-    if url_to_whitelist:
-        await whitelist_url(url_to_whitelist)
-        logger.info(f"Url {url_to_whitelist} has been whitelisted")
+    logger.debug("url_id = %s", url_id)
+    try:
+        results = await whitelist_domains([url_id])
+    except ValueError:
+        results = None
+    if results and results[0]["urls"]:
+        url_to_whitelist = results[0]["urls"][0]
+        logger.info("Url %s has been whitelisted", url_to_whitelist)
         return aiohttp.web_response.Response(
             status=200, text=f"{url_to_whitelist}"
         )
@@ -58,7 +230,9 @@ async def do_whitelist_url(request: web.Request):
         )
 
 
-app = web.Application()
+app = web.Application(middlewares=[measure_requests])
 app.add_routes(routes)
+app.router.add_get("/metrics", handle_metrics)
+app.on_startup.append(set_up_app_logging)
 app.on_startup.append(set_up_background_tasks)
 app.on_cleanup.append(cleanup_background_tasks)
@@ -0,0 +1,107 @@
+"""Scanner service: checks the candidate domains that are due, separately
+from the web application.
+
+    python scanner.py [--processes N] [--once]
+
+Scanner processes, on one host or several, coordinate through the database:
+every process claims the due domains it checks, so they can be run side by
+side with no further configuration. Every pass is recorded as a scan run
+under the name SCANNER_NAME-<index of the process>: a process restarted in
+the middle of a pass resumes it.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+
+from backend.db.db_utils import add_candidates
+from backend.db.model import async_engine, create_schema
+from backend.domains.domains_checker import (find_dangerous_domains,
+                                             seconds_until_next_check)
+from backend.domains.scan_runs import SCANNER_NAME
+from backend.domains.urls_generator import generate_candidates
+from backend.log_config import set_up_logging
+from backend.metrics import serve_metrics
+
+logger = logging.getLogger("scanner")
+
+# Number of scanner processes started by this service
+SCANNER_PROCESSES = int(os.getenv("SCANNER_PROCESSES", 1))
+# File the scanner processes log to, stderr if unset
+SCANNER_LOG_FILE = os.getenv("SCANNER_LOG_FILE")
+# Port the first scanner process serves '/metrics' on, the following ones
+# use the next ports (0 not to serve metrics)
+SCANNER_METRICS_PORT = int(os.getenv("SCANNER_METRICS_PORT", 9100))
+
+
+async def prepare_database(seed: bool):
+    """Create the schema and add new candidates once for all the processes"""
+
+    async with async_engine.begin() as conn:
+        await conn.run_sync(create_schema)
+    if seed:
+        added = await add_candidates(generate_candidates())
+        logger.info("Added %s new candidates", added)
+    # Connections can't be shared with the scanner processes
+    await async_engine.dispose()
+
+
+async def scan(once: bool, export: bool, metrics_port: int, name: str):
+    runner = await serve_metrics(metrics_port) if metrics_port else None
+    idle_passes = 0
+    try:
+        while True:
+            processed = await find_dangerous_domains(seed=False,
+                                                     export=export,
+                                                     scanner=name)
+            if once:
+                break
+            idle_passes = 0 if processed else idle_passes + 1
+            # Schedule next pass for when the next domain is due, backing
+            # off while the due ones are leased by other processes
+            await asyncio.sleep(await seconds_until_next_check(idle_passes))
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+def run_scanner(index: int, once: bool):
+    set_up_logging(SCANNER_LOG_FILE)
+    metrics_port = SCANNER_METRICS_PORT + index if SCANNER_METRICS_PORT else 0
+    # Every process updates the CSV snapshot after a pass that has changed
+    # dangerous domains, snapshots are replaced atomically
+    asyncio.run(scan(once, export=True, metrics_port=metrics_port,
+                     name=f"{SCANNER_NAME}-{index}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--processes", type=int, default=SCANNER_PROCESSES,
+                        help="number of scanner processes to run")
+    parser.add_argument("--once", action="store_true",
+                        help="exit after checking the domains due now")
+    parser.add_argument("--no-seed", dest="seed", action="store_false",
+                        help="do not add new candidates to the database")
+    args = parser.parse_args()
+
+    set_up_logging(SCANNER_LOG_FILE)
+    asyncio.run(prepare_database(args.seed))
+    if args.processes == 1:
+        run_scanner(0, args.once)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_scanner, args=(index, args.once),
+                        name=f"scanner-{index}")
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()